@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+# Time flatpakify end to end and phase by phase on a plain Linux box: no
+# Gentoo, no network, no root. Fake emerge, flatpak-builder, flatpak and sudo
+# from benchmarks/fakes go first on PATH, the host repository, vardb, portage
+# config and Flatpak runtime are synthetic, and the "emerged" rootfs has a
+# configurable number of ELF binaries, libraries and data files.
+# Per-phase numbers come from flatpakify --report.
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import struct
+import hashlib
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+FLATPAKIFY = BENCH_DIR.parent / "flatpakify.py"
+FAKES_DIR = BENCH_DIR / "fakes"
+
+CATEGORY = "bench-apps"
+PACKAGE = "bench-app"
+VERSION = "1.0"
+RUNTIME_ID = "org.freedesktop.Platform"
+RUNTIME_VERSION = "25.08"
+RUNTIME_LIBS = 8
+SCENARIOS = ["cold", "warm", "cached"]
+REPORT_FIELDS = ["wall_time", "cpu_time", "child_cpu_time", "bytes_written"]
+
+def host_elf_header():
+    # Class, byte order and machine of the running interpreter, so the synthetic
+    # objects resolve against host libraries the same way real ones would
+    with open(os.path.realpath(sys.executable), 'rb') as f:
+        header = f.read(20)
+    endian = "<" if header[5] == 1 else ">"
+    return header[4], endian, struct.unpack_from(endian + "H", header, 18)[0]
+
+def write_elf(path, needed, soname=None, payload=b""):
+    # Smallest dynamic object flatpakify's ELF reader accepts: a .dynstr and a
+    # .dynamic section with DT_NEEDED/DT_SONAME, after payload bytes for size
+    elf_class, endian, machine = HOST_ELF
+    wide = elf_class == 2
+    strings = b"\0"
+    offsets = {}
+    for name in needed + ([soname] if soname else []):
+        offsets[name] = len(strings)
+        strings += name.encode() + b"\0"
+    entries = [(1, offsets[name]) for name in needed] + ([(14, offsets[soname])] if soname else []) + [(0, 0)]
+    dynamic_format = endian + ("qQ" if wide else "iI")
+    dynamic = b"".join(struct.pack(dynamic_format, tag, value) for tag, value in entries)
+
+    header_size, section_size = (64, 64) if wide else (52, 40)
+    dynstr_offset = header_size + len(payload)
+    dynamic_offset = (dynstr_offset + len(strings) + 7) & ~7
+    section_offset = (dynamic_offset + len(dynamic) + 7) & ~7
+
+    section_format = endian + ("IIQQQQIIQQ" if wide else "IIIIIIIIII")
+    sections = [
+        (0, 0, 0, 0, 0, 0, 0, 0, 0, 0),
+        (0, 3, 0, 0, dynstr_offset, len(strings), 0, 0, 1, 0),
+        (0, 6, 0, 0, dynamic_offset, len(dynamic), 1, 0, 8, struct.calcsize(dynamic_format)),
+    ]
+    header = b"\x7fELF" + bytes([elf_class, 1 if endian == "<" else 2, 1, 0]) + bytes(8)
+    header += struct.pack(endian + "HHI", 3, machine, 1)
+    header += struct.pack(endian + ("QQQ" if wide else "III"), 0, 0, section_offset)
+    header += struct.pack(endian + "IHHHHHH", 0, header_size, 0, 0, section_size, len(sections), 0)
+
+    image = bytearray(section_offset + section_size * len(sections))
+    image[:len(header)] = header
+    image[header_size:header_size + len(payload)] = payload
+    image[dynstr_offset:dynstr_offset + len(strings)] = strings
+    image[dynamic_offset:dynamic_offset + len(dynamic)] = dynamic
+    for index, section in enumerate(sections):
+        struct.pack_into(section_format, image, section_offset + index * section_size, *section)
+    with open(path, 'wb') as f:
+        f.write(image)
+
+def flatpak_arch():
+    machine = platform.machine()
+    return {"amd64": "x86_64", "arm64": "aarch64", "i686": "i386", "armv7l": "arm"}.get(machine, machine)
+
+def write_contents(vardb_dir, cpf, paths):
+    # A vardb entry whose CONTENTS lists paths (relative to the prefix)
+    os.makedirs(f"{vardb_dir}/{cpf}", exist_ok=True)
+    with open(f"{vardb_dir}/{cpf}/CONTENTS", 'w') as f:
+        for path in paths:
+            f.write(f"obj {path} {hashlib.md5(path.encode()).hexdigest()} 0\n")
+
+def build_template(template, eprefix, args, rng):
+    # The rootfs the fake emerge merges: binaries need a few of the package's
+    # libraries, one runtime library and libc; libraries need later libraries
+    # and sometimes libz from the host, so every resolver layer is exercised
+    lib_dir = f"{template}/usr/lib64"
+    bin_dir = f"{template}/usr/bin"
+    data_dir = f"{template}/usr/share/{PACKAGE}"
+    for directory in (lib_dir, bin_dir, data_dir, f"{template}/usr/share/applications"):
+        os.makedirs(directory, exist_ok=True)
+    installed = []
+
+    libraries = [f"libbench{index}.so.1" for index in range(args.libraries)]
+    for index, soname in enumerate(libraries):
+        needed = rng.sample(libraries[index + 1:], min(2, len(libraries) - index - 1))
+        if index % 4 == 0:
+            needed.append("libz.so.1")
+        write_elf(f"{lib_dir}/{soname}", needed + ["libc.so.6"], soname, rng.randbytes(args.library_size))
+        os.symlink(soname, f"{lib_dir}/{soname[:-2]}")
+        installed.append(f"/usr/lib64/{soname}")
+
+    for index in range(args.binaries):
+        name = PACKAGE if index == 0 else f"{PACKAGE}-tool{index}"
+        needed = rng.sample(libraries, min(3, len(libraries))) + [f"libruntime{index % RUNTIME_LIBS}.so.1", "libc.so.6"]
+        write_elf(f"{bin_dir}/{name}", needed, payload=rng.randbytes(args.binary_size))
+        os.chmod(f"{bin_dir}/{name}", 0o755)
+        installed.append(f"/usr/bin/{name}")
+
+    # Half already compressed media, half compressible text
+    for index in range(args.data_files):
+        if index % 2:
+            name, content = f"sound{index}.ogg", rng.randbytes(args.data_size)
+        else:
+            name, content = f"level{index}.txt", (f"entity {index} " * (args.data_size // 10 + 1)).encode()[:args.data_size]
+        with open(f"{data_dir}/{name}", 'wb') as f:
+            f.write(content)
+        installed.append(f"/usr/share/{PACKAGE}/{name}")
+
+    with open(f"{template}/usr/share/applications/{PACKAGE}.desktop", 'w') as f:
+        f.write(f"[Desktop Entry]\nType=Application\nName={PACKAGE}\nExec={PACKAGE}\n")
+    write_contents(f"{template}/var/db/pkg", f"{CATEGORY}/{PACKAGE}-{VERSION}", [f"{eprefix}{path}" for path in installed])
+
+def build_fixture(workspace, args):
+    rng = random.Random(args.seed)
+    repos = f"{workspace}/repos"
+    profile = f"{repos}/gentoo/profiles/default/linux/amd64/23.0"
+    os.makedirs(profile, exist_ok=True)
+    os.makedirs(f"{repos}/gentoo/{CATEGORY}/{PACKAGE}", exist_ok=True)
+    os.makedirs(f"{repos}/gentoo/metadata/md5-cache/{CATEGORY}", exist_ok=True)
+    with open(f"{repos}/gentoo/{CATEGORY}/{PACKAGE}/{PACKAGE}-{VERSION}.ebuild", 'w') as f:
+        f.write('EAPI=8\nDESCRIPTION="flatpakify benchmark package"\nKEYWORDS="amd64"\n')
+    with open(f"{repos}/gentoo/metadata/md5-cache/{CATEGORY}/{PACKAGE}-{VERSION}", 'w') as f:
+        f.write("EAPI=8\nKEYWORDS=amd64\nRDEPEND=\n_eclasses_=\n")
+
+    config = f"{workspace}/portage"
+    os.makedirs(f"{config}/package.use", exist_ok=True)
+    with open(f"{config}/make.conf", 'w') as f:
+        f.write('CFLAGS="-O2 -pipe"\nCXXFLAGS="${CFLAGS}"\nCHOST="x86_64-pc-linux-gnu"\nUSE="X wayland"\n')
+    with open(f"{config}/package.use/bench", 'w') as f:
+        f.write(f"{CATEGORY}/{PACKAGE} -doc\n")
+    os.symlink(profile, f"{config}/make.profile")
+
+    # Host vardb: owners of the runtime libraries (they end up in
+    # package.provided) and filler packages for a realistic database size
+    vardb = f"{workspace}/vardb"
+    for index in range(args.host_packages):
+        if index < RUNTIME_LIBS:
+            write_contents(vardb, f"bench-libs/libruntime{index}-1.0", [f"/usr/lib64/libruntime{index}.so.1"])
+        else:
+            write_contents(vardb, f"bench-filler{index % 20}/filler{index}-1.0",
+                           [f"/usr/bin/filler{index}", f"/usr/lib64/libfiller{index}.so.1", f"/usr/share/filler{index}/data"])
+
+    runtime = f"{workspace}/home/.local/share/flatpak/runtime/{RUNTIME_ID}/{flatpak_arch()}/{RUNTIME_VERSION}"
+    runtime_lib_dir = f"{runtime}/benchcommit/files/lib/{platform.machine()}-linux-gnu"
+    os.makedirs(runtime_lib_dir, exist_ok=True)
+    os.symlink("benchcommit", f"{runtime}/active")
+    for index in range(RUNTIME_LIBS):
+        write_elf(f"{runtime_lib_dir}/libruntime{index}.so.1", ["libc.so.6"], f"libruntime{index}.so.1")
+
+    build_template(f"{workspace}/template", "/app", args, rng)
+    os.makedirs(f"{workspace}/work", exist_ok=True)
+
+def bench_environment(workspace):
+    env = dict(os.environ)
+    env.update({
+        "PATH": f"{FAKES_DIR}{os.pathsep}{env.get('PATH', '')}",
+        "HOME": f"{workspace}/home",
+        "XDG_CACHE_HOME": f"{workspace}/cache",
+        "FLATPAKIFY_REPOS_DIR": f"{workspace}/repos",
+        "FLATPAKIFY_VARDB_DIR": f"{workspace}/vardb",
+        "FLATPAKIFY_FLATPAK_DIR": f"{workspace}/system-flatpak",
+        "FLATPAKIFY_PORTAGE_CONFIG_DIR": f"{workspace}/portage",
+        "BENCH_TEMPLATE": f"{workspace}/template",
+        "BENCH_PACKAGE": f"{CATEGORY}/{PACKAGE}",
+    })
+    return env
+
+def run_flatpakify(workspace, scenario, extra_args):
+    # One build; returns (end-to-end seconds, the --report contents)
+    report = f"{workspace}/report.json"
+    command = [sys.executable, str(FLATPAKIFY), f"{CATEGORY}/{PACKAGE}", "--report", report] + extra_args
+    if scenario == "cold":
+        shutil.rmtree(f"{workspace}/cache", ignore_errors=True)
+    if scenario != "cached":
+        command += ["--clean", "--no-result-cache"]
+    start = time.monotonic()
+    result = subprocess.run(command, cwd=f"{workspace}/work", env=bench_environment(workspace),
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    elapsed = time.monotonic() - start
+    if result.returncode != 0:
+        print(result.stdout, file=sys.stderr)
+        print(f"Error: flatpakify failed in the {scenario} scenario", file=sys.stderr)
+        sys.exit(1)
+    with open(report, 'r') as f:
+        data = json.load(f)
+    if scenario == "cached" and data["status"] != "cached":
+        print(f"Warning: the cached scenario rebuilt instead of reusing the result ({data['status']})", file=sys.stderr)
+    return elapsed, data
+
+def summarize(runs):
+    # Median per step and field over the runs of one scenario, in first-seen step order
+    steps = []
+    for _, report in runs:
+        for step in report["steps"]:
+            if step["name"] not in steps:
+                steps.append(step["name"])
+    rows = []
+    for name in steps:
+        measured = [step for _, report in runs for step in report["steps"] if step["name"] == name and "wall_time" in step]
+        if measured:
+            rows.append([name] + [statistics.median(step[field] for step in measured) for field in REPORT_FIELDS])
+    rows.append(["end-to-end", statistics.median(elapsed for elapsed, _ in runs), None, None, None])
+    return rows
+
+def format_bytes(size):
+    for unit in ("B", "K", "M", "G"):
+        if size < 1024:
+            return f"{size:.0f}{unit}" if unit == "B" else f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}T"
+
+def print_table(results):
+    print(f"{'scenario':<10} {'step':<12} {'wall s':>9} {'cpu s':>9} {'child s':>9} {'written':>9}")
+    for scenario, rows in results.items():
+        for name, wall, cpu, child, written in rows:
+            cells = [f"{value:9.3f}" if value is not None else f"{'':>9}" for value in (wall, cpu, child)]
+            cells.append(f"{format_bytes(written):>9}" if written is not None else f"{'':>9}")
+            print(f"{scenario:<10} {name:<12} {' '.join(cells)}")
+
+def main():
+    global HOST_ELF
+    parser = argparse.ArgumentParser(
+        description='Benchmark flatpakify with stand-ins for emerge, flatpak-builder, flatpak and sudo',
+        epilog='Examples:\n'
+               '  python3 benchmarks/bench.py\n'
+               '  python3 benchmarks/bench.py --binaries 50 --libraries 400 --data-files 5000 -- --prune report\n'
+               '  python3 benchmarks/bench.py --json after.json | tee bench_output.txt',
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--binaries', type=int, default=20, help='ELF executables in the rootfs (default: 20)')
+    parser.add_argument('--libraries', type=int, default=60, help='ELF shared libraries in the rootfs (default: 60)')
+    parser.add_argument('--data-files', type=int, default=500, help='Data files in the rootfs (default: 500)')
+    parser.add_argument('--binary-size', type=int, default=256 * 1024, help='Bytes per executable (default: 256K)')
+    parser.add_argument('--library-size', type=int, default=512 * 1024, help='Bytes per library (default: 512K)')
+    parser.add_argument('--data-size', type=int, default=64 * 1024, help='Bytes per data file (default: 64K)')
+    parser.add_argument('--host-packages', type=int, default=300, help='Packages in the synthetic host vardb (default: 300)')
+    parser.add_argument('--runs', type=int, default=3, help='Runs per scenario, the median is reported (default: 3)')
+    parser.add_argument('--scenarios', default=",".join(SCENARIOS),
+                        help='cold (empty caches), warm (caches kept), cached (result cache hit); default: all')
+    parser.add_argument('--seed', type=int, default=1, help='Seed of the synthetic tree (default: 1)')
+    parser.add_argument('--workdir', help='Keep the synthetic tree and builds in this directory instead of a temporary one')
+    parser.add_argument('--json', help='Also write every raw --report per scenario to this file')
+    parser.add_argument('flatpakify_args', nargs='*', help='Extra flatpakify options after --, default: --bundle-libs')
+    args = parser.parse_args()
+
+    scenarios = [scenario for scenario in args.scenarios.split(",") if scenario]
+    for scenario in scenarios:
+        if scenario not in SCENARIOS:
+            parser.error(f"unknown scenario: {scenario} (choose from {', '.join(SCENARIOS)})")
+    extra_args = args.flatpakify_args or ["--bundle-libs"]
+
+    HOST_ELF = host_elf_header()
+    workspace = os.path.abspath(args.workdir) if args.workdir else tempfile.mkdtemp(prefix="flatpakify-bench-")
+    try:
+        if args.workdir and os.path.exists(workspace):
+            shutil.rmtree(workspace)
+        start = time.monotonic()
+        build_fixture(workspace, args)
+        print(f"Synthetic tree: {args.binaries} binaries, {args.libraries} libraries, {args.data_files} data files, "
+              f"{args.host_packages} host packages ({time.monotonic() - start:.1f}s to generate)")
+        print(f"flatpakify options: {' '.join(extra_args)}\n")
+
+        results = {}
+        raw = {}
+        for scenario in scenarios:
+            if scenario == "cached" and "warm" not in scenarios and "cold" not in scenarios:
+                run_flatpakify(workspace, "warm", extra_args)
+            runs = [run_flatpakify(workspace, scenario, extra_args) for _ in range(args.runs)]
+            results[scenario] = summarize(runs)
+            raw[scenario] = [{"elapsed": elapsed, "report": report} for elapsed, report in runs]
+        print_table(results)
+
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump({"arguments": sys.argv[1:], "results": raw}, f, indent=2)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workspace, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -2,114 +2,244 @@
 # Unknown author and license
 # Modified by Stefan Cristian B. <stefan.cristian@rogentos.ro>
 # Purpose of the script:
-# Get first-level runtime dependencies with their specific versions.
+# Get first-level (or, with --depth, transitive) runtime dependencies with their specific versions.
 # Returns a list of =category/package-version strings ready for emerge.
+# Can also be imported: get_packages_dependencies_with_versions() resolves
+# many atoms against a single portage initialization.
 
 import sys
+import argparse
 import portage
 from portage.dep import Atom
 from portage.exception import InvalidAtom, InvalidDependString
 
-def get_package_dependencies_with_versions(pkg_atom_str):
+def create_context():
+    # Everything that is expensive to build is created once and shared by all atoms
+    return {
+        "portdb": portage.db[portage.root]["porttree"].dbapi,
+        "vardb": portage.db[portage.root]["vartree"].dbapi,
+        "use": portage.settings["USE"].split(),
+        "all_installed": None,
+        "installed_matches": {},
+        "cpv_exists": {},
+        "direct": {},
+    }
+
+def _installed_matches(context, dep_atom):
+    key = str(dep_atom)
+    if key not in context["installed_matches"]:
+        if context["all_installed"] is None:
+            context["all_installed"] = set(context["vardb"].cpv_all())
+        matches = context["vardb"].match(dep_atom)
+        context["installed_matches"][key] = [cpv for cpv in matches if cpv in context["all_installed"]]
+    return context["installed_matches"][key]
+
+def _cpv_exists(context, cpv):
+    if cpv not in context["cpv_exists"]:
+        context["cpv_exists"][cpv] = bool(context["portdb"].cpv_exists(cpv))
+    return context["cpv_exists"][cpv]
+
+def _dependency_atoms(rdepend_raw, use):
+    if not rdepend_raw:
+        return []
+
+    deps = portage.dep.use_reduce(
+        rdepend_raw,
+        uselist=use,
+        masklist=[],
+        matchall=True,
+        excludeall=[],
+        is_src_uri=False,
+        token_class=Atom
+    )
+
+    dependency_atoms = []
+
+    def extract_atoms(dep_list):
+        for item in dep_list:
+            if isinstance(item, Atom):
+                dependency_atoms.append(item)
+            elif isinstance(item, list):
+                extract_atoms(item)
+
+    extract_atoms(deps)
+    return dependency_atoms
+
+def _direct_dependencies(context, cpv, installed):
+    # Memoized per cpv: the installed, ebuild-backed cpvs its RDEPEND resolves to
+    key = (cpv, installed)
+    if key in context["direct"]:
+        return context["direct"][key]
+
+    dbapi = context["vardb"] if installed else context["portdb"]
+    rdepend_raw = dbapi.aux_get(cpv, ["RDEPEND"])[0]
+
+    resolved_packages = []
+    orphaned_packages = []
+    seen = set()
+
+    for dep_atom in _dependency_atoms(rdepend_raw, context["use"]):
+        if str(dep_atom) in seen:
+            continue
+        seen.add(str(dep_atom))
+
+        installed_matches = _installed_matches(context, dep_atom)
+
+        if installed_matches:
+            best_installed = portage.best(installed_matches)
+
+            if not _cpv_exists(context, best_installed):
+                if best_installed not in orphaned_packages:
+                    orphaned_packages.append(best_installed)
+            elif best_installed not in resolved_packages:
+                resolved_packages.append(best_installed)
+
+    context["direct"][key] = (resolved_packages, orphaned_packages)
+    return context["direct"][key]
+
+def _resolve(context, pkg_atom_str, depth, provided):
+    portdb = context["portdb"]
+
     try:
-        portdb = portage.db[portage.root]["porttree"].dbapi
-        vardb = portage.db[portage.root]["vartree"].dbapi
-        
-        try:
-            pkg_atom = Atom(pkg_atom_str)
-        except InvalidAtom:
-            if "/" not in pkg_atom_str:
-                matches = portdb.xmatch("match-all", pkg_atom_str)
-                if matches:
-                    pkg_atom = Atom(matches[-1])
-                else:
-                    raise ValueError(f"Package not found: {pkg_atom_str}")
+        pkg_atom = Atom(pkg_atom_str)
+    except InvalidAtom:
+        if "/" not in pkg_atom_str:
+            matches = portdb.xmatch("match-all", pkg_atom_str)
+            if matches:
+                pkg_atom = Atom(matches[-1])
             else:
-                raise
-        
-        best_match = portdb.xmatch("bestmatch-visible", pkg_atom)
-        if not best_match:
-            raise ValueError(f"No visible package found for: {pkg_atom}")
-        
-        cpv = best_match
-        
-        rdepend_raw = portdb.aux_get(cpv, ["RDEPEND"])[0]
-        
-        if not rdepend_raw:
-            return []
-        
-        deps = portage.dep.use_reduce(
-            rdepend_raw,
-            uselist=portage.settings["USE"].split(),
-            masklist=[],
-            matchall=True,
-            excludeall=[],
-            is_src_uri=False,
-            token_class=Atom
-        )
-        
-        dependency_atoms = []
-        
-        def extract_atoms(dep_list):
-            for item in dep_list:
-                if isinstance(item, Atom):
-                    dependency_atoms.append(item)
-                elif isinstance(item, list):
-                    extract_atoms(item)
-        
-        extract_atoms(deps)
-        
-        resolved_packages = []
-        orphaned_packages = []
-        seen = set()
-        
-        all_installed = set(vardb.cpv_all())
-        
-        for dep_atom in dependency_atoms:
-            if str(dep_atom) in seen:
+                raise ValueError(f"Package not found: {pkg_atom_str}")
+        else:
+            raise
+
+    best_match = portdb.xmatch("bestmatch-visible", pkg_atom)
+    if not best_match:
+        raise ValueError(f"No visible package found for: {pkg_atom}")
+
+    root = (best_match, False)
+
+    # Breadth-first pass for the shallowest level of every reachable cpv, so a
+    # depth limit does not depend on the order nodes are discovered in
+    levels = {root: 0}
+    queue = [root]
+    orphaned_packages = []
+    while queue:
+        node = queue.pop(0)
+        if depth is not None and levels[node] >= depth:
+            continue
+        children, orphans = _direct_dependencies(context, *node)
+        orphaned_packages.extend(orphan for orphan in orphans
+                                 if orphan not in orphaned_packages and portage.cpv_getkey(orphan) not in provided)
+        for child in children:
+            child_node = (child, True)
+            if child_node in levels or portage.cpv_getkey(child) in provided:
                 continue
-            seen.add(str(dep_atom))
-            
-            installed_matches = vardb.match(dep_atom)
-            
-            installed_matches = [cpv for cpv in installed_matches if cpv in all_installed]
-            
-            if installed_matches:
-                best_installed = portage.best(installed_matches)
-                
-                if portdb.cpv_exists(best_installed):
-                    resolved_packages.append(f"={best_installed}")
-                else:
-                    orphaned_packages.append(best_installed)
-        
-        return resolved_packages, orphaned_packages
-        
-    except Exception as e:
-        raise RuntimeError(f"Error processing {pkg_atom_str}: {e}")
+            levels[child_node] = levels[node] + 1
+            queue.append(child_node)
+
+    # Post-order walk so every dependency is listed before its dependents
+    resolved_packages = []
+    emitted = set()
+
+    def visit(node):
+        if depth is None or levels[node] < depth:
+            for child in _direct_dependencies(context, *node)[0]:
+                child_node = (child, True)
+                if child_node in levels and child_node not in emitted:
+                    emitted.add(child_node)
+                    visit(child_node)
+                    resolved_packages.append(f"={child}")
+
+    emitted.add(root)
+    visit(root)
+
+    return resolved_packages, orphaned_packages
+
+def get_packages_dependencies_with_versions(pkg_atoms, context=None, depth=1, provided=()):
+    # Batch API: returns ({atom: (resolved, orphaned)}, {atom: error message}).
+    # depth=None walks RDEPEND transitively; cpvs whose category/package is in
+    # provided (e.g. shipped by the Flatpak runtime) are neither listed nor followed.
+    if context is None:
+        context = create_context()
+    provided = set(provided)
+
+    results = {}
+    errors = {}
+    for pkg_atom_str in pkg_atoms:
+        if pkg_atom_str in results or pkg_atom_str in errors:
+            continue
+        try:
+            results[pkg_atom_str] = _resolve(context, pkg_atom_str, depth, provided)
+        except Exception as e:
+            errors[pkg_atom_str] = f"Error processing {pkg_atom_str}: {e}"
+
+    return results, errors
+
+def get_package_dependencies_with_versions(pkg_atom_str):
+    results, errors = get_packages_dependencies_with_versions([pkg_atom_str])
+    if pkg_atom_str in errors:
+        raise RuntimeError(errors[pkg_atom_str])
+    return results[pkg_atom_str]
+
+def parse_depth(value):
+    if value == "all":
+        return None
+    try:
+        depth = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"depth must be a positive number or 'all', got: {value}")
+    if depth < 1:
+        raise argparse.ArgumentTypeError(f"depth must be a positive number or 'all', got: {value}")
+    return depth
+
+def read_provided(path):
+    provided = set()
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            split = portage.versions.catpkgsplit(line)
+            provided.add(f"{split[0]}/{split[1]}" if split else line)
+    return provided
 
 def main():
-    if len(sys.argv) != 2:
-        print("Usage: ./first-level-runtime.py <category/package>", file=sys.stderr)
-        print("Examples:", file=sys.stderr)
-        print("  ./first-level-runtime.py sys-apps/portage", file=sys.stderr)
-        sys.exit(1)
-    
-    pkg_atom = sys.argv[1]
-    
+    parser = argparse.ArgumentParser(
+        description='Print installed runtime dependencies as =category/package-version atoms',
+        epilog='Example: flatpakify-check-rdeps --depth all sys-apps/portage')
+    parser.add_argument('packages', nargs='+', help='One or more category/package atoms')
+    parser.add_argument('--depth', type=parse_depth, default=1, help='RDEPEND levels to follow, or "all" (default: 1)')
+    parser.add_argument('--provided', help='package.provided style file of packages to stop at')
+    args = parser.parse_args()
+
+    pkg_atoms = args.packages
+
     try:
-        resolved_deps, orphaned_deps = get_package_dependencies_with_versions(pkg_atom)
-        
+        provided = read_provided(args.provided) if args.provided else ()
+        results, errors = get_packages_dependencies_with_versions(pkg_atoms, depth=args.depth, provided=provided)
+
+        for message in errors.values():
+            print(f"Error: {message}", file=sys.stderr)
+        if errors:
+            sys.exit(1)
+
+        resolved_deps = []
+        orphaned_deps = []
+        for resolved, orphaned in results.values():
+            resolved_deps.extend(dep for dep in resolved if dep not in resolved_deps)
+            orphaned_deps.extend(orphan for orphan in orphaned if orphan not in orphaned_deps)
+
         if orphaned_deps:
             print("\nERROR: The following installed dependencies have no available ebuilds:", file=sys.stderr)
             for orphan in orphaned_deps:
                 print(f"  {orphan}", file=sys.stderr)
             print("The old package has been installed, but it has not been upgraded. Please upgrade your package, or maintain its ebuild in your overlay.\n", file=sys.stderr)
             sys.exit(1)
-        
+
         if not resolved_deps and not orphaned_deps:
             print("No installed runtime dependencies found.", file=sys.stderr)
             sys.exit(0)
-        
+
         for dep in resolved_deps:
             print(dep)
 
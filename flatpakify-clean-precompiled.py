@@ -1,58 +1,226 @@
 #!/usr/bin/env python3
-# Remove .gpkg.tar archives for the given package from ./binpkgs directory.
+# Remove .gpkg.tar archives for the given package(s) from ./binpkgs directory,
+# or evict least-recently-used binary packages with --max-size / --older-than.
 
 import sys
 import os
+import re
+import json
+import time
+import argparse
+import fnmatch
 import subprocess
 from pathlib import Path
 
-def remove_binary_packages(pkg_atom_str):
-    if "/" not in pkg_atom_str:
-        print(f"Error: Package must be in category/package format, got: {pkg_atom_str}", file=sys.stderr)
-        sys.exit(1)
-    
-    category, package = pkg_atom_str.split("/", 1)
-    pkgdir = os.environ.get("PKGDIR", "./binpkgs")
-    binpkgs_dir = Path(pkgdir)
-    
-    if not binpkgs_dir.exists():
-        print(f"Error: Binary packages directory not found: {binpkgs_dir}", file=sys.stderr)
-        sys.exit(1)
-    
-    package_dir = binpkgs_dir / category / package
-    
-    if not package_dir.exists():
-        print(f"No binary package directory found for {pkg_atom_str} at {package_dir}")
-        return 0
-    
-    pattern = f"{package}-*.gpkg.tar"
-    
-    print(f"Searching in {package_dir} for binary packages matching: {pattern}")
-    
+# Written by flatpakify after every build: {relative binpkg path: last use epoch}
+LASTUSE_FILE = ".flatpakify-lastuse.json"
+BINPKG_SUFFIXES = (".gpkg.tar", ".tbz2", ".xpak")
+SIZE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 7 * 86400}
+
+def get_binpkgs_dir():
+    return Path(os.environ.get("PKGDIR", "./binpkgs"))
+
+def parse_size(value):
+    match = re.match(r'^(\d+(?:\.\d+)?)\s*([KMGT]?)(?:i?B)?$', value.strip(), re.IGNORECASE)
+    if not match:
+        raise argparse.ArgumentTypeError(f"invalid size: {value} (examples: 500M, 50G)")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).upper()])
+
+def parse_duration(value):
+    match = re.match(r'^(\d+)\s*([smhdw]?)$', value.strip())
+    if not match:
+        raise argparse.ArgumentTypeError(f"invalid duration: {value} (examples: 12h, 30d, 2w)")
+    return int(match.group(1)) * DURATION_UNITS[match.group(2) or "d"]
+
+def format_size(size):
+    for unit in ("", "K", "M", "G"):
+        if size < 1024:
+            return f"{size:.1f}{unit}" if unit else f"{size}B"
+        size /= 1024
+    return f"{size:.1f}T"
+
+def load_last_use(binpkgs_dir):
+    try:
+        with open(binpkgs_dir / LASTUSE_FILE, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def scan_binary_packages(binpkgs_dir):
+    # One walk over the whole store; last use is the recorded flatpakify use,
+    # or the modification time for packages flatpakify never recorded (access
+    # times are useless here: noatime/relatime, or any backup reading the store)
+    last_use = load_last_use(binpkgs_dir)
+    packages = []
+    for root, dirs, files in os.walk(binpkgs_dir):
+        for name in files:
+            if not name.endswith(BINPKG_SUFFIXES):
+                continue
+            file_path = Path(root) / name
+            relative = file_path.relative_to(binpkgs_dir)
+            if len(relative.parts) == 3:
+                cp = f"{relative.parts[0]}/{relative.parts[1]}"
+            elif len(relative.parts) == 2:
+                cp = f"{relative.parts[0]}/{re.sub(r'-[0-9].*$', '', name)}"
+            else:
+                continue
+            try:
+                st = file_path.stat()
+            except OSError:
+                continue
+            packages.append({
+                "path": file_path,
+                "relative": str(relative),
+                "cp": cp,
+                "size": st.st_size,
+                "last_use": last_use.get(str(relative)) or st.st_mtime,
+            })
+    return packages
+
+def select_packages(packages, patterns, older_than, max_size):
+    cutoff = time.time() - older_than if older_than is not None else None
+    selected = []
+    remaining = []
+    for pkg in packages:
+        if any(fnmatch.fnmatchcase(pkg["cp"], pattern) for pattern in patterns):
+            selected.append(pkg)
+        elif cutoff is not None and pkg["last_use"] < cutoff:
+            selected.append(pkg)
+        else:
+            remaining.append(pkg)
+
+    if max_size is not None:
+        remaining.sort(key=lambda pkg: pkg["last_use"])
+        total = sum(pkg["size"] for pkg in remaining)
+        for pkg in remaining:
+            if total <= max_size:
+                break
+            selected.append(pkg)
+            total -= pkg["size"]
+
+    return selected
+
+def remove_binary_packages(selected):
     removed_files = []
-    for file_path in package_dir.glob(pattern):
+    freed = 0
+    for pkg in selected:
         try:
-            print(f"Removing: {file_path}")
-            file_path.unlink()
-            removed_files.append(str(file_path))
+            print(f"Removing: {pkg['path']}")
+            pkg["path"].unlink()
+            removed_files.append(pkg["relative"])
+            freed += pkg["size"]
         except Exception as e:
-            print(f"Failed to remove {file_path}: {e}", file=sys.stderr)
-    
-    if not removed_files:
-        print(f"No binary packages found for {pkg_atom_str}")
-    else:
-        print(f"Removed {len(removed_files)} binary package(s)")
-    
-    return len(removed_files)
+            print(f"Failed to remove {pkg['path']}: {e}", file=sys.stderr)
+
+    for directory in {pkg["path"].parent for pkg in selected}:
+        try:
+            directory.rmdir()
+        except OSError:
+            pass
+
+    if removed_files:
+        print(f"Removed {len(removed_files)} binary package(s), freed {format_size(freed)}")
+    return removed_files
+
+def forget_last_use(binpkgs_dir, removed_files):
+    last_use = load_last_use(binpkgs_dir)
+    if not any(relative in last_use for relative in removed_files):
+        return
+    for relative in removed_files:
+        last_use.pop(relative, None)
+    # Replace the file atomically, like the Packages index, so a flatpakify
+    # run reading it concurrently never sees it half-written
+    lastuse_path = binpkgs_dir / LASTUSE_FILE
+    tmp_path = lastuse_path.with_name(f".{LASTUSE_FILE}.{os.getpid()}")
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(last_use, f)
+        os.chmod(tmp_path, lastuse_path.stat().st_mode & 0o7777)
+        os.replace(tmp_path, lastuse_path)
+    except OSError:
+        try:
+            tmp_path.unlink()
+        except OSError:
+            pass
+
+def update_packages_index(binpkgs_dir, removed_files):
+    # Drop the stanzas of the removed files from PKGDIR/Packages in place.
+    # Returns False when the index does not match the store, so the caller
+    # can fall back to a full emaint rebuild.
+    index_path = binpkgs_dir / "Packages"
+    try:
+        with open(index_path, 'r') as f:
+            content = f.read()
+    except OSError:
+        return False
+
+    blocks = [block for block in content.split("\n\n") if block.strip()]
+    if not blocks:
+        return False
+    header, stanzas = blocks[0], blocks[1:]
+
+    header_fields = dict(line.split(": ", 1) for line in header.splitlines() if ": " in line)
+    if header_fields.get("PACKAGES", str(len(stanzas))) != str(len(stanzas)):
+        return False
+
+    removed = set(removed_files)
+    kept = []
+    dropped = set()
+    for stanza in stanzas:
+        fields = dict(line.split(": ", 1) for line in stanza.splitlines() if ": " in line)
+        if "CPV" not in fields:
+            return False
+        paths = [fields["PATH"]] if "PATH" in fields else [f"{fields['CPV']}{suffix}" for suffix in BINPKG_SUFFIXES]
+        matched = removed.intersection(paths)
+        if matched:
+            dropped.update(matched)
+        else:
+            kept.append(stanza)
+
+    if dropped != removed:
+        return False
+
+    header_lines = []
+    for line in header.splitlines():
+        if line.startswith("PACKAGES: "):
+            line = f"PACKAGES: {len(kept)}"
+        elif line.startswith("TIMESTAMP: "):
+            line = f"TIMESTAMP: {int(time.time())}"
+        header_lines.append(line)
+
+    tmp_path = index_path.with_name(f".Packages.{os.getpid()}")
+    try:
+        with open(tmp_path, 'w') as f:
+            f.write("\n\n".join(["\n".join(header_lines)] + kept) + "\n\n")
+        st = index_path.stat()
+        # Keep the owner too (e.g. portage:portage when run as root), so
+        # emerge can still update the index; only root may give files away
+        try:
+            os.chown(tmp_path, st.st_uid, st.st_gid)
+        except PermissionError:
+            pass
+        os.chmod(tmp_path, st.st_mode & 0o7777)
+        os.replace(tmp_path, index_path)
+    except OSError as e:
+        print(f"Failed to rewrite {index_path}: {e}", file=sys.stderr)
+        try:
+            tmp_path.unlink()
+        except OSError:
+            pass
+        return False
+
+    print(f"Updated {index_path}: removed {len(dropped)} entr{'y' if len(dropped) == 1 else 'ies'}, {len(kept)} remaining")
+    return True
 
 def fix_binhost():
     print("Running emaint binhost --fix...")
-    
+
     env = os.environ.copy()
     env["EPREFIX"] = "/app"
     pkgdir = os.environ.get("PKGDIR", "./binpkgs")
     env["PKGDIR"] = pkgdir
-    
+
     try:
         result = subprocess.run(
             ["emaint", "binhost", "--fix"],
@@ -61,19 +229,19 @@ def fix_binhost():
             capture_output=True,
             text=True
         )
-        
+
         if result.stdout:
             print(result.stdout)
         if result.stderr:
             print(result.stderr, file=sys.stderr)
-            
+
         if result.returncode == 0:
             print("emaint binhost --fix completed successfully")
         else:
             print(f"emaint binhost --fix failed with exit code {result.returncode}", file=sys.stderr)
-            
+
         return result.returncode
-        
+
     except FileNotFoundError:
         print("Error: emaint command not found", file=sys.stderr)
         return 1
@@ -82,22 +250,63 @@ def fix_binhost():
         return 1
 
 def main():
-    if len(sys.argv) != 2:
-        print("Usage: ./flatpakify-clean-precompiled.py <category/package>", file=sys.stderr)
-        print("Examples:", file=sys.stderr)
-        print("  ./flatpakify-clean-precompiled.py games-strategy/seven-kingdoms", file=sys.stderr)
-        print("  ./flatpakify-clean-precompiled.py sys-apps/portage", file=sys.stderr)
+    parser = argparse.ArgumentParser(
+        description='Remove precompiled binary packages from PKGDIR (default: ./binpkgs)',
+        epilog='Examples:\n'
+               '  flatpakify-clean-precompiled games-strategy/seven-kingdoms\n'
+               '  flatpakify-clean-precompiled "dev-libs/*" sys-apps/portage\n'
+               '  flatpakify-clean-precompiled --max-size 50G --older-than 30d',
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('packages', nargs='*', help='category/package atoms or globs to remove')
+    parser.add_argument('--max-size', type=parse_size, help='Evict least recently used packages until the store fits, i.e. 50G')
+    parser.add_argument('--older-than', type=parse_duration, help='Evict packages not used for this long, i.e. 30d, 12h, 2w')
+    parser.add_argument('--dry-run', action='store_true', help='Only list what would be removed')
+    args = parser.parse_args()
+
+    if not args.packages and args.max_size is None and args.older_than is None:
+        parser.print_help(sys.stderr)
         sys.exit(1)
-    
-    pkg_atom = sys.argv[1]
-    
+
+    for pkg_atom in args.packages:
+        if "/" not in pkg_atom:
+            print(f"Error: Package must be in category/package format, got: {pkg_atom}", file=sys.stderr)
+            sys.exit(1)
+
+    binpkgs_dir = get_binpkgs_dir()
+    if not binpkgs_dir.exists():
+        print(f"Error: Binary packages directory not found: {binpkgs_dir}", file=sys.stderr)
+        sys.exit(1)
+
     try:
-        removed_count = remove_binary_packages(pkg_atom)
-        
+        packages = scan_binary_packages(binpkgs_dir)
+        total = sum(pkg["size"] for pkg in packages)
+        print(f"Found {len(packages)} binary package(s) using {format_size(total)} in {binpkgs_dir}")
+
+        selected = select_packages(packages, args.packages, args.older_than, args.max_size)
+
+        if not selected:
+            print("No binary packages to remove")
+            sys.exit(0)
+
+        if args.dry_run:
+            for pkg in selected:
+                print(f"Would remove: {pkg['path']} ({format_size(pkg['size'])})")
+            print(f"Would free {format_size(sum(pkg['size'] for pkg in selected))}")
+            sys.exit(0)
+
+        removed_files = remove_binary_packages(selected)
+        if not removed_files:
+            sys.exit(1)
+        forget_last_use(binpkgs_dir, removed_files)
+
+        if update_packages_index(binpkgs_dir, removed_files):
+            sys.exit(0)
+
+        print("Packages index is missing or out of sync with the store, rebuilding it")
         fix_result = fix_binhost()
-        
+
         sys.exit(fix_result)
-    
+
     except Exception as e:
         print(f"Error: {e}", file=sys.stderr)
         sys.exit(1)
@@ -6,10 +6,25 @@ import subprocess
 import argparse
 import shutil
 import hashlib
+import shlex
+import time
+import math
+import importlib.machinery
+import importlib.util
+import platform
+import json
+import glob
+import mmap
+import struct
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 import re
 import tarfile
 import tempfile
+import atexit
+import resource
+import stat
 
 PKGS = []
 APP_ID = ""
@@ -29,11 +44,281 @@ CLEAN_AFTER = True
 VERBOSE = False
 USE_KDE_RUNTIME = False
 WITH_DEPS = False
+DEPS_DEPTH = 1
 FLATPAK_RDEPS = []
 BUILD_AS_RUNTIME = False
 BUILD_AS_DATA = False
 CUSTOM_PREFIX = ""
 EMERGE_REBUILD_BINARY = False
+EMERGE_JOBS = None
+MERGE_PHASES = False
+BINPKG_STORE = ""
+STAGE_MODE = "dir"
+EXPORT_TARBALL = False
+COMPRESSION = "auto"
+STATE_DIR = ""
+SHARED_REPO = ""
+RESULT_CACHE = True
+RESUME = False
+CHECKPOINT_DIR = ""
+FRESH_ROOTFS_PATHS = []
+PHASE_CHAIN = ""
+PRUNE = ""
+PRIVILEGED_HELPER = None
+HELPER_USAGE = {"cpu": 0.0, "write_bytes": 0, "maxrss": 0}
+REPORT_PATH = ""
+BUILD_REPORT = {"status": None, "steps": []}
+CURRENT_STEP = None
+ENTRY_POINTS = []
+PLUGIN_DIRS = []
+
+# Used for package.provided when org.freedesktop.Platform is not installed locally
+FREEDESKTOP_PROVIDED_PACKAGES = [
+    "app-accessibility/at-spi2-core",
+    "app-alternatives/awk",
+    "app-alternatives/bc",
+    "app-alternatives/bzip2",
+    "app-alternatives/cpio",
+    "app-alternatives/gawk",
+    "app-alternatives/gzip",
+    "app-alternatives/lex",
+    "app-alternatives/ninja",
+    "app-alternatives/python3",
+    "app-alternatives/sh",
+    "app-alternatives/tar",
+    "app-alternatives/yacc",
+    "app-arch/brotli",
+    "app-arch/bzip2",
+    "app-arch/gcab",
+    "app-arch/lz4",
+    "app-arch/tar",
+    "app-crypt/libmd",
+    "app-crypt/p11-kit",
+    "app-editors/nano",
+    "app-emulation/vmware-workstation",
+    "app-misc/c_rehash",
+    "app-misc/pax-utils",
+    "app-portage/elt-patches",
+    "app-shells/bash",
+    "app-text/hunspell",
+    "app-text/mythes",
+    "dev-build/autotools-utils",
+    "dev-build/libtool",
+    "dev-build/pkgconf",
+    "dev-db/sqlite",
+    "dev-lang/duktape",
+    "dev-lang/orc",
+    "dev-lang/perl",
+    "dev-lang/python",
+    "dev-lang/python-exec",
+    "dev-lang/tcl",
+    "dev-libs/elfutils",
+    "dev-libs/expat",
+    "dev-libs/fribidi",
+    "dev-libs/gmp",
+    "dev-libs/gobject-introspection",
+    "dev-libs/hyphen",
+    "dev-libs/icu",
+    "dev-libs/json-glib",
+    "dev-libs/libffi",
+    "dev-libs/libgcrypt",
+    "dev-libs/libgudev",
+    "dev-libs/libksba",
+    "dev-libs/libtasn1",
+    "dev-libs/libusb",
+    "dev-libs/libxml2",
+    "dev-libs/libxmlb",
+    "dev-libs/libyaml",
+    "dev-libs/nspr",
+    "dev-libs/nss",
+    "dev-libs/openssl",
+    "dev-libs/wayland",
+    "dev-python/installer",
+    "dev-python/markupsafe",
+    "dev-python/pycairo",
+    "dev-python/pygobject",
+    "dev-qt/qtmultimedia",
+    "dev-util/mingw64-toolchain",
+    "dev-util/nvidia-cuda-toolkit",
+    "gnome-base/gsettings-desktop-schemas",
+    "gui-libs/gtk",
+    "gui-libs/libdecor",
+    "kde-apps/kio-extras",
+    "media-gfx/graphite2",
+    "media-gfx/imagemagick",
+    "media-libs/alsa-lib",
+    "media-libs/dav1d",
+    "media-libs/freetype",
+    "media-libs/giflib",
+    "media-libs/graphene",
+    "media-libs/gst-plugins-bad",
+    "media-libs/gst-plugins-base",
+    "media-libs/gst-plugins-good",
+    "media-libs/gst-plugins-ugly",
+    "media-libs/gstreamer",
+    "media-libs/ladspa-sdk",
+    "media-libs/lcms",
+    "media-libs/libepoxy",
+    "media-libs/libexif",
+    "media-libs/libglvnd",
+    "media-libs/libjpeg-turbo",
+    "media-libs/libjxl",
+    "media-libs/libpulse",
+    "media-libs/libsdl2",
+    "media-libs/libsamplerate",
+    "media-libs/libsndfile",
+    "media-libs/libv4l",
+    "media-libs/libva",
+    "media-libs/libvorbis",
+    "media-libs/mesa",
+    "media-libs/openal",
+    "media-libs/openjpeg",
+    "media-libs/opus",
+    "media-libs/shaderc",
+    "media-libs/speex",
+    "media-libs/speexdsp",
+    "media-libs/webrtc-audio-processing",
+    "media-plugins/alsa-plugins",
+    "media-plugins/gst-plugins-flac",
+    "media-plugins/gst-plugins-libav",
+    "media-plugins/gst-plugins-mpg123",
+    "media-plugins/gst-plugins-opus",
+    "media-sound/lame",
+    "media-sound/mpg123-base",
+    "media-video/ffmpeg",
+    "media-video/pipewire",
+    "net-dns/libidn2",
+    "net-libs/glib-networking",
+    "net-libs/gnutls",
+    "net-libs/libproxy",
+    "net-libs/libpsl",
+    "net-libs/libsoup",
+    "net-misc/curl",
+    "net-misc/rsync",
+    "net-print/cups",
+    "net-wireless/bluez",
+    "perl-core/Carp",
+    "perl-core/Exporter",
+    "perl-core/File-Path",
+    "perl-core/File-Spec",
+    "perl-core/Getopt-Long",
+    "perl-core/Scalar-List-Utils",
+    "perl-core/Text-ParseWords",
+    "sci-libs/fftw",
+    "sys-apps/acl",
+    "sys-apps/attr",
+    "sys-apps/baselayout",
+    "sys-apps/busybox",
+    "sys-apps/coreutils",
+    "sys-apps/debianutils",
+    "sys-apps/diffutils",
+    "sys-apps/dbus",
+    "sys-apps/eselect",
+    "sys-apps/file",
+    "sys-apps/findutils",
+    "sys-apps/gawk",
+    "sys-apps/grep",
+    "sys-apps/help2man",
+    "sys-apps/hwdata",
+    "sys-apps/install-xattr",
+    "sys-apps/kmod",
+    "sys-apps/less",
+    "sys-apps/net-tools",
+    "sys-apps/pciutils",
+    "sys-apps/portage",
+    "sys-apps/sandbox",
+    "sys-apps/sed",
+    "sys-apps/systemd",
+    "sys-apps/texinfo",
+    "sys-apps/util-linux",
+    "sys-apps/which",
+    "sys-apps/xz-utils",
+    "sys-auth/passwdqc",
+    "sys-devel/autoconf",
+    "sys-devel/automake",
+    "sys-devel/binutils",
+    "sys-devel/binutils-config",
+    "sys-devel/bison",
+    "sys-devel/flex",
+    "sys-devel/gcc",
+    "sys-devel/gcc-config",
+    "sys-devel/gettext",
+    "sys-devel/gnuconfig",
+    "sys-devel/make",
+    "sys-devel/patch",
+    "sys-fs/e2fsprogs",
+    "sys-fs/eudev",
+    "sys-kernel/linux-headers",
+    "sys-libs/cracklib",
+    "sys-libs/gdbm",
+    "sys-libs/glibc",
+    "sys-libs/libcap",
+    "sys-libs/libunwind",
+    "sys-libs/libxcrypt",
+    "sys-libs/ncurses",
+    "sys-libs/pam",
+    "sys-libs/readline",
+    "sys-libs/zlib",
+    "sys-libs/zlib-ng",
+    "sys-process/procps",
+    "virtual/editor",
+    "virtual/libc",
+    "virtual/libcrypt",
+    "virtual/libelf",
+    "virtual/libiconv",
+    "virtual/libintl",
+    "virtual/libudev",
+    "virtual/libusb",
+    "virtual/os-headers",
+    "virtual/pager",
+    "virtual/pam",
+    "virtual/perl-Carp",
+    "virtual/perl-Exporter",
+    "virtual/perl-File-Path",
+    "virtual/perl-File-Spec",
+    "virtual/perl-Getopt-Long",
+    "virtual/perl-Scalar-List-Utils",
+    "virtual/perl-Text-ParseWords",
+    "virtual/pkgconfig",
+    "virtual/udev",
+    "www-client/firefox-bin",
+    "x11-libs/cairo",
+    "x11-libs/gdk-pixbuf",
+    "x11-libs/gtk+",
+    "x11-libs/libICE",
+    "x11-libs/libnotify",
+    "x11-libs/libpciaccess",
+    "x11-libs/libSM",
+    "x11-libs/libvdpau",
+    "x11-libs/libX11",
+    "x11-libs/libXau",
+    "x11-libs/libxcb",
+    "x11-libs/libXcomposite",
+    "x11-libs/libXcursor",
+    "x11-libs/libXdamage",
+    "x11-libs/libXdmcp",
+    "x11-libs/libXext",
+    "x11-libs/libXfixes",
+    "x11-libs/libXft",
+    "x11-libs/libXi",
+    "x11-libs/libXinerama",
+    "x11-libs/libxkbfile",
+    "x11-libs/libXpm",
+    "x11-libs/libXrandr",
+    "x11-libs/libXrender",
+    "x11-libs/libXScrnSaver",
+    "x11-libs/libxshmfence",
+    "x11-libs/libXt",
+    "x11-libs/libXtst",
+    "x11-libs/libXv",
+    "x11-libs/libXxf86vm",
+    "x11-libs/xcb-util",
+    "x11-libs/xcb-util-cursor",
+    "x11-libs/xcb-util-image",
+    "x11-libs/xcb-util-keysyms",
+    "x11-libs/xcb-util-renderutil",
+    "x11-libs/xcb-util-wm"
+]
 
 def need(command):
     if shutil.which(command) is None:
@@ -47,12 +332,1519 @@ def error(message):
     print(f"ERROR: {message}", file=sys.stderr)
     sys.exit(1)
 
+# Host locations; the environment overrides let benchmarks/ run on a synthetic tree
+REPOS_DIR = os.environ.get("FLATPAKIFY_REPOS_DIR", "/var/db/repos")
+VARDB_DIR = os.environ.get("FLATPAKIFY_VARDB_DIR", "/var/db/pkg")
+FLATPAK_SYSTEM_DIR = os.environ.get("FLATPAKIFY_FLATPAK_DIR", "/var/lib/flatpak")
+PORTAGE_CONFIG_DIR = os.environ.get("FLATPAKIFY_PORTAGE_CONFIG_DIR", "/etc/portage")
+BINPKG_LASTUSE_FILE = ".flatpakify-lastuse.json"
+BINPKG_KEY_VARS = ["CHOST", "CFLAGS", "CXXFLAGS", "LDFLAGS", "USE", "ARCH"]
+EBUILD_CACHE_NAME = "ebuild-index.json"
+EBUILD_CACHE_VERSION = 2
+ELF_CACHE_NAME = "elf-cache.json"
+ELF_CACHE_VERSION = 2
+ELF_CACHE_MAX_AGE = 30 * 86400
+RESULTS_CACHE_DIR = "results"
+PORTAGE_STATE_DIRS = ["etc/portage", "var/db"]
+PHASES = ["config", "deps", "emerge", "cleanup", "libs", "prune", "staging", "manifest", "builder", "bundle", "install"]
+# Phases that build the rootfs; from cleanup on they change it in place
+# (relocation, bundled library copies, pruning), so rerunning one of them
+# after it or a later one already ran needs a fresh rootfs
+ROOTFS_PHASES = PHASES[:PHASES.index("prune") + 1]
+IN_PLACE_PHASES = ROOTFS_PHASES[ROOTFS_PHASES.index("cleanup"):]
+ROOTFS_MODIFIED_FILE = "rootfs-modified"
+PORTAGE_CONFIG_FILES = [
+    ("make.conf", "file"),
+    ("package.use", "dir"),
+    ("package.accept_keywords", "dir"),
+    ("package.mask", "dir"),
+    ("package.unmask", "dir"),
+    ("repos.conf", "dir"),
+    ("binrepos.conf", "dir"),
+    ("env", "dir"),
+]
+
+PV_PATTERN = re.compile(r'^(?P<pn>.+?)-(?P<pv>\d+(?:\.\d+)*[a-z]?(?:_(?:alpha|beta|pre|rc|p)\d*)*(?:-r\d+)?)$')
+PV_PARTS_PATTERN = re.compile(r'^(\d+(?:\.\d+)*)([a-z]?)((?:_(?:alpha|beta|pre|rc|p)\d*)*)(?:-r(\d+))?$')
+PV_SUFFIX_ORDER = {"alpha": 0, "beta": 1, "pre": 2, "rc": 3, "p": 5}
+ATOM_OPERATORS = ("<=", ">=", "<", ">", "=", "~")
+# Gentoo keyword of the machine architecture, the stable keyword emerge accepts by default
+KEYWORD_ARCHES = {"x86_64": "amd64", "aarch64": "arm64", "i686": "x86", "i386": "x86",
+                  "armv7l": "arm", "ppc64le": "ppc64", "riscv64": "riscv"}
+
+ELF_MAGIC = b"\x7fELF"
+SHT_DYNAMIC = 6
+SHT_GNU_VERDEF = 0x6ffffffd
+SHT_GNU_VERNEED = 0x6ffffffe
+VER_FLG_BASE = 0x1
+DT_NEEDED = 1
+DT_SONAME = 14
+DT_RPATH = 15
+DT_RUNPATH = 29
+HOST_LIB_DIRS = ["/lib64", "/usr/lib64", "/lib", "/usr/lib"]
+# zstd settings for tar -I; "none" stores the archive uncompressed
+COMPRESSION_COMMANDS = {"fast": "zstd -3 -T0", "max": "zstd -19 --long=27 -T0"}
+# Formats zstd cannot shrink any further (media, archives, packed game data)
+COMPRESSED_SUFFIXES = (".ogg", ".oga", ".opus", ".mp3", ".flac", ".m4a", ".png", ".jpg", ".jpeg", ".webp",
+                       ".avif", ".jxl", ".mp4", ".mkv", ".webm", ".avi", ".gz", ".tgz", ".xz", ".bz2", ".zst",
+                       ".lz4", ".zip", ".7z", ".rar", ".jar", ".pk3", ".pk4", ".pak", ".vpk")
+# Never reached through DT_NEEDED, always prunable
+STATIC_ARCHIVE_SUFFIXES = (".a", ".la")
+# Never bundled from the host: they only work together with its dynamic loader
+GLIBC_SONAME_PREFIXES = ("ld-", "libc.", "libm.", "libpthread.", "libdl.", "librt.", "libresolv.", "libnss_")
+
+KDE_DEP_PATTERNS = ['dev-qt/', 'kde-frameworks/', 'kde-plasma/', 'kde-apps/',
+                    'qtcore', 'qtgui', 'qtwidgets', 'kf5', 'kf6']
+KDE_ECLASSES = ("ecm", "kde.org", "qmake-utils", "qt5-build", "qt6-build")
+
+def split_pf(pf):
+    # Split a Gentoo PF (name-version[-rN]) into (PN, PV), "" when unversioned
+    match = PV_PATTERN.match(pf)
+    if not match:
+        return pf, ""
+    return match.group('pn'), match.group('pv')
+
+def version_key(pv):
+    match = PV_PARTS_PATTERN.match(pv)
+    if not match:
+        return ((), "", (), 0)
+    numbers = tuple(int(n) for n in match.group(1).split('.'))
+    suffixes = []
+    for suffix in match.group(3).split('_')[1:]:
+        name = suffix.rstrip('0123456789')
+        num = suffix[len(name):]
+        suffixes.append((PV_SUFFIX_ORDER[name], int(num) if num else 0))
+    # A missing suffix sorts between _rc and _p
+    suffixes.append((4, 0))
+    return (numbers, match.group(2), tuple(suffixes), int(match.group(4) or 0))
+
+def atom_to_cp(atom):
+    # Reduce an atom to (category/package, operator, version); the operator is
+    # one of ATOM_OPERATORS, "=*" for a =cat/pkg-1* glob, or "" when unversioned
+    atom = atom.lstrip("!").split("[")[0].split(":")[0]
+    operator = next((op for op in ATOM_OPERATORS if atom.startswith(op)), "")
+    atom = atom[len(operator):]
+    if "/" not in atom:
+        return "", "", ""
+    category, name = atom.split("/", 1)
+    version = ""
+    if operator:
+        if operator == "=" and name.endswith("*"):
+            operator = "=*"
+        name, version = split_pf(name.rstrip("*"))
+        if not version:
+            operator = ""
+    return f"{category}/{name}", operator, version
+
+def version_matches(pv, operator, version):
+    # Whether pv satisfies the version part of an atom, as emerge would read it
+    if not operator:
+        return True
+    if operator == "=*":
+        # Prefix match on version component boundaries: 1* matches 1.2 but not 10
+        return pv.startswith(version) and not pv[len(version):len(version) + 1].isdigit()
+    key, wanted = version_key(pv), version_key(version)
+    if operator == "~":
+        return key[:3] == wanted[:3]
+    return {"=": key == wanted, "<": key < wanted, "<=": key <= wanted,
+            ">": key > wanted, ">=": key >= wanted}[operator]
+
+def read_config_lines(name):
+    # Non-comment lines of a portage config file or directory of files
+    path = f"{PORTAGE_CONFIG_DIR}/{name}"
+    if os.path.isdir(path):
+        files = sorted(os.path.join(root, f) for root, _, names in os.walk(path, followlinks=True) for f in names)
+    else:
+        files = [path]
+    lines = []
+    for file_path in files:
+        try:
+            with open(file_path, 'r', errors='replace') as f:
+                lines.extend(line.split('#', 1)[0].strip() for line in f)
+        except OSError:
+            continue
+    return [line for line in lines if line]
+
+def accepted_keywords(cp):
+    # Keywords emerge accepts for cp: the stable ARCH keyword, then
+    # ACCEPT_KEYWORDS (environment or make.conf) and package.accept_keywords
+    # entries for cp applied incrementally; a bare entry means ~ARCH
+    arch = KEYWORD_ARCHES.get(platform.machine(), platform.machine())
+    tokens = os.environ.get("ACCEPT_KEYWORDS", "").split()
+    if not tokens:
+        for line in read_config_lines("make.conf"):
+            match = re.match(r'^(?:export\s+)?ACCEPT_KEYWORDS=(["\']?)(.*)\1$', line)
+            if match:
+                tokens = [token for token in match.group(2).split() if not token.startswith("$")]
+    for line in read_config_lines("package.accept_keywords"):
+        fields = line.split()
+        if atom_to_cp(fields[0])[0] == cp:
+            tokens += fields[1:] or [f"~{arch}"]
+    accepted = {arch}
+    for token in tokens:
+        if token == "-*":
+            accepted.clear()
+        elif token.startswith("-"):
+            accepted.discard(token[1:])
+        else:
+            accepted.add(token)
+    return accepted
+
+def keywords_visible(keywords, accepted):
+    # "**" also accepts ebuilds without any keywords (live ebuilds)
+    if "**" in accepted:
+        return True
+    for keyword in keywords.split():
+        if keyword in accepted:
+            return True
+        if keyword.startswith("~") and "~*" in accepted:
+            return True
+        if not keyword.startswith(("~", "-")) and "*" in accepted:
+            return True
+    return False
+
+def list_repos():
+    repos = []
+    if os.path.isdir(f"{REPOS_DIR}/gentoo"):
+        repos.append(f"{REPOS_DIR}/gentoo")
+    try:
+        for entry in sorted(os.listdir(REPOS_DIR)):
+            repo_dir = f"{REPOS_DIR}/{entry}"
+            if repo_dir not in repos and os.path.isdir(repo_dir):
+                repos.append(repo_dir)
+    except OSError:
+        pass
+    return repos
+
+def read_md5_cache(repo_dir, cpv):
+    metadata = {}
+    try:
+        with open(f"{repo_dir}/metadata/md5-cache/{cpv}", 'r') as f:
+            for line in f:
+                key, sep, value = line.rstrip('\n').partition('=')
+                if sep:
+                    metadata[key] = value
+    except OSError:
+        return None
+    return metadata
+
+def classify_ebuild(content, metadata):
+    # Prefer the md5-cache (exact eclass and dependency data), fall back to
+    # plain text matching over the ebuild itself for uncached overlays
+    if metadata is not None:
+        eclasses = [eclass for eclass in metadata.get("_eclasses_", "").split('\t')[::2] if eclass]
+        eclasses = eclasses or metadata.get("INHERIT", "").split()
+        deps = " ".join(metadata.get(key, "") for key in ("DEPEND", "RDEPEND", "BDEPEND")).lower()
+        cmake_meson = any(eclass in ("cmake", "meson") for eclass in eclasses)
+        kde = any(eclass in KDE_ECLASSES for eclass in eclasses) or any(pattern in deps for pattern in KDE_DEP_PATTERNS)
+    else:
+        cmake_meson = 'cmake' in content or 'meson' in content
+        kde = any(pattern in content for pattern in KDE_DEP_PATTERNS)
+
+    flatpak_rdeps = []
+    match = re.search(r'FLATPAK_RDEPS=\(([^)]*)\)', content)
+    if match:
+        flatpak_rdeps = match.group(1).replace('"', '').split()
+
+    return {"cmake_meson": cmake_meson, "kde": kde, "flatpak_rdeps": flatpak_rdeps}
+
+def find_best_ebuild(cp, operator, version, repos):
+    category, name = cp.split("/", 1)
+    candidates = []
+    for repo_dir in repos:
+        pkg_dir = f"{repo_dir}/{cp}"
+        try:
+            entries = os.listdir(pkg_dir)
+        except OSError:
+            continue
+        for entry in entries:
+            if not entry.endswith(".ebuild"):
+                continue
+            pn, pv = split_pf(entry[:-len(".ebuild")])
+            if pn != name or not pv or not version_matches(pv, operator, version):
+                continue
+            candidates.append((repo_dir, f"{pkg_dir}/{entry}", pv))
+
+    if not candidates:
+        return None
+
+    accepted = accepted_keywords(cp)
+    visible = []
+    for repo_dir, ebuild_path, pv in candidates:
+        metadata = read_md5_cache(repo_dir, f"{category}/{name}-{pv}")
+        if metadata is not None:
+            is_visible = keywords_visible(metadata.get("KEYWORDS", ""), accepted)
+        else:
+            is_visible = "9999" not in pv
+        visible.append((is_visible, version_key(pv), repo_dir != f"{REPOS_DIR}/gentoo", repo_dir, ebuild_path, pv, metadata))
+
+    # Highest version visible under ACCEPT_KEYWORDS wins, overlays win ties against ::gentoo
+    best = max(visible, key=lambda item: item[:3])
+    _, _, _, repo_dir, ebuild_path, pv, metadata = best
+    return {"cpv": f"{category}/{name}-{pv}", "repo": repo_dir, "ebuild": ebuild_path, "metadata": metadata}
+
+def build_vardb_index(vardb_dir=None):
+    # One pass over the installed package database: {category: {PN: [PF, ...]}}
+    vardb_dir = vardb_dir or VARDB_DIR
+    index = {}
+    try:
+        categories = os.listdir(vardb_dir)
+    except OSError:
+        return index
+    for category in categories:
+        try:
+            entries = os.listdir(f"{vardb_dir}/{category}")
+        except OSError:
+            continue
+        packages = index.setdefault(category, {})
+        for entry in entries:
+            if entry.startswith(("-MERGING-", ".")):
+                continue
+            pn, pv = split_pf(entry)
+            if pv:
+                packages.setdefault(pn, []).append(entry)
+    return index
+
+def flatpak_arch():
+    machine = platform.machine()
+    return {"x86_64": "x86_64", "amd64": "x86_64", "aarch64": "aarch64", "arm64": "aarch64",
+            "i386": "i386", "i686": "i386", "armv7l": "arm"}.get(machine, machine)
+
+def find_runtime(runtime_id, version):
+    # Locate an installed runtime, user installation first: (files dir, commit)
+    installations = [os.path.join(os.path.expanduser("~"), ".local/share/flatpak"), FLATPAK_SYSTEM_DIR]
+    for installation in installations:
+        active = f"{installation}/runtime/{runtime_id}/{flatpak_arch()}/{version}/active"
+        if os.path.isdir(f"{active}/files"):
+            try:
+                commit = os.path.basename(os.readlink(active))
+            except OSError:
+                commit = str(path_mtime(f"{active}/files"))
+            return f"{active}/files", commit
+    return None, None
+
+def is_soname(name):
+    return name.startswith("lib") and (name.endswith(".so") or ".so." in name)
+
+def scan_runtime_contents(platform_files, sdk_files):
+    # Sonames and binaries come from the Platform, pkg-config files from the Sdk
+    contents = {"lib": set(), "pc": set(), "bin": set()}
+    for root, dirs, files in os.walk(f"{platform_files}/lib"):
+        for name in files:
+            if is_soname(name):
+                contents["lib"].add(name)
+    for bin_dir in ("bin", "sbin"):
+        try:
+            contents["bin"].update(os.listdir(f"{platform_files}/{bin_dir}"))
+        except OSError:
+            pass
+    if sdk_files:
+        for pc_root in (f"{sdk_files}/lib", f"{sdk_files}/share/pkgconfig"):
+            for root, dirs, files in os.walk(pc_root):
+                if root.endswith("pkgconfig"):
+                    contents["pc"].update(name for name in files if name.endswith(".pc"))
+    return {kind: sorted(names) for kind, names in contents.items()}
+
+def contents_key(path):
+    directory, name = os.path.split(path)
+    if name.endswith(".pc") and directory.endswith("pkgconfig"):
+        return f"pc:{name}"
+    if is_soname(name) and "/lib" in directory:
+        return f"lib:{name}"
+    if directory.endswith(("/bin", "/sbin")):
+        return f"bin:{name}"
+    return None
+
+def map_vardb_contents(vardb_index, vardb_dir=None):
+    # {"lib:libfoo.so.1" | "pc:foo.pc" | "bin:foo": {"cat/pn", ...}} from every CONTENTS file
+    vardb_dir = vardb_dir or VARDB_DIR
+    owners = {}
+    for category, packages in vardb_index.items():
+        for pn, pfs in packages.items():
+            for pf in pfs:
+                try:
+                    with open(f"{vardb_dir}/{category}/{pf}/CONTENTS", 'r', errors='replace') as f:
+                        for line in f:
+                            kind, _, rest = line.rstrip('\n').partition(' ')
+                            if kind == "obj":
+                                path = rest.rsplit(' ', 2)[0]
+                            elif kind == "sym":
+                                path = rest.split(' -> ', 1)[0]
+                            else:
+                                continue
+                            key = contents_key(path)
+                            if key:
+                                owners.setdefault(key, set()).add(f"{category}/{pn}")
+                except OSError:
+                    continue
+    return owners
+
+def vardb_signature(vardb_index, vardb_dir=None):
+    vardb_dir = vardb_dir or VARDB_DIR
+    digest = hashlib.sha1()
+    for category in sorted(vardb_index):
+        digest.update(f"{category}:{path_mtime(f'{vardb_dir}/{category}')}\n".encode())
+    return digest.hexdigest()
+
+def runtime_provided_packages(runtime_id, version, vardb_index):
+    # Gentoo packages whose files the installed runtime already ships, cached per
+    # runtime commit (contents) and vardb state (ownership mapping)
+    platform_files, commit = find_runtime(runtime_id, version)
+    if not platform_files:
+        return []
+    sdk_files, sdk_commit = find_runtime(runtime_id.replace('Platform', 'Sdk'), version)
+
+    cache_name = f"runtime-{runtime_id}-{flatpak_arch()}-{version}.json"
+    cache = load_json_cache(cache_name)
+    stamp = [commit, sdk_commit]
+    vardb_stamp = vardb_signature(vardb_index)
+
+    if cache.get("commit") == stamp and cache.get("vardb") == vardb_stamp:
+        return cache["packages"]
+
+    if cache.get("commit") == stamp:
+        contents = cache["contents"]
+    else:
+        log(f"Indexing installed runtime {runtime_id}//{version} ({commit[:12]})...")
+        contents = scan_runtime_contents(platform_files, sdk_files)
+
+    owners = map_vardb_contents(vardb_index)
+    provided = set()
+    for kind, names in contents.items():
+        for name in names:
+            provided.update(owners.get(f"{kind}:{name}", ()))
+    packages = sorted(provided)
+
+    save_json_cache(cache_name, {"commit": stamp, "contents": contents, "vardb": vardb_stamp, "packages": packages})
+    return packages
+
+def parse_elf_dynamic(data):
+    # ELF class/machine, the dynamic section strings and the GNU symbol
+    # versions needed (per soname) and defined, from the section headers
+    elf_class, elf_data = data[4], data[5]
+    if elf_class not in (1, 2) or elf_data not in (1, 2):
+        return None
+    endian = "<" if elf_data == 1 else ">"
+    machine, = struct.unpack_from(endian + "H", data, 18)
+    if elf_class == 2:
+        shoff, = struct.unpack_from(endian + "Q", data, 40)
+        shentsize, shnum = struct.unpack_from(endian + "HH", data, 58)
+        section_format, dynamic_format = endian + "IIQQQQIIQQ", endian + "qQ"
+    else:
+        shoff, = struct.unpack_from(endian + "I", data, 32)
+        shentsize, shnum = struct.unpack_from(endian + "HH", data, 46)
+        section_format, dynamic_format = endian + "IIIIIIIIII", endian + "iI"
+
+    info = {"class": elf_class, "machine": machine, "soname": None, "needed": [], "rpath": [], "runpath": [],
+            "verneed": {}, "verdef": []}
+    sections = [struct.unpack_from(section_format, data, shoff + i * shentsize) for i in range(shnum)]
+
+    def string_at(strtab, offset):
+        start = strtab + offset
+        return data[start:data.find(b"\0", start)].decode(errors="replace")
+
+    for _, sh_type, _, _, offset, size, link, sh_info, _, _ in sections:
+        if sh_type not in (SHT_DYNAMIC, SHT_GNU_VERNEED, SHT_GNU_VERDEF) or link >= len(sections):
+            continue
+        strtab = sections[link][4]
+        if sh_type == SHT_DYNAMIC:
+            entry_size = struct.calcsize(dynamic_format)
+            for entry in range(offset, offset + size - entry_size + 1, entry_size):
+                tag, value = struct.unpack_from(dynamic_format, data, entry)
+                if tag == 0:
+                    break
+                if tag == DT_NEEDED:
+                    info["needed"].append(string_at(strtab, value))
+                elif tag == DT_SONAME:
+                    info["soname"] = string_at(strtab, value)
+                elif tag in (DT_RPATH, DT_RUNPATH):
+                    info["rpath" if tag == DT_RPATH else "runpath"].extend(d for d in string_at(strtab, value).split(":") if d)
+        elif sh_type == SHT_GNU_VERNEED:
+            # Elf_Verneed {vn_version, vn_cnt, vn_file, vn_aux, vn_next} -> Elf_Vernaux {hash, flags, other, name, next}
+            entry = offset
+            for _ in range(sh_info):
+                _, count, file_name, aux, next_entry = struct.unpack_from(endian + "HHIII", data, entry)
+                versions = info["verneed"].setdefault(string_at(strtab, file_name), [])
+                aux_entry = entry + aux
+                for _ in range(count):
+                    _, _, _, name, next_aux = struct.unpack_from(endian + "IHHII", data, aux_entry)
+                    versions.append(string_at(strtab, name))
+                    aux_entry += next_aux
+                if not next_entry:
+                    break
+                entry += next_entry
+        else:
+            # Elf_Verdef {vd_version, vd_flags, vd_ndx, vd_cnt, vd_hash, vd_aux, vd_next} -> Elf_Verdaux {name, next}
+            entry = offset
+            for _ in range(sh_info):
+                _, flags, _, _, _, aux, next_entry = struct.unpack_from(endian + "HHHHIII", data, entry)
+                if not flags & VER_FLG_BASE:
+                    name, = struct.unpack_from(endian + "I", data, entry + aux)
+                    info["verdef"].append(string_at(strtab, name))
+                if not next_entry:
+                    break
+                entry += next_entry
+    return info
+
+def read_elf_dynamic(path):
+    # mmap'd and parsed in-process, nothing is loaded or executed; None for non-ELF files
+    try:
+        with open(path, 'rb') as f:
+            if f.read(4) != ELF_MAGIC or os.fstat(f.fileno()).st_size < 64:
+                return None
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return parse_elf_dynamic(data)
+    except (OSError, ValueError, struct.error):
+        return None
+
+def read_elf_batch(paths):
+    # read_elf_dynamic() for many files: unchanged files (same size and mtime)
+    # come from the on-disk cache, the rest is parsed by a process per core.
+    # Returns ({path: info}, cache hits).
+    cache = load_json_cache(ELF_CACHE_NAME)
+    entries = cache.get("files", {}) if cache.get("version") == ELF_CACHE_VERSION else {}
+    now = int(time.time())
+
+    results = {}
+    stale = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            results[path] = None
+            continue
+        signature = [st.st_size, st.st_mtime_ns]
+        cached = entries.get(path)
+        if cached and cached[0] == signature:
+            results[path] = cached[1]
+            cached[2] = now
+        else:
+            stale.append((path, signature))
+
+    workers = min(os.cpu_count() or 1, len(stale) // 64 + 1)
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork")) as pool:
+            infos = list(pool.map(read_elf_dynamic, [path for path, _ in stale], chunksize=64))
+    else:
+        infos = [read_elf_dynamic(path) for path, _ in stale]
+    for (path, signature), info in zip(stale, infos):
+        results[path] = info
+        entries[path] = [signature, info, now]
+
+    entries = {path: entry for path, entry in entries.items() if now - entry[2] < ELF_CACHE_MAX_AGE}
+    save_json_cache(ELF_CACHE_NAME, {"version": ELF_CACHE_VERSION, "files": entries})
+    return results, len(paths) - len(stale)
+
+def ld_so_conf_dirs(path="/etc/ld.so.conf"):
+    dirs = []
+    try:
+        with open(path, 'r') as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return dirs
+    for line in lines:
+        line = line.split("#", 1)[0].strip()
+        if line.startswith("include "):
+            pattern = line.split(None, 1)[1]
+            for included in sorted(glob.glob(os.path.join(os.path.dirname(path), pattern))):
+                dirs.extend(ld_so_conf_dirs(included))
+        elif line:
+            dirs.append(line)
+    return dirs
+
+def library_search_layers(rootfs, eprefix, runtime_files):
+    # (name, root, dirs) in lookup order: the rootfs being bundled, the Flatpak
+    # runtime (its files dir is mounted as /usr) and finally the host
+    rootfs_dirs = [f"{eprefix}{lib_dir}" for lib_dir in HOST_LIB_DIRS] + (HOST_LIB_DIRS if eprefix else [])
+    layers = [("rootfs", rootfs, rootfs_dirs)]
+    if runtime_files:
+        runtime_dirs = [f"/lib/{os.path.basename(d)}" for d in sorted(glob.glob(f"{runtime_files}/lib/*-linux-gnu*"))]
+        layers.append(("runtime", runtime_files, runtime_dirs + ["/lib", "/lib64"]))
+    host_dirs = []
+    for lib_dir in ld_so_conf_dirs() + HOST_LIB_DIRS:
+        if lib_dir not in host_dirs:
+            host_dirs.append(lib_dir)
+    layers.append(("host", "", host_dirs))
+    return layers
+
+def resolve_library(soname, elf, origin, root, layers, elf_cache, outdated=None):
+    # Where the dynamic loader would find soname for elf: RPATH (only without
+    # RUNPATH), RUNPATH, then the search layers; candidates must match the
+    # ELF class and machine of the object that needs them. A runtime library
+    # that lacks a symbol version elf needs from it is passed over (and noted
+    # in outdated) so a newer copy further down the search path is used.
+    candidates = []
+    for rpath in elf["runpath"] or elf["rpath"]:
+        rpath = rpath.replace("${ORIGIN}", origin).replace("$ORIGIN", origin)
+        candidates.append((None, rpath if rpath.startswith(origin) else f"{root}{rpath}"))
+    for layer, layer_root, dirs in layers:
+        candidates.extend((layer, f"{layer_root}{lib_dir}") for lib_dir in dirs)
+
+    for layer, lib_dir in candidates:
+        path = f"{lib_dir}/{soname}"
+        if path not in elf_cache:
+            elf_cache[path] = read_elf_dynamic(path) if os.path.isfile(path) else None
+        candidate = elf_cache[path]
+        if candidate and candidate["class"] == elf["class"] and candidate["machine"] == elf["machine"]:
+            if layer == "runtime" and not set(elf["verneed"].get(soname, ())) <= set(candidate["verdef"]):
+                if outdated is not None:
+                    outdated.add(soname)
+                continue
+            if layer is None:
+                layer = next((name for name, layer_root, _ in layers if layer_root and path.startswith(f"{layer_root}/")), "host")
+            return layer, path
+    return None, None
+
+def host_symlink_index(lib_dir, indexes):
+    # {real file: [symlink names]} for a host library directory, built once per
+    # directory and shared by every library bundled from it
+    if lib_dir not in indexes:
+        index = {}
+        try:
+            with os.scandir(lib_dir) as entries:
+                for entry in entries:
+                    if entry.is_symlink():
+                        index.setdefault(os.path.realpath(entry.path), []).append(entry.name)
+        except OSError:
+            pass
+        indexes[lib_dir] = index
+    return indexes[lib_dir]
+
+def scan_library_dependencies(files, layers, elf_cache=None):
+    # Follow DT_NEEDED transitively from the given rootfs files. Returns the
+    # host libraries to bundle (in discovery order), the sonames the runtime
+    # provides, the sonames the runtime has in a version too old for at least
+    # one consumer (they may be provided for others too, and the host copy is
+    # bundled either way), and the sonames that could not be resolved at all
+    roots = {name: layer_root for name, layer_root, _ in layers}
+    elf_cache = dict(elf_cache or {})
+    queue = [(path, "rootfs") for path in files]
+    seen = set(files)
+    host_libs = []
+    provided = set()
+    outdated = set()
+    missing = set()
+    while queue:
+        path, layer = queue.pop()
+        if path not in elf_cache:
+            elf_cache[path] = read_elf_dynamic(path)
+        elf = elf_cache[path]
+        if not elf:
+            continue
+        for soname in elf["needed"]:
+            found_layer, found = resolve_library(soname, elf, os.path.dirname(path), roots[layer], layers, elf_cache, outdated)
+            if found is None:
+                missing.add(soname)
+            elif found_layer == "runtime":
+                provided.add(soname)
+            elif found not in seen:
+                seen.add(found)
+                queue.append((found, found_layer))
+                if found_layer == "host":
+                    host_libs.append(found)
+    return host_libs, provided, outdated, missing
+
+def reachable_rootfs_files(roots, layers, elf_cache):
+    # Real paths of every rootfs object the DT_NEEDED graph reaches from roots
+    rootfs = layers[0][1]
+    elf_cache = dict(elf_cache)
+    reached = set()
+    queue = [os.path.realpath(path) for path in roots]
+    while queue:
+        path = queue.pop()
+        if path in reached:
+            continue
+        reached.add(path)
+        if path not in elf_cache:
+            elf_cache[path] = read_elf_dynamic(path)
+        elf = elf_cache[path]
+        if not elf:
+            continue
+        for soname in elf["needed"]:
+            found_layer, found = resolve_library(soname, elf, os.path.dirname(path), rootfs, layers, elf_cache)
+            if found_layer == "rootfs":
+                queue.append(os.path.realpath(found))
+    return reached
+
+def find_unreachable_files(app_root, roots, layers):
+    # ELF executables and libraries under app_root that nothing reaches from
+    # roots, static archives, and the symlinks pointing at any of them.
+    # A shared object that no ELF file in the tree lists in DT_NEEDED is most
+    # likely a plugin loaded with dlopen() (GTK/Qt plugins, GIO modules,
+    # Python extensions), so it is returned separately as kept and walked
+    # like a root, keeping the libraries it links against. Being unreferenced
+    # does not depend on reachability, so a single walk is already complete.
+    candidates = []
+    archives = []
+    symlinks = []
+    for root, dirs, names in os.walk(app_root):
+        for name in names:
+            path = os.path.join(root, name)
+            if os.path.islink(path):
+                symlinks.append(path)
+            elif name.endswith(STATIC_ARCHIVE_SUFFIXES):
+                archives.append(path)
+            elif os.access(path, os.X_OK) or ".so" in name:
+                candidates.append(path)
+    elf_info, _ = read_elf_batch(candidates)
+    referenced = {soname for elf in elf_info.values() if elf for soname in elf["needed"]}
+    root_paths = {os.path.realpath(path) for path in roots}
+    kept = [path for path in candidates
+            if elf_info.get(path) and ".so" in os.path.basename(path) and os.path.realpath(path) not in root_paths
+            and elf_info[path]["soname"] not in referenced and os.path.basename(path) not in referenced]
+    reached = reachable_rootfs_files(list(roots) + kept, layers, elf_info)
+    unreachable = [path for path in candidates if elf_info.get(path) and os.path.realpath(path) not in reached]
+    unreachable += archives
+    pruned = set(unreachable)
+    unreachable += [link for link in symlinks if os.path.realpath(link) in pruned]
+    return unreachable, kept
+
+def rootfs_file_owners(vardb_dirs):
+    # {installed path: "cat/pn"} from the CONTENTS files of the rootfs vardb
+    owners = {}
+    for vardb_dir in vardb_dirs:
+        for category, packages in build_vardb_index(vardb_dir).items():
+            for pn, pfs in packages.items():
+                for pf in pfs:
+                    try:
+                        with open(f"{vardb_dir}/{category}/{pf}/CONTENTS", 'r', errors='replace') as f:
+                            for line in f:
+                                kind, _, rest = line.rstrip('\n').partition(' ')
+                                if kind == "obj":
+                                    owners[rest.rsplit(' ', 2)[0]] = f"{category}/{pn}"
+                                elif kind == "sym":
+                                    owners[rest.split(' -> ', 1)[0]] = f"{category}/{pn}"
+                    except OSError:
+                        continue
+    return owners
+
+def sandbox_path(rootfs, eprefix, path):
+    # --entry-point/--plugin-dir take sandbox paths (/app/...) or paths relative to the prefix
+    return f"{rootfs}{path}" if path.startswith("/") else f"{rootfs}{eprefix}/{path}"
+
+def new_size_usage(rootfs, prefixes, owners):
+    # Exact byte counts of a rootfs per top-level directory (the first level
+    # below the longest matching prefix) and per owning package, filled in by
+    # the walks the build makes anyway instead of separate du runs
+    return {"rootfs": rootfs, "prefixes": sorted(set(prefixes), key=len, reverse=True), "owners": owners,
+            "seen": set(), "total": 0, "compressed": 0, "files": 0, "dirs": {}, "packages": {}}
+
+def counted_size(usage, path):
+    # Size of a regular file not yet in usage, else None (hard links count once)
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return None
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    if st.st_nlink > 1:
+        if (st.st_dev, st.st_ino) in usage["seen"]:
+            return None
+        usage["seen"].add((st.st_dev, st.st_ino))
+    return st.st_size
+
+def account_file(usage, path, size, count=1, owner=None):
+    # Adds one file to usage; count=-1 takes a removed one out again
+    relative = path[len(usage["rootfs"]):]
+    top = "/" + relative.lstrip("/").split("/", 1)[0] if relative.count("/") > 1 else "/"
+    for prefix in usage["prefixes"]:
+        if prefix and relative.startswith(prefix + "/"):
+            rest = relative[len(prefix) + 1:]
+            top = f"{prefix}/{rest.split('/', 1)[0]}" if "/" in rest else prefix
+            break
+    package = owner or usage["owners"].get(relative, "(not owned by any package)")
+    for table, key in ((usage["dirs"], top), (usage["packages"], package)):
+        files, size_sum = table.get(key, (0, 0))
+        table[key] = (files + count, size_sum + count * size)
+    usage["files"] += count
+    usage["total"] += count * size
+    if path.lower().endswith(COMPRESSED_SUFFIXES):
+        usage["compressed"] += count * size
+
+def walk_rootfs(top, usage):
+    # os.walk that accounts every regular file into usage on the way
+    for root, dirs, names in os.walk(top):
+        for name in names:
+            path = os.path.join(root, name)
+            size = counted_size(usage, path)
+            if size is not None:
+                account_file(usage, path, size)
+        yield root, dirs, names
+
+def log_size_usage(usage, title):
+    log(f"{title}: {format_size(usage['total'])} in {usage['files']} file(s)")
+    for label, table, limit in (("directory", usage["dirs"], None), ("package", usage["packages"], None if VERBOSE else 5)):
+        ranked = sorted(table.items(), key=lambda item: -item[1][1])
+        log(f"  by {label}: " + ", ".join(f"{key} {format_size(size)}" for key, (_, size) in ranked[:limit]) +
+            (f" and {len(ranked) - limit} more" if limit and len(ranked) > limit else ""))
+
+def size_usage_summary(usage):
+    return {
+        "total": usage["total"],
+        "compressed": usage["compressed"],
+        "files": usage["files"],
+        "dirs": {key: {"files": files, "bytes": size} for key, (files, size) in usage["dirs"].items()},
+        "packages": {key: {"files": files, "bytes": size} for key, (files, size) in usage["packages"].items()},
+    }
+
+def filter_data_rootfs(rootfs, remove_dirs, before, after):
+    # One bottom-up walk for a data-only build: accounts every file into
+    # before and the ones outside remove_dirs into after, and returns the
+    # directories that the removal leaves empty, deepest first
+    removed = tuple(f"{path}/" for path in remove_dirs)
+    gone = set()
+    empty_dirs = []
+    for root, dirs, names in os.walk(rootfs, topdown=False):
+        removed_here = f"{root}/".startswith(removed)
+        kept = False
+        for name in names:
+            path = os.path.join(root, name)
+            size = counted_size(before, path)
+            if size is not None:
+                account_file(before, path, size)
+            if removed_here or f"{path}/" in removed:
+                continue
+            kept = True
+            if size is not None:
+                account_file(after, path, size)
+        kept = kept or any(os.path.join(root, name) not in gone for name in dirs)
+        if removed_here or (not kept and root != rootfs):
+            gone.add(root)
+            if not removed_here:
+                empty_dirs.append(root)
+    return empty_dirs
+
+def compression_command(setting, distributable, total, compressed):
+    # The tar -I compressor for the rootfs archive, or None to store it. auto
+    # stores an intermediate archive that is mostly compressed media already
+    # (it is unpacked right away) and uses long-distance matching for an
+    # exported one, at a low level when there is little left to gain.
+    if setting != "auto":
+        return COMPRESSION_COMMANDS.get(setting)
+    mostly_compressed = compressed * 2 >= total
+    if distributable:
+        return "zstd -3 --long=27 -T0" if mostly_compressed else COMPRESSION_COMMANDS["max"]
+    return None if mostly_compressed else "zstd -1 -T0"
+
+def format_size(size):
+    for unit in ("", "K", "M", "G"):
+        if size < 1024:
+            return f"{size:.1f}{unit}" if unit else f"{size}B"
+        size /= 1024
+    return f"{size:.1f}T"
+
+def available_memory():
+    try:
+        with open("/proc/meminfo", 'r') as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+def emerge_parallelism(jobs):
+    # Returns (emerge --jobs, --load-average, compiler slots) for --jobs auto|N
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+    if jobs == "auto":
+        # Budget roughly 2 GiB per compiler process, then split the slots
+        # between a handful of concurrent emerge jobs
+        make_slots = cpus
+        memory = available_memory()
+        if memory:
+            make_slots = max(1, min(cpus, memory // (2 * 1024 ** 3)))
+        emerge_jobs = max(1, math.isqrt(make_slots))
+    else:
+        make_slots = cpus
+        emerge_jobs = jobs
+    return emerge_jobs, cpus, make_slots
+
+def apply_parallelism(emerge_env, parallelism, emerge_opts):
+    # With --nodeps emerge has no dependency graph to schedule jobs by, so the
+    # packages are merged one at a time in the given (dependencies first)
+    # order and every compiler slot goes to MAKEOPTS instead
+    if not parallelism:
+        return
+    jobs, load_average, make_slots = parallelism
+    if "--nodeps" in emerge_opts.split():
+        if jobs > 1:
+            log(f"--nodeps merges one package at a time, using --jobs={jobs} for MAKEOPTS only")
+        jobs = 1
+    makeopts = f"-j{max(1, make_slots // jobs)} -l{load_average}"
+    log(f"Parallel emerge: --jobs={jobs} --load-average={load_average} MAKEOPTS=\"{makeopts}\"")
+    emerge_env["EMERGE_DEFAULT_OPTS"] = f"{emerge_env['EMERGE_DEFAULT_OPTS']} --jobs={jobs} --load-average={load_average}"
+    emerge_env["MAKEOPTS"] = makeopts
+
+def portage_build_settings(eprefix, profile_path):
+    # The effective settings that decide what emerge produces
+    settings = {"EPREFIX": eprefix, "PROFILE": profile_path}
+    try:
+        result = subprocess.run(["portageq", "envvar", "-v"] + BINPKG_KEY_VARS, capture_output=True, text=True)
+        for line in result.stdout.splitlines():
+            name, sep, value = line.partition('=')
+            if sep:
+                settings[name] = " ".join(shlex.split(value))
+    except OSError:
+        pass
+    if not any(name in settings for name in BINPKG_KEY_VARS):
+        log("Warning: portageq not available, using make.conf as the build settings")
+        try:
+            with open(f"{PORTAGE_CONFIG_DIR}/make.conf", 'r') as f:
+                settings["make.conf"] = f.read()
+        except OSError:
+            pass
+    return settings
+
+def binpkg_store_dir(store, key_inputs):
+    # Binary packages are only interchangeable between builds that agree on
+    # these settings; per-package USE is still checked by --binpkg-respect-use
+    key = hashlib.sha256(json.dumps(key_inputs, sort_keys=True).encode()).hexdigest()[:16]
+    store_dir = os.path.join(store, key)
+    os.makedirs(store_dir, exist_ok=True)
+    if not os.path.exists(os.path.join(store_dir, "store.json")):
+        with open(os.path.join(store_dir, "store.json"), 'w') as f:
+            json.dump(key_inputs, f, indent=2, sort_keys=True)
+    return store_dir
+
+def merged_since(rootfs, eprefix, since):
+    # cat/PF of every package merged into the rootfs vardb after the given time
+    merged = set()
+    for vardb_dir in {f"{rootfs}/var/db/pkg", f"{rootfs}{eprefix}/var/db/pkg"}:
+        for category, packages in build_vardb_index(vardb_dir).items():
+            for pfs in packages.values():
+                for pf in pfs:
+                    mtime = path_mtime(f"{vardb_dir}/{category}/{pf}")
+                    if mtime is not None and mtime >= since:
+                        merged.add(f"{category}/{pf}")
+    return sorted(merged)
+
+def binpkg_files(pkgdir, cpv):
+    category, pf = cpv.split("/", 1)
+    pn, _ = split_pf(pf)
+    files = [path for path in Path(pkgdir, category, pn).glob(f"{pf}-[0-9]*.gpkg.tar")]
+    for suffix in (".gpkg.tar", ".tbz2", ".xpak"):
+        if os.path.isfile(f"{pkgdir}/{cpv}{suffix}"):
+            files.append(Path(f"{pkgdir}/{cpv}{suffix}"))
+    return files
+
+def write_binpkg_json(path, data):
+    # Atomic write of flatpakify's bookkeeping next to the binary packages.
+    # PKGDIR is normally created by sudo emerge and owned by root, so a
+    # permission error retries through the privileged helper.
+    content = json.dumps(data)
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=f".{os.path.basename(path)}.")
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+        return
+    except PermissionError:
+        pass
+    except OSError as e:
+        log(f"Warning: Could not write {path}: {e}")
+        return
+    tmp_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.{os.getpid()}")
+    results = privileged([["write", tmp_path, content], ["move", tmp_path, path]], check=False)
+    failure = next((result for result in results if result), None)
+    if failure:
+        privileged([["remove", tmp_path]], check=False)
+        log(f"Warning: Could not write {path}: {failure}")
+
+def record_binpkg_use(pkgdir, merged):
+    # Last-use times read by flatpakify-clean-precompiled --max-size/--older-than.
+    # Nothing to record when no binary package was used or PKGDIR does not exist
+    if not merged or not os.path.isdir(pkgdir):
+        return
+    used = [path for cpv in merged for path in binpkg_files(pkgdir, cpv)]
+    if not used:
+        return
+    lastuse_path = os.path.join(pkgdir, BINPKG_LASTUSE_FILE)
+    try:
+        with open(lastuse_path, 'r') as f:
+            last_use = json.load(f)
+    except (OSError, ValueError):
+        last_use = {}
+    now = int(time.time())
+    for path in used:
+        last_use[os.path.relpath(path, pkgdir)] = now
+    write_binpkg_json(lastuse_path, last_use)
+
+def report_binpkg_store(store_dir, merged, since):
+    built = [cpv for cpv in merged if any((path_mtime(str(path)) or 0) >= since for path in binpkg_files(store_dir, cpv))]
+    reused = len(merged) - len(built)
+
+    stats_path = os.path.join(store_dir, "stats.json")
+    try:
+        with open(stats_path, 'r') as f:
+            stats = json.load(f)
+    except (OSError, ValueError):
+        stats = {"lookups": 0, "hits": 0}
+    stats["lookups"] += len(merged)
+    stats["hits"] += reused
+    write_binpkg_json(stats_path, stats)
+
+    if merged:
+        log(f"Binary package store: reused {reused}/{len(merged)} package(s) ({100 * reused // len(merged)}%), built {len(built)}")
+    if built and VERBOSE:
+        log(f"  Built from source: {' '.join(built)}")
+    if stats["lookups"]:
+        log(f"Binary package store lifetime hit rate: {stats['hits']}/{stats['lookups']} ({100 * stats['hits'] // stats['lookups']}%) - {store_dir}")
+
+def load_rdeps_module():
+    # Import flatpakify-check-rdeps in-process so portage is initialized once per build
+    candidates = [
+        shutil.which("flatpakify-check-rdeps"),
+        os.path.join(os.path.dirname(os.path.realpath(__file__)), "flatpakify-check-rdeps.py"),
+        "./flatpakify-check-rdeps.py",
+    ]
+    for path in candidates:
+        if not path or not os.path.isfile(path):
+            continue
+        try:
+            loader = importlib.machinery.SourceFileLoader("flatpakify_check_rdeps", path)
+            module = importlib.util.module_from_spec(importlib.util.spec_from_loader(loader.name, loader))
+            loader.exec_module(module)
+            return module
+        except Exception as e:
+            log(f"Warning: Could not load {path}: {e}")
+            return None
+    log("Warning: Neither flatpakify-check-rdeps and ./flatpakify-check-rdeps.py found, building without dependencies")
+    return None
+
+def cache_dir():
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    path = os.path.join(base, "flatpakify")
+    try:
+        os.makedirs(path, exist_ok=True)
+    except OSError:
+        return None
+    return path
+
+def load_json_cache(name):
+    directory = cache_dir()
+    if not directory:
+        return {}
+    try:
+        with open(os.path.join(directory, name), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_json_cache(name, data):
+    directory = cache_dir()
+    if not directory:
+        return
+    path = os.path.join(directory, name)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=f".{os.path.basename(path)}.")
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        log(f"Warning: Could not write cache {name}: {e}")
+
+def path_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+def repo_sync_stamp(repo_dir):
+    for stamp in ("metadata/timestamp.chk", "metadata/timestamp.commit", ".git/FETCH_HEAD", ".git/HEAD"):
+        mtime = path_mtime(f"{repo_dir}/{stamp}")
+        if mtime is not None:
+            return mtime
+    return path_mtime(repo_dir)
+
+def ebuild_signature(cp, entry, repo_stamps):
+    # Cheap fingerprint: the package dir in every repo, each repo's sync stamp,
+    # the accepted keywords and the chosen ebuild plus its md5-cache entry
+    signature = [[repo_dir, stamp, path_mtime(f"{repo_dir}/{cp}")] for repo_dir, stamp in repo_stamps]
+    signature.append(sorted(accepted_keywords(cp)))
+    if entry:
+        signature.append([entry["ebuild"], path_mtime(entry["ebuild"]),
+                          path_mtime(f"{entry['repo']}/metadata/md5-cache/{entry['cpv']}")])
+    return signature
+
+def index_ebuild(pkg, repos):
+    cp, operator, version = atom_to_cp(pkg)
+    best = find_best_ebuild(cp, operator, version, repos) if cp else None
+    if best is None:
+        return None
+    try:
+        with open(best["ebuild"], 'r') as f:
+            content = f.read()
+    except OSError:
+        return None
+    entry = {"cpv": best["cpv"], "repo": best["repo"], "ebuild": best["ebuild"]}
+    entry.update(classify_ebuild(content, best["metadata"]))
+    return entry
+
+def build_ebuild_index(pkgs):
+    # One lookup per requested package answering every ebuild question main() has,
+    # persisted across runs and revalidated with stat() calls only
+    repos = list_repos()
+    repo_stamps = [[repo_dir, repo_sync_stamp(repo_dir)] for repo_dir in repos]
+    cache = load_json_cache(EBUILD_CACHE_NAME)
+    cached_packages = cache.get("packages", {}) if cache.get("version") == EBUILD_CACHE_VERSION else {}
+
+    index = {}
+    hits = 0
+    for pkg in pkgs:
+        if pkg in index:
+            continue
+        cp, _, _ = atom_to_cp(pkg)
+        cached = cached_packages.get(pkg)
+        if cached and cached["signature"] == ebuild_signature(cp, cached["entry"], repo_stamps):
+            index[pkg] = cached["entry"]
+            hits += 1
+            continue
+        entry = index_ebuild(pkg, repos)
+        index[pkg] = entry
+        cached_packages[pkg] = {"entry": entry, "signature": ebuild_signature(cp, entry, repo_stamps)}
+
+    if hits < len(index):
+        save_json_cache(EBUILD_CACHE_NAME, {"version": EBUILD_CACHE_VERSION, "packages": cached_packages})
+    if VERBOSE:
+        log(f"Ebuild metadata cache: {hits}/{len(index)} package(s) reused")
+    return index
+
+def portage_config_digest():
+    # Content hash of the /etc/portage files copied into every build root
+    digest = hashlib.sha256()
+    for name, _ in PORTAGE_CONFIG_FILES + [("package.env", "dir")]:
+        path = f"{PORTAGE_CONFIG_DIR}/{name}"
+        if os.path.isdir(path):
+            files = sorted(os.path.join(root, f) for root, _, names in os.walk(path, followlinks=True) for f in names)
+        elif os.path.exists(path):
+            files = [path]
+        else:
+            continue
+        for file_path in files:
+            digest.update(file_path.encode() + b"\0")
+            try:
+                with open(file_path, 'rb') as f:
+                    digest.update(f.read())
+            except OSError:
+                pass
+    return digest.hexdigest()
+
+def script_digest():
+    with open(os.path.realpath(__file__), 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def build_fingerprint(inputs):
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+def flatpak_ref(app_id, version):
+    if BUILD_AS_DATA or BUILD_AS_RUNTIME:
+        return f"runtime/{app_id}/{flatpak_arch()}/{version}"
+    return f"app/{app_id}/{flatpak_arch()}/master"
+
+def repo_commit(repo_dir, ref):
+    try:
+        with open(os.path.join(repo_dir, "refs", "heads", ref), 'r') as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def export_bundle(repo_dir, bundle, app_id):
+    if BUILD_AS_DATA or BUILD_AS_RUNTIME:
+        cmd = ["flatpak", "build-bundle", "--runtime", repo_dir, bundle, app_id, FLATPAK_APP_VERSION]
+    else:
+        cmd = ["flatpak", "build-bundle", repo_dir, bundle, app_id]
+    return subprocess.run(cmd).returncode == 0
+
+def load_build_result(fingerprint):
+    return load_json_cache(os.path.join(RESULTS_CACHE_DIR, f"{fingerprint}.json")) or None
+
+def save_build_result(fingerprint, bundle, repo_dir, ref):
+    st = os.stat(bundle)
+    save_json_cache(os.path.join(RESULTS_CACHE_DIR, f"{fingerprint}.json"), {
+        "bundle": bundle,
+        "bundle_stat": [st.st_size, st.st_mtime_ns],
+        "repo": repo_dir,
+        "ref": ref,
+        "commit": repo_commit(repo_dir, ref),
+        "command": COMMAND,
+        "created": int(time.time()),
+    })
+
+def reuse_build_result(result, bundle, repo_dir, ref):
+    # The previous bundle is reused while it is untouched; otherwise it is
+    # exported again if the repository ref still points at the same commit
+    try:
+        st = os.stat(result["bundle"])
+        if [st.st_size, st.st_mtime_ns] == result["bundle_stat"]:
+            if result["bundle"] != bundle:
+                shutil.copy2(result["bundle"], bundle)
+            return True
+    except (OSError, KeyError, TypeError):
+        pass
+    if result.get("commit") and repo_commit(repo_dir, ref) == result["commit"]:
+        log(f"Exporting bundle from {repo_dir} ({result['commit'][:12]})...")
+        return export_bundle(repo_dir, bundle, APP_ID)
+    return False
+
+def phase_begin(name, inputs, requires=()):
+    # Chains the phase inputs onto the previous phase. Returns the outputs saved
+    # by an earlier run when --resume can skip the phase (and the files in
+    # requires still exist), otherwise None; a phase that runs invalidates its
+    # own checkpoint and those of every later phase.
+    global PHASE_CHAIN
+    PHASE_CHAIN = hashlib.sha256(json.dumps([PHASE_CHAIN, name, inputs], sort_keys=True).encode()).hexdigest()
+    if RESUME:
+        try:
+            with open(os.path.join(CHECKPOINT_DIR, f"{name}.json"), 'r') as f:
+                checkpoint = json.load(f)
+        except (OSError, ValueError):
+            checkpoint = {}
+        if checkpoint.get("input") == PHASE_CHAIN and all(os.path.exists(path) for path in requires):
+            log(f"Resume: phase '{name}' is up to date, skipping")
+            step_end()
+            BUILD_REPORT["steps"].append({"name": name, "status": "skipped"})
+            return checkpoint.get("outputs", {})
+        try:
+            with open(os.path.join(CHECKPOINT_DIR, ROOTFS_MODIFIED_FILE), 'r') as f:
+                modified_by = f.read().strip()
+        except OSError:
+            modified_by = ""
+        if name in ROOTFS_PHASES and modified_by in PHASES and PHASES.index(modified_by) >= PHASES.index(name):
+            restart_with_fresh_rootfs(name)
+    if name in IN_PLACE_PHASES:
+        # The furthest phase that started changing the rootfs in place
+        os.makedirs(CHECKPOINT_DIR, exist_ok=True)
+        with open(os.path.join(CHECKPOINT_DIR, ROOTFS_MODIFIED_FILE), 'w') as f:
+            f.write(f"{name}\n")
+    for later in PHASES[PHASES.index(name):]:
+        try:
+            os.remove(os.path.join(CHECKPOINT_DIR, f"{later}.json"))
+        except OSError:
+            pass
+    if VERBOSE:
+        log(f"Phase: {name}")
+    step_begin(name)
+    return None
+
+def restart_with_fresh_rootfs(phase):
+    # Emerging, bundling or pruning again in a rootfs that this or a later
+    # phase already relocated, extended or pruned would work on a damaged
+    # tree, so the rootfs, its portage state and every checkpoint go and the
+    # build starts over
+    log(f"Resume: phase '{phase}' has to run again on a rootfs an earlier run already changed in place, starting from a fresh rootfs")
+    privileged([["remove", path] for path in FRESH_ROOTFS_PATHS], check=False)
+    stop_privileged_helper()
+    shutil.rmtree(CHECKPOINT_DIR, ignore_errors=True)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.execv(sys.executable, [sys.executable, os.path.realpath(__file__)] + sys.argv[1:])
+
+def phase_end(name, outputs=None):
+    os.makedirs(CHECKPOINT_DIR, exist_ok=True)
+    with open(os.path.join(CHECKPOINT_DIR, f"{name}.json"), 'w') as f:
+        json.dump({"input": PHASE_CHAIN, "outputs": outputs or {}, "finished": int(time.time())}, f)
+    step_end()
+
+def resource_usage():
+    # Cumulative counters of flatpakify, its reaped children (emerge, tar,
+    # flatpak-builder...) and the privileged helper, which is never reaped mid-build
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    try:
+        with open("/proc/self/io", 'r') as f:
+            write_bytes = int(dict(line.split(": ", 1) for line in f.read().splitlines())["write_bytes"])
+    except (OSError, ValueError, KeyError):
+        write_bytes = (own.ru_oublock + children.ru_oublock) * 512
+    return {
+        "wall": time.monotonic(),
+        "cpu": own.ru_utime + own.ru_stime,
+        "child_cpu": children.ru_utime + children.ru_stime + HELPER_USAGE["cpu"],
+        "maxrss": max(own.ru_maxrss, children.ru_maxrss, HELPER_USAGE["maxrss"]) * 1024,
+        "write_bytes": write_bytes + HELPER_USAGE["write_bytes"],
+    }
+
+def step_begin(name):
+    # Every phase, plus a few steps before the first one, is measured for --report
+    global CURRENT_STEP
+    step_end()
+    CURRENT_STEP = (name, resource_usage())
+
+def step_end(status="done"):
+    global CURRENT_STEP
+    if CURRENT_STEP is None:
+        return
+    name, start = CURRENT_STEP
+    end = resource_usage()
+    BUILD_REPORT["steps"].append({
+        "name": name,
+        "status": status,
+        "wall_time": round(end["wall"] - start["wall"], 3),
+        "cpu_time": round(end["cpu"] - start["cpu"], 3),
+        "child_cpu_time": round(end["child_cpu"] - start["child_cpu"], 3),
+        # High-water mark of any process so far; getrusage has no per-phase peak
+        "peak_rss": end["maxrss"],
+        "bytes_written": end["write_bytes"] - start["write_bytes"],
+    })
+    CURRENT_STEP = None
+
+def write_build_report():
+    # Also runs at exit after a failure, marking the step that was running
+    if CURRENT_STEP is not None:
+        step_end("failed")
+    if BUILD_REPORT["status"] is None:
+        BUILD_REPORT["status"] = "failed"
+    BUILD_REPORT["finished"] = time.time()
+    BUILD_REPORT["wall_time"] = round(BUILD_REPORT["finished"] - BUILD_REPORT["started"], 3)
+    BUILD_REPORT["totals"] = {key: round(sum(step.get(key, 0) for step in BUILD_REPORT["steps"]), 3)
+                              for key in ("wall_time", "cpu_time", "child_cpu_time", "bytes_written")}
+    try:
+        with open(REPORT_PATH, 'w') as f:
+            json.dump(BUILD_REPORT, f, indent=2)
+            f.write("\n")
+    except OSError as e:
+        print(f"Warning: could not write the build report {REPORT_PATH}: {e}", file=sys.stderr)
+
+# Runs as root for the whole build: reads one JSON list of [operation, args...]
+# per line and answers with None or an error per operation, plus its own
+# cumulative resource usage for the build report
+PRIVILEGED_HELPER_SOURCE = r"""
+import json, os, resource, shutil, sys
+
+def remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.unlink(path)
+
+def copy_preserving(src, dst):
+    shutil.copy2(src, dst, follow_symlinks=False)
+    st = os.lstat(src)
+    os.lchown(dst, st.st_uid, st.st_gid)
+
+def copy(src, dst, preserve, follow):
+    # cp [-a|-L] --remove-destination: into dst when it is a directory
+    if os.path.isdir(dst) and not os.path.islink(dst):
+        dst = os.path.join(dst, os.path.basename(src.rstrip("/")))
+    if os.path.isdir(src) and (follow or not os.path.islink(src)):
+        shutil.copytree(src, dst, symlinks=not follow, dirs_exist_ok=True,
+                        copy_function=copy_preserving if preserve else shutil.copy)
+        return
+    if os.path.lexists(dst):
+        os.unlink(dst)
+    if preserve and not follow:
+        copy_preserving(src, dst)
+    else:
+        shutil.copy(src, dst, follow_symlinks=follow)
+
+def write(path, content, mode="w"):
+    with open(path, mode) as f:
+        f.write(content)
+
+def link(target, path):
+    if os.path.lexists(path) and (os.path.islink(path) or not os.path.isdir(path)):
+        os.unlink(path)
+    os.symlink(target, path)
+
+def chown(path, uid, gid, recursive):
+    os.lchown(path, uid, gid)
+    if recursive:
+        for root, dirs, files in os.walk(path):
+            for name in dirs + files:
+                os.lchown(os.path.join(root, name), uid, gid)
+
+OPERATIONS = {
+    "mkdir": lambda path: os.makedirs(path, exist_ok=True),
+    "write": write,
+    "append": lambda path, content: write(path, content, "a"),
+    "touch": lambda path: (write(path, "", "a"), os.utime(path)),
+    "copy": copy,
+    "link": link,
+    "remove": remove,
+    "rmdir": os.rmdir,
+    "move": shutil.move,
+    "chown": chown,
+}
+
+for line in sys.stdin:
+    results = []
+    for name, *args in json.loads(line):
+        try:
+            OPERATIONS[name](*args)
+            results.append(None)
+        except Exception as e:
+            results.append(str(e) or type(e).__name__)
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    try:
+        with open("/proc/self/io") as f:
+            write_bytes = int(dict(line.split(": ", 1) for line in f.read().splitlines())["write_bytes"])
+    except (OSError, KeyError, ValueError):
+        write_bytes = usage.ru_oublock * 512
+    usage = {"cpu": usage.ru_utime + usage.ru_stime, "write_bytes": write_bytes, "maxrss": usage.ru_maxrss}
+    sys.stdout.write(json.dumps({"results": results, "usage": usage}) + "\n")
+    sys.stdout.flush()
+"""
+
+def privileged(operations, check=True):
+    # Run a batch of filesystem operations as root in one helper process that
+    # is started on first use and lives until flatpakify exits. Returns None
+    # or an error message per operation; with check, any error is fatal.
+    global PRIVILEGED_HELPER
+    if not operations:
+        return []
+    if PRIVILEGED_HELPER is None:
+        PRIVILEGED_HELPER = subprocess.Popen([SUDO_COMMAND, sys.executable, "-c", PRIVILEGED_HELPER_SOURCE],
+                                             stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+        atexit.register(stop_privileged_helper)
+    try:
+        PRIVILEGED_HELPER.stdin.write(json.dumps(operations) + "\n")
+        PRIVILEGED_HELPER.stdin.flush()
+        reply = json.loads(PRIVILEGED_HELPER.stdout.readline())
+        results = reply["results"]
+        HELPER_USAGE.update(reply["usage"])
+    except (OSError, ValueError, TypeError, KeyError):
+        error(f"The privileged helper started with {SUDO_COMMAND} exited unexpectedly")
+    for operation, result in zip(operations, results):
+        if result and check:
+            error(f"Privileged {operation[0]} of {operation[1]} failed: {result}")
+        elif result and VERBOSE:
+            log(f"Warning: {operation[0]} of {operation[1]} failed: {result}")
+    return results
+
+def stop_privileged_helper():
+    global PRIVILEGED_HELPER
+    if PRIVILEGED_HELPER is not None:
+        PRIVILEGED_HELPER.stdin.close()
+        PRIVILEGED_HELPER.wait()
+        PRIVILEGED_HELPER = None
+
+def stash_portage_state(rootfs, stash_dir):
+    # The portage config and vardb are moved out of the rootfs instead of being
+    # deleted, so a resumed build can still emerge into it
+    for path in PORTAGE_STATE_DIRS:
+        if os.path.isdir(f"{rootfs}/{path}"):
+            privileged([
+                ["remove", f"{stash_dir}/{path}"],
+                ["mkdir", os.path.dirname(f"{stash_dir}/{path}")],
+                ["move", f"{rootfs}/{path}", f"{stash_dir}/{path}"],
+            ])
+
+def restore_portage_state(rootfs, stash_dir):
+    for path in PORTAGE_STATE_DIRS:
+        if os.path.isdir(f"{stash_dir}/{path}") and not os.path.exists(f"{rootfs}/{path}"):
+            log(f"Restoring /{path} into the rootfs to emerge again...")
+            privileged([
+                ["mkdir", os.path.dirname(f"{rootfs}/{path}")],
+                ["move", f"{stash_dir}/{path}", f"{rootfs}/{path}"],
+            ])
+
+def resolve_runtime_deps(pkgs, provided):
+    # =cpv atoms of the installed runtime dependencies of pkgs, dependencies first
+    if DEPS_DEPTH == 1:
+        log("Resolving first-level runtime dependencies...")
+    else:
+        log(f"Resolving runtime dependencies ({'all' if DEPS_DEPTH is None else DEPS_DEPTH} levels)...")
+    
+    all_runtime_deps = []
+    rdeps_module = load_rdeps_module()
+    if rdeps_module is not None:
+        try:
+            rdeps_results, rdeps_errors = rdeps_module.get_packages_dependencies_with_versions(
+                pkgs, depth=DEPS_DEPTH, provided=provided)
+        except Exception as e:
+            log(f"Warning: Failed to get runtime dependencies: {e}")
+            rdeps_results, rdeps_errors = {}, {}
+        
+        for PKG in pkgs:
+            if PKG in rdeps_errors:
+                log(f"Warning: Failed to get runtime dependencies for {PKG}: {rdeps_errors[PKG]}")
+                continue
+            if PKG not in rdeps_results:
+                continue
+            runtime_deps, orphaned_deps = rdeps_results[PKG]
+            if orphaned_deps:
+                log(f"Warning: Failed to get runtime dependencies for {PKG}: installed dependencies without ebuilds: {' '.join(orphaned_deps)}")
+                continue
+            if runtime_deps:
+                log(f"Runtime dependencies for {PKG}: {' '.join(runtime_deps)}")
+                all_runtime_deps.extend(runtime_deps)
+            else:
+                log(f"No runtime dependencies found for {PKG}")
+    
+    seen = set()
+    unique_deps = []
+    for dep in all_runtime_deps:
+        if dep not in seen:
+            seen.add(dep)
+            unique_deps.append(dep)
+    return unique_deps
+
+def install_bundle(bundle):
+    log("Installing Flatpak...")
+    subprocess.run(["flatpak", "--user", "install", "-y", "--noninteractive", "--reinstall", "--bundle", bundle], check=True)
+
+def finish_build(bundle, build_type):
+    # Run the bundle if asked and print how to use it
+    if RUN_AFTER:
+        log("Running application...")
+        subprocess.run(["flatpak", "run", APP_ID])
+    
+    print(f"""
+========================================
+Build Complete!
+========================================
+
+Package(s):     {' '.join(PKGS)}
+App ID:         {APP_ID}
+Version:        {FLATPAK_APP_VERSION}
+Build Type:     {build_type}
+Bundle:         {bundle}""")
+    
+    if BUILD_AS_DATA:
+        print(f"""
+To install extension manually:
+  flatpak install --user -y {bundle}
+
+To use in applications:
+  Add to your application manifest as extension dependency
+
+To uninstall:
+  flatpak uninstall {APP_ID}""")
+    elif BUILD_AS_RUNTIME:
+        print(f"""
+To install runtime manually:
+  flatpak install --user -y {bundle}
+
+To use as runtime dependency:
+  --runtime={APP_ID}
+
+To uninstall:
+  flatpak uninstall -y {APP_ID}""")
+    else:
+        print(f"""Command:        {COMMAND}
+
+To install manually:
+  flatpak install --user -y {bundle}
+
+To run:
+  flatpak run {APP_ID}
+
+To debug:
+  flatpak run --command=sh --devel {APP_ID}
+
+To uninstall:
+  flatpak uninstall -y {APP_ID}""")
+    
+    print()
+
 def parse_args():
     global PKGS, APP_ID, COMMAND, RUNTIME, FLATPAK_RUNTIME_VERSION, FLATPAK_APP_VERSION
     global BUNDLE_LIBS, INSTALL, RUN_AFTER, NETWORK, FLATPAK_AUDIO, FS_ARGS
-    global CLEAN_BUILD, CLEAN_AFTER, VERBOSE, USE_KDE_RUNTIME, WITH_DEPS
+    global CLEAN_BUILD, CLEAN_AFTER, VERBOSE, USE_KDE_RUNTIME, WITH_DEPS, DEPS_DEPTH
     global FLATPAK_RDEPS, BUILD_AS_RUNTIME, BUILD_AS_DATA, CUSTOM_PREFIX, EMERGE_REBUILD_BINARY
-    global SUDO_COMMAND
+    global SUDO_COMMAND, EMERGE_JOBS, MERGE_PHASES, BINPKG_STORE, STAGE_MODE, EXPORT_TARBALL
+    global STATE_DIR, SHARED_REPO, RESULT_CACHE, RESUME, PRUNE, ENTRY_POINTS, PLUGIN_DIRS, COMPRESSION, REPORT_PATH
     
     parser = argparse.ArgumentParser(description='Build any Gentoo package with /app prefix for Flatpak')
     parser.add_argument('packages', nargs='*', help='One or more Gentoo packages from your system overlays')
@@ -65,19 +1857,34 @@ def parse_args():
     parser.add_argument('--app-version', default='1.0', help='Flatpak app/runtime version')
     parser.add_argument('--use-kde-runtime', action='store_true', help='Use KDE runtime for KDE/Qt applications')
     parser.add_argument('--set-prefix', help='Override installation prefix')
-    parser.add_argument('--with-deps', action='store_true', help='Build with only first level runtime dependencies')
+    parser.add_argument('--with-deps', action='store_true', help='Build with installed runtime dependencies (first level by default)')
+    parser.add_argument('--deps-depth', default='1', help='RDEPEND levels followed by --with-deps, or "all" (default: 1)')
     parser.add_argument('--bundle-libs', action='store_true', help='Bundle libraries from host system')
+    parser.add_argument('--prune', choices=['report', 'remove'], help='Report or remove executables, libraries and static archives nothing reaches from the main binary')
+    parser.add_argument('--entry-point', action='append', default=[], help='Extra executable kept by --prune, i.e. /app/libexec/foo/helper')
+    parser.add_argument('--plugin-dir', action='append', default=[], help='Directory of dlopen()ed plugins kept by --prune, i.e. /app/lib64/foo/plugins')
     parser.add_argument('--flatpak-rdep', action='append', default=[], help='Add Flatpak runtime dependency')
     parser.add_argument('--build-as-runtime', action='store_true', help='Build as custom Flatpak runtime')
     parser.add_argument('--build-as-data', action='store_true', help='Build as data-only Flatpak extension')
+    parser.add_argument('--stage-mode', choices=['dir', 'tarball'], default='dir', help='Hand the rootfs to flatpak-builder as a directory (default) or as a compressed tarball')
+    parser.add_argument('--export-tarball', action='store_true', help='Also write the filtered rootfs as <name>-rootfs.tar[.zst] next to the bundle')
+    parser.add_argument('--compression', choices=['none', 'fast', 'max', 'auto'], default='auto', help='Rootfs archive compression (default: auto, picked from its use and contents)')
+    parser.add_argument('--state-dir', help='Persistent flatpak-builder state directory (module cache), kept across builds')
+    parser.add_argument('--repo', help='Shared OSTree repository to export into, kept across builds')
     parser.add_argument('--fs', action='append', default=[], help='Add filesystem permission')
     parser.add_argument('--network', action='store_true', help='Add network permission')
     parser.add_argument('--audio', action='store_true', help='Add audio permissions')
     parser.add_argument('--install', action='store_true', help='Install to current user after build')
     parser.add_argument('--run', action='store_true', help='Run the app after (implies --install)')
     parser.add_argument('--clean', action='store_true', help='Clean build directories before starting')
+    parser.add_argument('--resume', action='store_true', help='Continue an interrupted build from its first phase whose inputs changed (overrides --clean)')
     parser.add_argument('--keep-build', action='store_true', help='Keep build directories after completion')
     parser.add_argument('--rebuild-binary', action='store_true', help='Force rebuild from source')
+    parser.add_argument('--no-result-cache', action='store_true', help='Always rebuild, even when the inputs match a previous successful build')
+    parser.add_argument('--jobs', help='Parallel emerge jobs: "auto" (from CPU count and memory) or a number; also sets --load-average and MAKEOPTS. With --with-deps packages are merged with --nodeps, one at a time, and only MAKEOPTS is raised')
+    parser.add_argument('--binpkg-store', nargs='?', const='default', help='Share binary packages between builds in a store keyed by USE/CFLAGS/CHOST/EPREFIX/profile (default: ~/.cache/flatpakify/binpkgs)')
+    parser.add_argument('--merge-phases', action='store_true', help='Emerge --with-deps dependencies and main package(s) in one invocation (saves an emerge startup; packages are still merged one at a time)')
+    parser.add_argument('--report', help='Write per-phase wall time, CPU time, peak RSS and bytes written as JSON to this file')
     parser.add_argument('--verbose', action='store_true', help='Show detailed build output')
     parser.add_argument('--sudo-command', default='sudo', help='Privilege escalation command (default: sudo)')
     
@@ -113,7 +1920,16 @@ def parse_args():
     if args.set_prefix:
         CUSTOM_PREFIX = args.set_prefix
     WITH_DEPS = args.with_deps
+    if args.deps_depth == "all":
+        DEPS_DEPTH = None
+    elif args.deps_depth.isdigit() and int(args.deps_depth) > 0:
+        DEPS_DEPTH = int(args.deps_depth)
+    else:
+        error(f"--deps-depth must be a positive number or 'all', got: {args.deps_depth}")
     BUNDLE_LIBS = args.bundle_libs
+    PRUNE = args.prune or ""
+    ENTRY_POINTS = args.entry_point
+    PLUGIN_DIRS = args.plugin_dir
     FLATPAK_RDEPS = args.flatpak_rdep
     BUILD_AS_RUNTIME = args.build_as_runtime
     BUILD_AS_DATA = args.build_as_data
@@ -125,19 +1941,52 @@ def parse_args():
         RUN_AFTER = True
         INSTALL = True
     CLEAN_BUILD = args.clean
+    RESUME = args.resume
+    if RESUME and CLEAN_BUILD:
+        log("--resume keeps the existing build directory, ignoring --clean")
+        CLEAN_BUILD = False
     if args.keep_build:
         CLEAN_AFTER = False
     EMERGE_REBUILD_BINARY = args.rebuild_binary
+    RESULT_CACHE = not args.no_result_cache
+    if args.jobs:
+        if args.jobs == "auto":
+            EMERGE_JOBS = "auto"
+        elif args.jobs.isdigit() and int(args.jobs) > 0:
+            EMERGE_JOBS = int(args.jobs)
+        else:
+            error(f"--jobs must be 'auto' or a positive number, got: {args.jobs}")
+    MERGE_PHASES = args.merge_phases
+    if args.binpkg_store:
+        if args.binpkg_store == "default":
+            if not cache_dir():
+                error("Could not create the flatpakify cache directory for --binpkg-store")
+            BINPKG_STORE = os.path.join(cache_dir(), "binpkgs")
+        else:
+            BINPKG_STORE = os.path.abspath(args.binpkg_store)
     VERBOSE = args.verbose
+    STAGE_MODE = args.stage_mode
+    EXPORT_TARBALL = args.export_tarball
+    COMPRESSION = args.compression
+    if args.state_dir:
+        STATE_DIR = os.path.abspath(args.state_dir)
+    if args.repo:
+        SHARED_REPO = os.path.abspath(args.repo)
     SUDO_COMMAND = args.sudo_command
+    if args.report:
+        REPORT_PATH = os.path.abspath(args.report)
     
     return BUNDLE_NAME
 
 def main():
-    global APP_ID, COMMAND, RUNTIME, FLATPAK_RUNTIME_VERSION
+    global APP_ID, COMMAND, RUNTIME, FLATPAK_RUNTIME_VERSION, CHECKPOINT_DIR, FRESH_ROOTFS_PATHS
     
     BUNDLE_NAME = parse_args()
     
+    if REPORT_PATH:
+        BUILD_REPORT.update({"started": time.time(), "script": script_digest()[:16], "arguments": sys.argv[1:]})
+        atexit.register(write_build_report)
+    
     need(SUDO_COMMAND)
     need("emerge")
     need("flatpak")
@@ -185,67 +2034,29 @@ def main():
     ROOTFS = os.path.join(STAGE_DIR, "rootfs")
     FLATPAK_DIR = os.path.join(STAGE_DIR, "flatpak")
     BUILD_DIR = os.path.join(STAGE_DIR, "build")
-    REPO_DIR = os.path.join(STAGE_DIR, "repo")
-    
-    if CLEAN_BUILD:
-        log("Cleaning previous build directories...")
-        shutil.rmtree(STAGE_DIR, ignore_errors=True)
-    
-    os.makedirs(ROOTFS, exist_ok=True)
-    os.makedirs(FLATPAK_DIR, exist_ok=True)
-    os.makedirs(BUILD_DIR, exist_ok=True)
-    os.makedirs(REPO_DIR, exist_ok=True)
+    REPO_DIR = SHARED_REPO or os.path.join(STAGE_DIR, "repo")
+    CHECKPOINT_DIR = os.path.join(STAGE_DIR, ".checkpoints")
+    PORTAGE_STATE_DIR = os.path.join(STAGE_DIR, "portage-state")
+    FRESH_ROOTFS_PATHS = [ROOTFS, PORTAGE_STATE_DIR]
     
     log(f"Building: {' '.join(PKGS)}")
     
-    log("Setting up build environment...")
-    subprocess.run([SUDO_COMMAND, "mkdir", "-p", f"{ROOTFS}/etc/portage"], check=False)
-    
-    portage_files = [
-        ("make.conf", "file"),
-        ("package.use", "dir"),
-        ("package.accept_keywords", "dir"),
-        ("package.mask", "dir"),
-        ("package.unmask", "dir"),
-        ("repos.conf", "dir"),
-        ("binrepos.conf", "dir"),
-        ("env", "dir"),
-    ]
+    step_begin("index")
+    EBUILD_INDEX = build_ebuild_index(PKGS)
     
-    for pfile, ptype in portage_files:
-        src = f"/etc/portage/{pfile}"
-        dst = f"{ROOTFS}/etc/portage/"
-        if os.path.exists(src):
-            if ptype == "file":
-                if os.path.islink(src):
-                    real_src = os.path.realpath(src)
-                    if os.path.exists(real_src):
-                        subprocess.run([SUDO_COMMAND, "cp", real_src, dst], check=False)
-                    else:
-                        log(f"Warning: {src} is a broken symlink, skipping")
-                else:
-                    subprocess.run([SUDO_COMMAND, "cp", "-a", src, dst], check=False)
-            else:
-                subprocess.run([SUDO_COMMAND, "cp", "-aR", src, dst], check=False)
-    
-    if os.path.exists("/etc/portage/package.env"):
-        subprocess.run([SUDO_COMMAND, "mkdir", "-p", f"{ROOTFS}/etc/portage/package.env"], check=True)
-        subprocess.run([SUDO_COMMAND, "cp", "-aR", "/etc/portage/package.env/*", 
-                       f"{ROOTFS}/etc/portage/package.env/"], check=False)
-
     PROFILE_PATH = ""
-    if os.path.islink("/etc/portage/make.profile"):
-        PROFILE_PATH = os.path.realpath("/etc/portage/make.profile")
+    if os.path.islink(f"{PORTAGE_CONFIG_DIR}/make.profile"):
+        PROFILE_PATH = os.path.realpath(f"{PORTAGE_CONFIG_DIR}/make.profile")
         if not os.path.exists(PROFILE_PATH):
             PROFILE_PATH = ""
     else:
         try_profiles = [
-            "/var/db/repos/gentoo/profiles/default/linux/amd64/23.0/desktop/plasma/systemd",
-            "/var/db/repos/gentoo/profiles/default/linux/amd64/23.0/desktop/plasma",
-            "/var/db/repos/gentoo/profiles/default/linux/amd64/23.0/desktop/systemd",
-            "/var/db/repos/gentoo/profiles/default/linux/amd64/23.0/desktop",
-            "/var/db/repos/gentoo/profiles/default/linux/amd64/23.0/systemd",
-            "/var/db/repos/gentoo/profiles/default/linux/amd64/23.0"
+            f"{REPOS_DIR}/gentoo/profiles/default/linux/amd64/23.0/desktop/plasma/systemd",
+            f"{REPOS_DIR}/gentoo/profiles/default/linux/amd64/23.0/desktop/plasma",
+            f"{REPOS_DIR}/gentoo/profiles/default/linux/amd64/23.0/desktop/systemd",
+            f"{REPOS_DIR}/gentoo/profiles/default/linux/amd64/23.0/desktop",
+            f"{REPOS_DIR}/gentoo/profiles/default/linux/amd64/23.0/systemd",
+            f"{REPOS_DIR}/gentoo/profiles/default/linux/amd64/23.0"
         ]
         for try_profile in try_profiles:
             if os.path.isdir(try_profile):
@@ -255,281 +2066,24 @@ def main():
     
     if not PROFILE_PATH or not os.path.isdir(PROFILE_PATH):
         log("Warning: Could not determine profile, will use system default")
-        PROFILE_PATH = "/etc/portage/make.profile"
-    
-    if BUILD_AS_DATA:
-        log("Creating minimal profile for data-only runtime build...")
-        subprocess.run([SUDO_COMMAND, "mkdir", "-p", f"{ROOTFS}/etc/portage/profile"], check=True)
-
-        with open(f"{ROOTFS}/etc/portage/profile/packages", "w") as f:
-            subprocess.run([SUDO_COMMAND, "tee", f"{ROOTFS}/etc/portage/profile/packages"],
-                         input=b"# Minimal packages list - avoid system packages for data-only runtimes\n",
-                         stdout=subprocess.DEVNULL, check=True)
-        
-        make_conf_content = f"""# Minimal configuration for data-only packages
-{'FEATURES="-collision-protect -protect-owned buildpkg -sandbox -usersandbox"' if EMERGE_REBUILD_BINARY else 'FEATURES="-collision-protect -protect-owned getbinpkg buildpkg -sandbox -usersandbox"'}
-USE="-* minimal"
-# Mask everything except data directories
-INSTALL_MASK="/app/usr/include/ /bin /sbin /lib /lib64 /usr/bin /usr/sbin /usr/lib /usr/lib64 /lib/debug /usr/lib/debug"
-"""
-        subprocess.run([SUDO_COMMAND, "tee", f"{ROOTFS}/etc/portage/make.conf"], 
-                     input=make_conf_content.encode(), stdout=subprocess.DEVNULL, check=True)
+        PROFILE_PATH = f"{PORTAGE_CONFIG_DIR}/make.profile"
     
-    subprocess.run([SUDO_COMMAND, "ln", "-sfn", PROFILE_PATH, f"{ROOTFS}/etc/portage/make.profile"], check=True)
+    if USE_KDE_RUNTIME:
+        RUNTIME = "org.kde.Platform"
+        FLATPAK_RUNTIME_VERSION = "6.9"
+        log(f"Using KDE runtime: {RUNTIME}/{FLATPAK_RUNTIME_VERSION}")
     
-    candidate_packages = []
+    vardb_index = build_vardb_index()
+    candidate_packages = runtime_provided_packages(RUNTIME, FLATPAK_RUNTIME_VERSION, vardb_index)
     
-    if RUNTIME == "org.freedesktop.Platform":
+    if candidate_packages:
+        log(f"Creating package.provided from installed runtime {RUNTIME}//{FLATPAK_RUNTIME_VERSION}...")
+    elif RUNTIME == "org.freedesktop.Platform":
         log("Creating package.provided for freedesktop platform...")
-        subprocess.run([SUDO_COMMAND, "mkdir", "-p", f"{ROOTFS}/etc/portage/profile"], check=True)
-        
-        candidate_packages = [
-            "app-accessibility/at-spi2-core",
-            "app-alternatives/awk",
-            "app-alternatives/bc",
-            "app-alternatives/bzip2",
-            "app-alternatives/cpio",
-            "app-alternatives/gawk",
-            "app-alternatives/gzip",
-            "app-alternatives/lex",
-            "app-alternatives/ninja",
-            "app-alternatives/python3",
-            "app-alternatives/sh",
-            "app-alternatives/tar",
-            "app-alternatives/yacc",
-            "app-arch/brotli",
-            "app-arch/bzip2",
-            "app-arch/gcab",
-            "app-arch/lz4",
-            "app-arch/tar",
-            "app-crypt/libmd",
-            "app-crypt/p11-kit",
-            "app-editors/nano",
-            "app-emulation/vmware-workstation",
-            "app-misc/c_rehash",
-            "app-misc/pax-utils",
-            "app-portage/elt-patches",
-            "app-shells/bash",
-            "app-text/hunspell",
-            "app-text/mythes",
-            "dev-build/autotools-utils",
-            "dev-build/libtool",
-            "dev-build/pkgconf",
-            "dev-db/sqlite",
-            "dev-lang/duktape",
-            "dev-lang/orc",
-            "dev-lang/perl",
-            "dev-lang/python",
-            "dev-lang/python-exec",
-            "dev-lang/tcl",
-            "dev-libs/elfutils",
-            "dev-libs/expat",
-            "dev-libs/fribidi",
-            "dev-libs/gmp",
-            "dev-libs/gobject-introspection",
-            "dev-libs/hyphen",
-            "dev-libs/icu",
-            "dev-libs/json-glib",
-            "dev-libs/libffi",
-            "dev-libs/libgcrypt",
-            "dev-libs/libgudev",
-            "dev-libs/libksba",
-            "dev-libs/libtasn1",
-            "dev-libs/libusb",
-            "dev-libs/libxml2",
-            "dev-libs/libxmlb",
-            "dev-libs/libyaml",
-            "dev-libs/nspr",
-            "dev-libs/nss",
-            "dev-libs/openssl",
-            "dev-libs/wayland",
-            "dev-python/installer",
-            "dev-python/markupsafe",
-            "dev-python/pycairo",
-            "dev-python/pygobject",
-            "dev-qt/qtmultimedia",
-            "dev-util/mingw64-toolchain",
-            "dev-util/nvidia-cuda-toolkit",
-            "gnome-base/gsettings-desktop-schemas",
-            "gui-libs/gtk",
-            "gui-libs/libdecor",
-            "kde-apps/kio-extras",
-            "media-gfx/graphite2",
-            "media-gfx/imagemagick",
-            "media-libs/alsa-lib",
-            "media-libs/dav1d",
-            "media-libs/freetype",
-            "media-libs/giflib",
-            "media-libs/graphene",
-            "media-libs/gst-plugins-bad",
-            "media-libs/gst-plugins-base",
-            "media-libs/gst-plugins-good",
-            "media-libs/gst-plugins-ugly",
-            "media-libs/gstreamer",
-            "media-libs/ladspa-sdk",
-            "media-libs/lcms",
-            "media-libs/libepoxy",
-            "media-libs/libexif",
-            "media-libs/libglvnd",
-            "media-libs/libjpeg-turbo",
-            "media-libs/libjxl",
-            "media-libs/libpulse",
-            "media-libs/libsdl2",
-            "media-libs/libsamplerate",
-            "media-libs/libsndfile",
-            "media-libs/libv4l",
-            "media-libs/libva",
-            "media-libs/libvorbis",
-            "media-libs/mesa",
-            "media-libs/openal",
-            "media-libs/openjpeg",
-            "media-libs/opus",
-            "media-libs/shaderc",
-            "media-libs/speex",
-            "media-libs/speexdsp",
-            "media-libs/webrtc-audio-processing",
-            "media-plugins/alsa-plugins",
-            "media-plugins/gst-plugins-flac",
-            "media-plugins/gst-plugins-libav",
-            "media-plugins/gst-plugins-mpg123",
-            "media-plugins/gst-plugins-opus",
-            "media-sound/lame",
-            "media-sound/mpg123-base",
-            "media-video/ffmpeg",
-            "media-video/pipewire",
-            "net-dns/libidn2",
-            "net-libs/glib-networking",
-            "net-libs/gnutls",
-            "net-libs/libproxy",
-            "net-libs/libpsl",
-            "net-libs/libsoup",
-            "net-misc/curl",
-            "net-misc/rsync",
-            "net-print/cups",
-            "net-wireless/bluez",
-            "perl-core/Carp",
-            "perl-core/Exporter",
-            "perl-core/File-Path",
-            "perl-core/File-Spec",
-            "perl-core/Getopt-Long",
-            "perl-core/Scalar-List-Utils",
-            "perl-core/Text-ParseWords",
-            "sci-libs/fftw",
-            "sys-apps/acl",
-            "sys-apps/attr",
-            "sys-apps/baselayout",
-            "sys-apps/busybox",
-            "sys-apps/coreutils",
-            "sys-apps/debianutils",
-            "sys-apps/diffutils",
-            "sys-apps/dbus",
-            "sys-apps/eselect",
-            "sys-apps/file",
-            "sys-apps/findutils",
-            "sys-apps/gawk",
-            "sys-apps/grep",
-            "sys-apps/help2man",
-            "sys-apps/hwdata",
-            "sys-apps/install-xattr",
-            "sys-apps/kmod",
-            "sys-apps/less",
-            "sys-apps/net-tools",
-            "sys-apps/pciutils",
-            "sys-apps/portage",
-            "sys-apps/sandbox",
-            "sys-apps/sed",
-            "sys-apps/systemd",
-            "sys-apps/texinfo",
-            "sys-apps/util-linux",
-            "sys-apps/which",
-            "sys-apps/xz-utils",
-            "sys-auth/passwdqc",
-            "sys-devel/autoconf",
-            "sys-devel/automake",
-            "sys-devel/binutils",
-            "sys-devel/binutils-config",
-            "sys-devel/bison",
-            "sys-devel/flex",
-            "sys-devel/gcc",
-            "sys-devel/gcc-config",
-            "sys-devel/gettext",
-            "sys-devel/gnuconfig",
-            "sys-devel/make",
-            "sys-devel/patch",
-            "sys-fs/e2fsprogs",
-            "sys-fs/eudev",
-            "sys-kernel/linux-headers",
-            "sys-libs/cracklib",
-            "sys-libs/gdbm",
-            "sys-libs/glibc",
-            "sys-libs/libcap",
-            "sys-libs/libunwind",
-            "sys-libs/libxcrypt",
-            "sys-libs/ncurses",
-            "sys-libs/pam",
-            "sys-libs/readline",
-            "sys-libs/zlib",
-            "sys-libs/zlib-ng",
-            "sys-process/procps",
-            "virtual/editor",
-            "virtual/libc",
-            "virtual/libcrypt",
-            "virtual/libelf",
-            "virtual/libiconv",
-            "virtual/libintl",
-            "virtual/libudev",
-            "virtual/libusb",
-            "virtual/os-headers",
-            "virtual/pager",
-            "virtual/pam",
-            "virtual/perl-Carp",
-            "virtual/perl-Exporter",
-            "virtual/perl-File-Path",
-            "virtual/perl-File-Spec",
-            "virtual/perl-Getopt-Long",
-            "virtual/perl-Scalar-List-Utils",
-            "virtual/perl-Text-ParseWords",
-            "virtual/pkgconfig",
-            "virtual/udev",
-            "www-client/firefox-bin",
-            "x11-libs/cairo",
-            "x11-libs/gdk-pixbuf",
-            "x11-libs/gtk+",
-            "x11-libs/libICE",
-            "x11-libs/libnotify",
-            "x11-libs/libpciaccess",
-            "x11-libs/libSM",
-            "x11-libs/libvdpau",
-            "x11-libs/libX11",
-            "x11-libs/libXau",
-            "x11-libs/libxcb",
-            "x11-libs/libXcomposite",
-            "x11-libs/libXcursor",
-            "x11-libs/libXdamage",
-            "x11-libs/libXdmcp",
-            "x11-libs/libXext",
-            "x11-libs/libXfixes",
-            "x11-libs/libXft",
-            "x11-libs/libXi",
-            "x11-libs/libXinerama",
-            "x11-libs/libxkbfile",
-            "x11-libs/libXpm",
-            "x11-libs/libXrandr",
-            "x11-libs/libXrender",
-            "x11-libs/libXScrnSaver",
-            "x11-libs/libxshmfence",
-            "x11-libs/libXt",
-            "x11-libs/libXtst",
-            "x11-libs/libXv",
-            "x11-libs/libXxf86vm",
-            "x11-libs/xcb-util",
-            "x11-libs/xcb-util-cursor",
-            "x11-libs/xcb-util-image",
-            "x11-libs/xcb-util-keysyms",
-            "x11-libs/xcb-util-renderutil",
-            "x11-libs/xcb-util-wm"
-        ]
-        
+        candidate_packages = list(FREEDESKTOP_PROVIDED_PACKAGES)
+    
+    installed_packages = []
+    if candidate_packages:
         filtered_candidates = []
         for candidate in candidate_packages:
             should_exclude = False
@@ -550,81 +2104,172 @@ INSTALL_MASK="/app/usr/include/ /bin /sbin /lib /lib64 /usr/bin /usr/sbin /usr/l
         removed_count = original_count - len(candidate_packages)
         log(f"Filtered candidate_packages: removed {removed_count} user-specified packages")
         
-        installed_packages = []
-        
         for pkg in candidate_packages:
             category, package_name = pkg.split('/')
-            pkg_dir = f"/var/db/pkg/{category}"
-            
-            if os.path.isdir(pkg_dir):
-                for installed_dir in os.listdir(pkg_dir):
-                    if installed_dir.startswith(package_name + "-"):
-                        pf_file = f"{pkg_dir}/{installed_dir}/PF"
-                        if os.path.isfile(pf_file):
-                            try:
-                                with open(pf_file, 'r') as f:
-                                    pf_value = f.read().strip()
-                                    installed_packages.append(f"{category}/{pf_value}")
-                            except:
-                                pass
-        
-        if installed_packages:
-            installed_packages.sort()
-            provided_content = '\n'.join(installed_packages) + '\n'
+            for pf in vardb_index.get(category, {}).get(package_name, []):
+                installed_packages.append(f"{category}/{pf}")
+        installed_packages.sort()
+    
+    unique_deps = []
+    if WITH_DEPS and not BUILD_AS_DATA:
+        step_begin("rdeps")
+        unique_deps = resolve_runtime_deps(PKGS, candidate_packages)
+    
+    step_begin("fingerprint")
+    BUILD_SETTINGS = portage_build_settings(EPREFIX, PROFILE_PATH)
+    PORTAGE_CONFIG_DIGEST = portage_config_digest()
+    BUNDLE = f"{WORK_DIR}/{SAFE_PKG}.flatpak"
+    BUNDLE_REF = flatpak_ref(APP_ID, FLATPAK_APP_VERSION)
+    
+    # Everything the bundle is derived from; the manifest itself is generated
+    # from these inputs and the resulting rootfs, so the script hash covers it.
+    # A repository sync, an eclass change (the md5-cache _eclasses_ checksums)
+    # or a different set of installed packages (which a plain emerge resolves
+    # dependencies against) all change it.
+    BUILD_REPORT.update({"packages": PKGS, "app_id": APP_ID})
+    BUILD_FINGERPRINT = build_fingerprint({
+        "script": script_digest(),
+        "repos": [[repo_dir, repo_sync_stamp(repo_dir)] for repo_dir in list_repos()],
+        "packages": {pkg: entry and [entry["cpv"], entry["repo"], path_mtime(entry["ebuild"]),
+                                     (read_md5_cache(entry["repo"], entry["cpv"]) or {}).get("_eclasses_")]
+                     for pkg, entry in EBUILD_INDEX.items()},
+        "deps": unique_deps,
+        "provided": installed_packages,
+        "settings": BUILD_SETTINGS,
+        "portage_config": PORTAGE_CONFIG_DIGEST,
+        "host": vardb_signature(vardb_index),
+        "runtime": [RUNTIME, FLATPAK_RUNTIME_VERSION, FLATPAK_RDEPS],
+        "app": [APP_ID, COMMAND, FLATPAK_APP_VERSION, BUILD_TYPE, EPREFIX, BUNDLE],
+        "finish_args": [FS_ARGS, NETWORK, FLATPAK_AUDIO],
+        "options": [BUNDLE_LIBS, WITH_DEPS, DEPS_DEPTH, STAGE_MODE, EXPORT_TARBALL, COMPRESSION, PRUNE, ENTRY_POINTS, PLUGIN_DIRS],
+    })
+    
+    if RESULT_CACHE and not CLEAN_BUILD and not EMERGE_REBUILD_BINARY:
+        previous = load_build_result(BUILD_FINGERPRINT)
+        if previous and reuse_build_result(previous, BUNDLE, REPO_DIR, BUNDLE_REF):
+            log(f"Inputs unchanged since {time.strftime('%Y-%m-%d %H:%M', time.localtime(previous['created']))}, reusing {BUNDLE}")
+            COMMAND = previous.get("command") or COMMAND
+            if INSTALL:
+                step_begin("install")
+                install_bundle(BUNDLE)
+            step_end()
+            BUILD_REPORT["status"] = "cached"
+            finish_build(BUNDLE, BUILD_TYPE)
+            return
+    step_end()
+    
+    if CLEAN_BUILD:
+        log("Cleaning previous build directories...")
+        privileged([["remove", PORTAGE_STATE_DIR]], check=False)
+        shutil.rmtree(STAGE_DIR, ignore_errors=True)
+    
+    os.makedirs(ROOTFS, exist_ok=True)
+    os.makedirs(FLATPAK_DIR, exist_ok=True)
+    os.makedirs(BUILD_DIR, exist_ok=True)
+    os.makedirs(REPO_DIR, exist_ok=True)
+    if STATE_DIR:
+        os.makedirs(STATE_DIR, exist_ok=True)
+    
+    if phase_begin("config", {
+        "settings": BUILD_SETTINGS,
+        "portage_config": PORTAGE_CONFIG_DIGEST,
+        "provided": installed_packages,
+        "profile": PROFILE_PATH,
+        "prefix": [EPREFIX, PREFIX, BUILD_TYPE],
+        "cmake_meson": [PKG for PKG in PKGS if EBUILD_INDEX.get(PKG) and EBUILD_INDEX[PKG]["cmake_meson"]],
+        "rebuild_binary": EMERGE_REBUILD_BINARY,
+    }) is None:
+        log("Setting up build environment...")
+        config_copies = [["mkdir", f"{ROOTFS}/etc/portage"]]
+        
+        for pfile, ptype in PORTAGE_CONFIG_FILES:
+            src = f"{PORTAGE_CONFIG_DIR}/{pfile}"
+            dst = f"{ROOTFS}/etc/portage/"
+            if os.path.exists(src):
+                if ptype == "file":
+                    if os.path.islink(src):
+                        real_src = os.path.realpath(src)
+                        if os.path.exists(real_src):
+                            config_copies.append(["copy", real_src, f"{dst}{pfile}", False, True])
+                        else:
+                            log(f"Warning: {src} is a broken symlink, skipping")
+                    else:
+                        config_copies.append(["copy", src, dst, True, False])
+                else:
+                    config_copies.append(["copy", src, dst, True, False])
+        
+        if os.path.isdir(f"{PORTAGE_CONFIG_DIR}/package.env"):
+            config_copies.append(["copy", f"{PORTAGE_CONFIG_DIR}/package.env", f"{ROOTFS}/etc/portage/", True, False])
+        privileged(config_copies, check=False)
+        
+        # Everything below is written in one batch at the end of the phase
+        config_writes = []
+        if BUILD_AS_DATA:
+            log("Creating minimal profile for data-only runtime build...")
+            config_writes.append(["mkdir", f"{ROOTFS}/etc/portage/profile"])
+            config_writes.append(["write", f"{ROOTFS}/etc/portage/profile/packages",
+                                  "# Minimal packages list - avoid system packages for data-only runtimes\n"])
+        
+            make_conf_content = f"""# Minimal configuration for data-only packages
+{'FEATURES="-collision-protect -protect-owned buildpkg -sandbox -usersandbox"' if EMERGE_REBUILD_BINARY else 'FEATURES="-collision-protect -protect-owned getbinpkg buildpkg -sandbox -usersandbox"'}
+USE="-* minimal"
+# Mask everything except data directories
+INSTALL_MASK="/app/usr/include/ /bin /sbin /lib /lib64 /usr/bin /usr/sbin /usr/lib /usr/lib64 /lib/debug /usr/lib/debug"
+"""
+            config_writes.append(["write", f"{ROOTFS}/etc/portage/make.conf", make_conf_content])
+        
+        config_writes.append(["link", PROFILE_PATH, f"{ROOTFS}/etc/portage/make.profile"])
+        
+        if candidate_packages:
+            config_writes.append(["mkdir", f"{ROOTFS}/etc/portage/profile"])
+        
+            if installed_packages:
+                provided_content = '\n'.join(installed_packages) + '\n'
             
-            with open("package.provided", "w") as f:
-                f.write(provided_content)
+                with open("package.provided", "w") as f:
+                    f.write(provided_content)
             
-            log(f"Created package.provided with {len(installed_packages)} installed packages")
-            subprocess.run([SUDO_COMMAND, "cp", "package.provided", f"{ROOTFS}/etc/portage/profile/package.provided"], check=True)
+                log(f"Created package.provided with {len(installed_packages)} installed packages")
+                config_writes.append(["write", f"{ROOTFS}/etc/portage/profile/package.provided", provided_content])
 
-    
-    log("Creating Flatpak build environment...")
-    subprocess.run([SUDO_COMMAND, "mkdir", "-p", f"{ROOTFS}/etc/portage/env"], check=True)
-    
-    
-    cmake_meson_env = f"""# CMake/Meson packages - install to EPREFIX/usr for consistency
+        
+        log("Creating Flatpak build environment...")
+        config_writes.append(["mkdir", f"{ROOTFS}/etc/portage/env"])
+        
+        
+        cmake_meson_env = f"""# CMake/Meson packages - install to EPREFIX/usr for consistency
 CMAKE_INSTALL_PREFIX="{EPREFIX}{PREFIX}"
 MYCMAKEARGS="-DCMAKE_INSTALL_PREFIX={EPREFIX}{PREFIX}"
 MESON_INSTALL_PREFIX="{EPREFIX}{PREFIX}"
 MYMESONARGS="--prefix={EPREFIX}{PREFIX}"
 """
-    
-    subprocess.run([SUDO_COMMAND, "tee", f"{ROOTFS}/etc/portage/env/flatpak-cmake-meson"], 
-                 input=cmake_meson_env.encode(), stdout=subprocess.DEVNULL, check=True)
-    
-    other_env = f"""# Environment for non-CMake/Meson packages
+        
+        config_writes.append(["write", f"{ROOTFS}/etc/portage/env/flatpak-cmake-meson", cmake_meson_env])
+        
+        other_env = f"""# Environment for non-CMake/Meson packages
 # EPREFIX is set via emerge environment variable
 """
-    
-    subprocess.run([SUDO_COMMAND, "tee", f"{ROOTFS}/etc/portage/env/flatpak-other"], 
-                 input=other_env.encode(), stdout=subprocess.DEVNULL, check=True)
-    
-    subprocess.run([SUDO_COMMAND, "mkdir", "-p", f"{ROOTFS}/etc/portage/package.env"], check=True)
-    
-    subprocess.run([SUDO_COMMAND, "touch", f"{ROOTFS}/etc/portage/package.env/flatpak"], check=True)
-    
-    for PKG in PKGS:
-        EBUILD_PATH = ""
-        for repo_dir in ["/var/db/repos/gentoo"] + list(Path("/var/db/repos").glob("*")):
-            pkg_dir = Path(repo_dir) / PKG
-            if pkg_dir.is_dir():
-                ebuilds = list(pkg_dir.glob("*.ebuild"))
-                if ebuilds:
-                    EBUILD_PATH = str(ebuilds[0])
-                    break
         
-        if EBUILD_PATH and os.path.isfile(EBUILD_PATH):
-            with open(EBUILD_PATH, 'r') as f:
-                content = f.read()
-                if 'cmake' in content or 'meson' in content:
+        config_writes.append(["write", f"{ROOTFS}/etc/portage/env/flatpak-other", other_env])
+        
+        config_writes.append(["mkdir", f"{ROOTFS}/etc/portage/package.env"])
+        
+        config_writes.append(["touch", f"{ROOTFS}/etc/portage/package.env/flatpak"])
+        
+        for PKG in PKGS:
+            ebuild_info = EBUILD_INDEX.get(PKG)
+            if ebuild_info:
+                if ebuild_info["cmake_meson"]:
                     log(f"Package {PKG} uses CMake/Meson - using specific build args")
                     env_assignment = f"{PKG} flatpak-cmake-meson\n"
                 else:
                     log(f"Package {PKG} uses other build system - using EXTRA_ECONF")
                     env_assignment = f"{PKG} flatpak-other\n"
-                
-                subprocess.run([SUDO_COMMAND, "sh", "-c", f"echo '{env_assignment.strip()}' >> {ROOTFS}/etc/portage/package.env/flatpak"], check=True)
+            
+                config_writes.append(["append", f"{ROOTFS}/etc/portage/package.env/flatpak", env_assignment])
+        
+        privileged(config_writes)
+        phase_end("config")
     
     # detection mechanism for the future to be used for kde dependencies
     if not USE_KDE_RUNTIME:
@@ -633,118 +2278,95 @@ MYMESONARGS="--prefix={EPREFIX}{PREFIX}"
             if any(keyword in PKG.lower() for keyword in ['kde', 'plasma', 'kf5', 'kf6', 'qt5', 'qt6']):
                 kde_packages.append(PKG)
             else:
-                EBUILD_PATH = ""
-                for repo_dir in ["/var/db/repos/gentoo"] + list(Path("/var/db/repos").glob("*")):
-                    pkg_dir = Path(repo_dir) / PKG
-                    if pkg_dir.is_dir():
-                        ebuilds = list(pkg_dir.glob("*.ebuild"))
-                        if ebuilds:
-                            EBUILD_PATH = str(ebuilds[0])
-                            break
-                
-                if EBUILD_PATH and os.path.isfile(EBUILD_PATH):
-                    with open(EBUILD_PATH, 'r') as f:
-                        content = f.read()
-                        if any(pattern in content for pattern in [
-                            'dev-qt/', 'kde-frameworks/', 'kde-plasma/', 'kde-apps/',
-                            'qtcore', 'qtgui', 'qtwidgets', 'kf5', 'kf6'
-                        ]):
-                            kde_packages.append(PKG)
+                ebuild_info = EBUILD_INDEX.get(PKG)
+                if ebuild_info and ebuild_info["kde"]:
+                    kde_packages.append(PKG)
         
         if kde_packages:
             log(f"Detected KDE/Qt packages: {', '.join(kde_packages)}")
             log("Consider using --use-kde-runtime flag FlatPak KDE/Qt integration")
     
-    if USE_KDE_RUNTIME:
-        RUNTIME = "org.kde.Platform"
-        FLATPAK_RUNTIME_VERSION = "6.9"
-        log(f"Using KDE runtime: {RUNTIME}/{FLATPAK_RUNTIME_VERSION}")
-    
     if EMERGE_REBUILD_BINARY:
         EMERGE_FEATURES = "-collision-protect -protect-owned buildpkg"
     else:
         EMERGE_FEATURES = "-collision-protect -protect-owned getbinpkg buildpkg"
     
+    if os.environ.get("PKGDIR"):
+        BINPKG_DIR = os.environ["PKGDIR"]
+        if BINPKG_STORE:
+            log(f"PKGDIR is set, ignoring --binpkg-store and using {BINPKG_DIR}")
+    elif BINPKG_STORE:
+        BINPKG_DIR = binpkg_store_dir(BINPKG_STORE, BUILD_SETTINGS)
+        log(f"Using shared binary package store: {BINPKG_DIR}")
+    else:
+        BINPKG_DIR = f"{os.getcwd()}/binpkgs/"
+    USING_BINPKG_STORE = BINPKG_STORE and not os.environ.get("PKGDIR")
+    EMERGE_START = time.time_ns()
+    
+    EMERGE_PARALLELISM = emerge_parallelism(EMERGE_JOBS) if EMERGE_JOBS else None
+    
     if BUILD_AS_DATA:
         EMERGE_OPTS = "-v1 --ask=n"
         log("Building data package without dependencies...")
     elif WITH_DEPS:
         EMERGE_OPTS = "-v1 --nodeps --ask=n"
-        log("Building with first-level runtime dependencies...")
-        
-        all_runtime_deps = []
-        for PKG in PKGS:
-            try:
-                rdeps_command = "flatpakify-check-rdeps"
-                if shutil.which(rdeps_command) is None:
-                    rdeps_command = "./flatpakify-check-rdeps.py"
-                    if not os.path.isfile(rdeps_command):
-                        log("Warning: Neither flatpakify-check-rdeps and ./flatpakify-check-rdeps.py found, building without dependencies")
-                        break
-                
-                result = subprocess.run([rdeps_command, PKG], capture_output=True, text=True, check=True)
-                runtime_deps = result.stdout.strip().split('\n')
-                runtime_deps = [dep for dep in runtime_deps if dep]
-                if runtime_deps:
-                    log(f"Runtime dependencies for {PKG}: {' '.join(runtime_deps)}")
-                    all_runtime_deps.extend(runtime_deps)
-                else:
-                    log(f"No runtime dependencies found for {PKG}")
-            except subprocess.CalledProcessError as e:
-                log(f"Warning: Failed to get runtime dependencies for {PKG}: {e}")
-            except FileNotFoundError:
-                log("Warning: flatpakify-check-rdeps not found, building without additional dependencies")
-                break
-        
-        seen = set()
-        unique_deps = []
-        for dep in all_runtime_deps:
-            if dep not in seen:
-                seen.add(dep)
-                unique_deps.append(dep)
+        log("Building with installed runtime dependencies...")
         
+        PKGS_TO_BUILD = PKGS
         if unique_deps:
             log(f"Total unique runtime dependencies to build: {len(unique_deps)}")
             
-            log("Phase 1: Building runtime dependencies...")
+            if MERGE_PHASES and any(EBUILD_INDEX.get(PKG) and EBUILD_INDEX[PKG]["cmake_meson"] for PKG in PKGS):
+                log("CMake/Meson packages need their own EPREFIX handling - keeping dependency and main phases separate")
+            elif MERGE_PHASES:
+                log("Building runtime dependencies and main package(s) in a single emerge, in dependency order...")
+                PKGS_TO_BUILD = unique_deps + PKGS
             
-            emerge_env = os.environ.copy()
-            emerge_env["FEATURES"] = EMERGE_FEATURES
-            emerge_env["PKGDIR"] = os.environ.get("PKGDIR", f"{os.getcwd()}/binpkgs/")
-            emerge_env["CONFIG_PROTECT"] = "-*"
-            emerge_env["ACCEPT_LICENSE"] = "*"
+            if PKGS_TO_BUILD is PKGS and \
+               phase_begin("deps", {"deps": unique_deps, "binpkgs": BINPKG_DIR, "rebuild_binary": EMERGE_REBUILD_BINARY}) is None:
+                restore_portage_state(ROOTFS, PORTAGE_STATE_DIR)
+                log("Phase 1: Building runtime dependencies...")
             
-            if EMERGE_REBUILD_BINARY:
-                default_opts = "--rebuilt-binaries"
-            else:
-                default_opts = "--getbinpkg --rebuilt-binaries"
-            user_opts = os.environ.get("EMERGE_DEFAULT_OPTS", "")
-            if user_opts:
-                emerge_env["EMERGE_DEFAULT_OPTS"] = f"{user_opts} {default_opts}"
-            else:
-                emerge_env["EMERGE_DEFAULT_OPTS"] = default_opts
+                emerge_env = os.environ.copy()
+                emerge_env["FEATURES"] = EMERGE_FEATURES
+                emerge_env["PKGDIR"] = BINPKG_DIR
+                emerge_env["CONFIG_PROTECT"] = "-*"
+                emerge_env["ACCEPT_LICENSE"] = "*"
+            
+                if EMERGE_REBUILD_BINARY:
+                    default_opts = "--rebuilt-binaries"
+                else:
+                    default_opts = "--getbinpkg --rebuilt-binaries"
+                user_opts = os.environ.get("EMERGE_DEFAULT_OPTS", "")
+                if user_opts:
+                    emerge_env["EMERGE_DEFAULT_OPTS"] = f"{user_opts} {default_opts}"
+                else:
+                    emerge_env["EMERGE_DEFAULT_OPTS"] = default_opts
+                if USING_BINPKG_STORE:
+                    emerge_env["EMERGE_DEFAULT_OPTS"] += " --binpkg-respect-use=y"
+                apply_parallelism(emerge_env, EMERGE_PARALLELISM, EMERGE_OPTS)
             
-            if not BUILD_AS_RUNTIME and not BUILD_AS_DATA:
-                emerge_env["EPREFIX"] = EPREFIX
-                log(f"Setting EPREFIX={EPREFIX} for dependencies")
+                if not BUILD_AS_RUNTIME and not BUILD_AS_DATA:
+                    emerge_env["EPREFIX"] = EPREFIX
+                    log(f"Setting EPREFIX={EPREFIX} for dependencies")
             
-            deps_exclude_args = []
-            if candidate_packages:
-                for pkg in candidate_packages:
-                    deps_exclude_args.extend(["--exclude", pkg])
+                deps_exclude_args = []
+                if candidate_packages:
+                    for pkg in candidate_packages:
+                        deps_exclude_args.extend(["--exclude", pkg])
             
-            emerge_cmd = [SUDO_COMMAND] + [f"{k}={v}" for k, v in emerge_env.items() if k in ["FEATURES", "PKGDIR", "CONFIG_PROTECT", "INSTALL_MASK", "EPREFIX", "EMERGE_DEFAULT_OPTS", "ACCEPT_LICENSE"]]
-            emerge_cmd += ["emerge"] + EMERGE_OPTS.split() + [f"--root={ROOTFS}", f"--config-root={ROOTFS}"] + deps_exclude_args + unique_deps
+                emerge_cmd = [SUDO_COMMAND] + [f"{k}={v}" for k, v in emerge_env.items() if k in ["FEATURES", "PKGDIR", "CONFIG_PROTECT", "INSTALL_MASK", "EPREFIX", "EMERGE_DEFAULT_OPTS", "ACCEPT_LICENSE", "MAKEOPTS"]]
+                emerge_cmd += ["emerge"] + EMERGE_OPTS.split() + [f"--root={ROOTFS}", f"--config-root={ROOTFS}"] + deps_exclude_args + unique_deps
             
-            result = subprocess.run(emerge_cmd, capture_output=False)
-            if result.returncode != 0:
-                error("Failed to build runtime dependencies. Check the emerge output above for details.")
+                result = subprocess.run(emerge_cmd, capture_output=False)
+                if result.returncode != 0:
+                    error("Failed to build runtime dependencies. Check the emerge output above for details.")
             
-            log("Runtime dependencies built successfully")
+                log("Runtime dependencies built successfully")
+                phase_end("deps")
             
-            log("Phase 2: Building main package(s)...")
+                log("Phase 2: Building main package(s)...")
             
-        PKGS_TO_BUILD = PKGS
     else:
         EMERGE_OPTS = "-v1 --ask=n"
         log("Building without dependencies (strict package-only mode)...")
@@ -753,343 +2375,444 @@ MYMESONARGS="--prefix={EPREFIX}{PREFIX}"
     if not VERBOSE:
         EMERGE_OPTS += " --quiet-build"
     
-    log("Running emerge for main package(s) (this may take a while)...")
-    
-    if EMERGE_REBUILD_BINARY:
-        EMERGE_FEATURES = "-collision-protect -protect-owned buildpkg"
-    else:
-        EMERGE_FEATURES = "-collision-protect -protect-owned getbinpkg buildpkg"
-    
-    emerge_env = os.environ.copy()
-    emerge_env["FEATURES"] = EMERGE_FEATURES
-    emerge_env["PKGDIR"] = os.environ.get("PKGDIR", f"{os.getcwd()}/binpkgs/")
-    emerge_env["CONFIG_PROTECT"] = "-*"
-    emerge_env["ACCEPT_LICENSE"] = "*"
-    
-    if EMERGE_REBUILD_BINARY:
-        default_opts = "--rebuilt-binaries"
-    else:
-        default_opts = "--getbinpkg --rebuilt-binaries"
-    user_opts = os.environ.get("EMERGE_DEFAULT_OPTS", "")
-    if user_opts:
-        emerge_env["EMERGE_DEFAULT_OPTS"] = f"{user_opts} {default_opts}"
-    else:
-        emerge_env["EMERGE_DEFAULT_OPTS"] = default_opts
-    
-    uses_cmake_meson = False
-    if not BUILD_AS_RUNTIME and not BUILD_AS_DATA:
-        for PKG in PKGS_TO_BUILD:
-            EBUILD_PATH = ""
-            for repo_dir in ["/var/db/repos/gentoo"] + list(Path("/var/db/repos").glob("*")):
-                pkg_dir = Path(repo_dir) / PKG
-                if pkg_dir.is_dir():
-                    ebuilds = list(pkg_dir.glob("*.ebuild"))
-                    if ebuilds:
-                        EBUILD_PATH = str(ebuilds[0])
-                        break
-            
-            if EBUILD_PATH and os.path.isfile(EBUILD_PATH):
-                with open(EBUILD_PATH, 'r') as f:
-                    content = f.read()
-                    if 'cmake' in content or 'meson' in content:
-                        uses_cmake_meson = True
-                        log(f"Package {PKG} uses CMake/Meson - will not set EPREFIX inside package.env")
-                        break
-    
-    if not BUILD_AS_RUNTIME and not BUILD_AS_DATA and not uses_cmake_meson:
-        emerge_env["EPREFIX"] = EPREFIX
-        log(f"Setting EPREFIX={EPREFIX} for non-CMake/Meson packages")
-    elif uses_cmake_meson:
-        log("CMake/Meson packages detected - using their native prefix handling")
-    
-    if BUILD_AS_DATA:
-        emerge_env["INSTALL_MASK"] = "/bin /sbin /lib /lib/debug /lib64 /usr/bin /usr/sbin /usr/lib/debug /usr/lib /usr/lib64 /usr/libexec /usr/include /etc /var"
-    
-    packages_to_emerge = PKGS_TO_BUILD if 'PKGS_TO_BUILD' in locals() else PKGS
-    
-    exclude_args = []
-    if candidate_packages:
-        for pkg in candidate_packages:
-            exclude_args.extend(["--exclude", pkg])
-    
-    emerge_cmd = [SUDO_COMMAND] + [f"{k}={v}" for k, v in emerge_env.items() if k in ["FEATURES", "PKGDIR", "CONFIG_PROTECT", "INSTALL_MASK", "EPREFIX", "EMERGE_DEFAULT_OPTS", "ACCEPT_LICENSE"]]
-    emerge_cmd += ["emerge"] + EMERGE_OPTS.split() + [f"--root={ROOTFS}", f"--config-root={ROOTFS}"] + exclude_args + packages_to_emerge
-    
-    result = subprocess.run(emerge_cmd, capture_output=False)
-    if result.returncode != 0:
-        error("Build failed. Check the emerge output above for details.")
-    
-    log("Checking for Flatpak runtime dependencies...")
-    for PKG in PKGS:
-        EBUILD_PATH = ""
-        for repo_dir in ["/var/db/repos/gentoo"] + list(Path("/var/db/repos").glob("*")):
-            pkg_dir = Path(repo_dir) / PKG
-            if pkg_dir.is_dir():
-                ebuilds = list(pkg_dir.glob("*.ebuild"))
-                if ebuilds:
-                    EBUILD_PATH = str(ebuilds[0])
+    EMERGE_OUTPUTS = phase_begin("emerge", {
+        "packages": PKGS,
+        "deps": unique_deps,
+        "merge_phases": MERGE_PHASES,
+        "opts": EMERGE_OPTS,
+        "binpkgs": BINPKG_DIR,
+        "rebuild_binary": EMERGE_REBUILD_BINARY,
+    })
+    if EMERGE_OUTPUTS is None:
+        restore_portage_state(ROOTFS, PORTAGE_STATE_DIR)
+        log("Running emerge for main package(s) (this may take a while)...")
+        
+        if EMERGE_REBUILD_BINARY:
+            EMERGE_FEATURES = "-collision-protect -protect-owned buildpkg"
+        else:
+            EMERGE_FEATURES = "-collision-protect -protect-owned getbinpkg buildpkg"
+        
+        emerge_env = os.environ.copy()
+        emerge_env["FEATURES"] = EMERGE_FEATURES
+        emerge_env["PKGDIR"] = BINPKG_DIR
+        emerge_env["CONFIG_PROTECT"] = "-*"
+        emerge_env["ACCEPT_LICENSE"] = "*"
+        
+        if EMERGE_REBUILD_BINARY:
+            default_opts = "--rebuilt-binaries"
+        else:
+            default_opts = "--getbinpkg --rebuilt-binaries"
+        user_opts = os.environ.get("EMERGE_DEFAULT_OPTS", "")
+        if user_opts:
+            emerge_env["EMERGE_DEFAULT_OPTS"] = f"{user_opts} {default_opts}"
+        else:
+            emerge_env["EMERGE_DEFAULT_OPTS"] = default_opts
+        if USING_BINPKG_STORE:
+            emerge_env["EMERGE_DEFAULT_OPTS"] += " --binpkg-respect-use=y"
+        apply_parallelism(emerge_env, EMERGE_PARALLELISM, EMERGE_OPTS)
+        
+        uses_cmake_meson = False
+        if not BUILD_AS_RUNTIME and not BUILD_AS_DATA:
+            for PKG in PKGS_TO_BUILD:
+                ebuild_info = EBUILD_INDEX.get(PKG)
+                if ebuild_info and ebuild_info["cmake_meson"]:
+                    uses_cmake_meson = True
+                    log(f"Package {PKG} uses CMake/Meson - will not set EPREFIX inside package.env")
                     break
         
-        if EBUILD_PATH and os.path.isfile(EBUILD_PATH):
-            log(f"Found ebuild for {PKG}: {EBUILD_PATH}")
-            with open(EBUILD_PATH, 'r') as f:
-                content = f.read()
-                match = re.search(r'FLATPAK_RDEPS=\(([^)]*)\)', content)
-                if match:
-                    rdeps = match.group(1).replace('"', '').split()
-                    if rdeps:
-                        log(f"Found FLATPAK_RDEPS in {PKG}: {' '.join(rdeps)}")
-                        FLATPAK_RDEPS.extend(rdeps)
-    
-    log("Cleaning up staging area...")
-    dirs_to_remove = [
-        f"{ROOTFS}/etc/portage",
-        f"{ROOTFS}/var/db", f"{ROOTFS}/var/cache", f"{ROOTFS}/var/lib",
-        f"{ROOTFS}/var/tmp", f"{ROOTFS}/var/run", f"{ROOTFS}/var/lock",
-        f"{ROOTFS}/usr/share/man", f"{ROOTFS}/usr/share/doc", f"{ROOTFS}/usr/share/info",
-        f"{ROOTFS}{EPREFIX}{PREFIX}/share/man", f"{ROOTFS}{EPREFIX}{PREFIX}/share/doc", f"{ROOTFS}{EPREFIX}{PREFIX}/share/info",
-        f"{ROOTFS}/tmp"
-    ]
-    
-    for dir_path in dirs_to_remove:
-        subprocess.run([SUDO_COMMAND, "rm", "-rf", dir_path], check=False)
-    
-    if BUILD_AS_DATA:
-        log("Filtering for data-only package - removing all non-data files...")
+        if not BUILD_AS_RUNTIME and not BUILD_AS_DATA and not uses_cmake_meson:
+            emerge_env["EPREFIX"] = EPREFIX
+            log(f"Setting EPREFIX={EPREFIX} for non-CMake/Meson packages")
+        elif uses_cmake_meson:
+            log("CMake/Meson packages detected - using their native prefix handling")
         
-        try:
-            result = subprocess.run(["du", "-sh", ROOTFS], capture_output=True, text=True)
-            BEFORE_SIZE = result.stdout.split()[0] if result.returncode == 0 else "unknown"
-            log(f"ROOTFS size before filtering: {BEFORE_SIZE}")
-        except:
-            pass
+        if BUILD_AS_DATA:
+            emerge_env["INSTALL_MASK"] = "/bin /sbin /lib /lib/debug /lib64 /usr/bin /usr/sbin /usr/lib/debug /usr/lib /usr/lib64 /usr/libexec /usr/include /etc /var"
         
-        data_remove_dirs = [
-            f"{ROOTFS}/usr/bin", f"{ROOTFS}/usr/sbin", f"{ROOTFS}/usr/lib64", f"{ROOTFS}/usr/lib",
-            f"{ROOTFS}/usr/libexec", f"{ROOTFS}/usr/include",
-            f"{ROOTFS}/bin", f"{ROOTFS}/sbin", f"{ROOTFS}/lib64", f"{ROOTFS}/lib", f"{ROOTFS}/libexec",
-            f"{ROOTFS}/app/bin", f"{ROOTFS}/app/sbin", f"{ROOTFS}/app/lib64", f"{ROOTFS}/app/lib",
-            f"{ROOTFS}/app/libexec", f"{ROOTFS}/app/include",
-            f"{ROOTFS}/app/etc", f"{ROOTFS}/app/etc", f"{ROOTFS}/var"
-        ]
+        packages_to_emerge = PKGS_TO_BUILD if 'PKGS_TO_BUILD' in locals() else PKGS
         
-        for dir_path in data_remove_dirs:
-            subprocess.run([SUDO_COMMAND, "rm", "-rf", dir_path], check=False)
+        exclude_args = []
+        if candidate_packages:
+            for pkg in candidate_packages:
+                exclude_args.extend(["--exclude", pkg])
         
-        log("Keeping only data directories (share/...)")
+        emerge_cmd = [SUDO_COMMAND] + [f"{k}={v}" for k, v in emerge_env.items() if k in ["FEATURES", "PKGDIR", "CONFIG_PROTECT", "INSTALL_MASK", "EPREFIX", "EMERGE_DEFAULT_OPTS", "ACCEPT_LICENSE", "MAKEOPTS"]]
+        emerge_cmd += ["emerge"] + EMERGE_OPTS.split() + [f"--root={ROOTFS}", f"--config-root={ROOTFS}"] + exclude_args + packages_to_emerge
         
-        subprocess.run(["find", ROOTFS, "-type", "d", "-empty", "-delete"], check=False)
+        result = subprocess.run(emerge_cmd, capture_output=False)
+        if result.returncode != 0:
+            error("Build failed. Check the emerge output above for details.")
         
-        try:
-            result = subprocess.run(["du", "-sh", ROOTFS], capture_output=True, text=True)
-            AFTER_SIZE = result.stdout.split()[0] if result.returncode == 0 else "unknown"
-            log(f"ROOTFS size after filtering: {AFTER_SIZE} (was {BEFORE_SIZE})")
-        except:
-            pass
+        MERGED_CPVS = merged_since(ROOTFS, EPREFIX, EMERGE_START)
+        record_binpkg_use(BINPKG_DIR, MERGED_CPVS)
+        if USING_BINPKG_STORE:
+            report_binpkg_store(BINPKG_DIR, MERGED_CPVS, EMERGE_START)
         
-        log("Data-only filtering completed")
+        phase_end("emerge", {"merged": MERGED_CPVS})
     else:
-        if os.path.exists(f"{ROOTFS}/var"):
-            subprocess.run([SUDO_COMMAND, "rmdir", f"{ROOTFS}/var"], check=False)
-    
-    # Since we're using EPREFIX and proper build environments, the rootfs should already 
-    # have the correct structure. We only need minimal adjustments for special cases.
+        MERGED_CPVS = EMERGE_OUTPUTS["merged"]
     
-    if BUILD_AS_DATA:
-        log("Preparing data extension structure...")
-        
-        if os.path.isdir(f"{ROOTFS}/usr/share"):
-            log("Moving /usr/share to root level for data extension...")
-            subprocess.run([SUDO_COMMAND, "mkdir", "-p", f"{ROOTFS}/share"], check=True)
-            subprocess.run([SUDO_COMMAND, "sh", "-c", f"mv {ROOTFS}/usr/share/* {ROOTFS}/share/ 2>/dev/null || true"], check=False)
-            subprocess.run([SUDO_COMMAND, "rmdir", f"{ROOTFS}/usr/share"], check=False)
-            subprocess.run([SUDO_COMMAND, "rmdir", f"{ROOTFS}/usr"], check=False)
-        
-        if os.path.isdir(f"{ROOTFS}/app/share"):
-            log("Moving /app/share to root level for data extension...")
-            subprocess.run([SUDO_COMMAND, "mkdir", "-p", f"{ROOTFS}/share"], check=True)
-            subprocess.run([SUDO_COMMAND, "sh", "-c", f"mv {ROOTFS}/app/share/* {ROOTFS}/share/ 2>/dev/null || true"], check=False)
-            subprocess.run([SUDO_COMMAND, "rmdir", f"{ROOTFS}/app/share"], check=False)
-            subprocess.run([SUDO_COMMAND, "rmdir", f"{ROOTFS}/app"], check=False)
-        
-        if not os.path.isdir(f"{ROOTFS}/share") or not os.listdir(f"{ROOTFS}/share"):
-            log("Warning: No data files found in /share directory")
+    log("Checking for Flatpak runtime dependencies...")
+    for PKG in PKGS:
+        ebuild_info = EBUILD_INDEX.get(PKG)
+        if ebuild_info:
+            log(f"Found ebuild for {PKG}: {ebuild_info['ebuild']}")
+            rdeps = ebuild_info["flatpak_rdeps"]
+            if rdeps:
+                log(f"Found FLATPAK_RDEPS in {PKG}: {' '.join(rdeps)}")
+                FLATPAK_RDEPS.extend(rdeps)
+    
+    # Filled by the walks below (data filtering, library scan, staging) and kept
+    # current as files are bundled or pruned; None until a walk covered ROOTFS
+    ROOTFS_USAGE = None
+    ROOTFS_VARDB_DIRS = [f"{PORTAGE_STATE_DIR}/var/db/pkg", f"{ROOTFS}{EPREFIX}/var/db/pkg"]
+    
+    CLEANUP_OUTPUTS = phase_begin("cleanup", {"command": COMMAND, "build_type": BUILD_TYPE})
+    if CLEANUP_OUTPUTS is None:
+        log("Cleaning up staging area...")
+        stash_portage_state(ROOTFS, PORTAGE_STATE_DIR)
+        dirs_to_remove = [
+            f"{ROOTFS}/var/cache", f"{ROOTFS}/var/lib",
+            f"{ROOTFS}/var/tmp", f"{ROOTFS}/var/run", f"{ROOTFS}/var/lock",
+            f"{ROOTFS}/usr/share/man", f"{ROOTFS}/usr/share/doc", f"{ROOTFS}/usr/share/info",
+            f"{ROOTFS}{EPREFIX}{PREFIX}/share/man", f"{ROOTFS}{EPREFIX}{PREFIX}/share/doc", f"{ROOTFS}{EPREFIX}{PREFIX}/share/info",
+            f"{ROOTFS}/tmp"
+        ]
+        
+        privileged([["remove", dir_path] for dir_path in dirs_to_remove], check=False)
+        
+        if BUILD_AS_DATA:
+            log("Filtering for data-only package - removing all non-data files...")
+            
+            data_remove_dirs = [
+                f"{ROOTFS}/usr/bin", f"{ROOTFS}/usr/sbin", f"{ROOTFS}/usr/lib64", f"{ROOTFS}/usr/lib",
+                f"{ROOTFS}/usr/libexec", f"{ROOTFS}/usr/include",
+                f"{ROOTFS}/bin", f"{ROOTFS}/sbin", f"{ROOTFS}/lib64", f"{ROOTFS}/lib", f"{ROOTFS}/libexec",
+                f"{ROOTFS}/app/bin", f"{ROOTFS}/app/sbin", f"{ROOTFS}/app/lib64", f"{ROOTFS}/app/lib",
+                f"{ROOTFS}/app/libexec", f"{ROOTFS}/app/include",
+                f"{ROOTFS}/app/etc", f"{ROOTFS}/app/etc", f"{ROOTFS}/var"
+            ]
+            
+            owners = rootfs_file_owners(ROOTFS_VARDB_DIRS)
+            before_usage = new_size_usage(ROOTFS, [EPREFIX + PREFIX, EPREFIX], owners)
+            ROOTFS_USAGE = new_size_usage(ROOTFS, [EPREFIX + PREFIX, EPREFIX], owners)
+            empty_dirs = filter_data_rootfs(ROOTFS, data_remove_dirs, before_usage, ROOTFS_USAGE)
+            log(f"ROOTFS size before filtering: {format_size(before_usage['total'])}")
+            
+            privileged([["remove", dir_path] for dir_path in data_remove_dirs] +
+                       [["rmdir", dir_path] for dir_path in empty_dirs], check=False)
+            
+            log("Keeping only data directories (share/...)")
+            log(f"ROOTFS size after filtering: {format_size(ROOTFS_USAGE['total'])} (was {format_size(before_usage['total'])})")
+            
+            log("Data-only filtering completed")
         else:
-            log("Data files found in /share:")
-            subprocess.run(["ls", "-la", f"{ROOTFS}/share/"], check=False)
-    
-    elif BUILD_AS_RUNTIME:
-        if os.path.isdir(f"{ROOTFS}/app") and not os.path.isdir(f"{ROOTFS}/usr"):
-            log("Moving files from /app to /usr for runtime build...")
-            subprocess.run([SUDO_COMMAND, "mv", f"{ROOTFS}/app", f"{ROOTFS}/usr"], check=True)
+            if os.path.exists(f"{ROOTFS}/var"):
+                privileged([["rmdir", f"{ROOTFS}/var"]], check=False)
         
-        if not os.path.isdir(f"{ROOTFS}/usr") or not os.listdir(f"{ROOTFS}/usr"):
-            error("Failed to create /usr structure for runtime")
-        log("Successfully created runtime /usr structure")
-    
-    else:
-        if not os.path.isdir(f"{ROOTFS}/app"):
-            if os.path.isdir(f"{ROOTFS}/usr"):
-                log("Warning: Files installed to /usr instead of /app, moving to /app...")
-                subprocess.run([SUDO_COMMAND, "mv", f"{ROOTFS}/usr", f"{ROOTFS}/app"], check=True)
+        # Since we're using EPREFIX and proper build environments, the rootfs should already 
+        # have the correct structure. We only need minimal adjustments for special cases.
+        
+        if BUILD_AS_DATA:
+            log("Preparing data extension structure...")
+            
+            if os.path.isdir(f"{ROOTFS}/usr/share"):
+                log("Moving /usr/share to root level for data extension...")
+                privileged([["mkdir", f"{ROOTFS}/share"]])
+                privileged([["move", f"{ROOTFS}/usr/share/{name}", f"{ROOTFS}/share/"]
+                            for name in sorted(os.listdir(f"{ROOTFS}/usr/share")) if not name.startswith(".")] +
+                           [["rmdir", f"{ROOTFS}/usr/share"], ["rmdir", f"{ROOTFS}/usr"]], check=False)
+            
+            if os.path.isdir(f"{ROOTFS}/app/share"):
+                log("Moving /app/share to root level for data extension...")
+                privileged([["mkdir", f"{ROOTFS}/share"]])
+                privileged([["move", f"{ROOTFS}/app/share/{name}", f"{ROOTFS}/share/"]
+                            for name in sorted(os.listdir(f"{ROOTFS}/app/share")) if not name.startswith(".")] +
+                           [["rmdir", f"{ROOTFS}/app/share"], ["rmdir", f"{ROOTFS}/app"]], check=False)
+            
+            if not os.path.isdir(f"{ROOTFS}/share") or not os.listdir(f"{ROOTFS}/share"):
+                log("Warning: No data files found in /share directory")
             else:
-                error("No application files found in /app or /usr after build")
+                log("Data files found in /share:")
+                subprocess.run(["ls", "-la", f"{ROOTFS}/share/"], check=False)
         
-        if not os.path.isdir(f"{ROOTFS}/app") or not os.listdir(f"{ROOTFS}/app"):
-            error("Failed to create /app structure for application")
-        log("Successfully verified application /app structure")
-    
-    if not BUILD_AS_RUNTIME and not BUILD_AS_DATA:
-        BIN_DIRS = [f"{ROOTFS}{EPREFIX}/bin", f"{ROOTFS}{EPREFIX}{PREFIX}/bin"]
-        LIB_DIRS = [f"{ROOTFS}{EPREFIX}/lib64", f"{ROOTFS}{EPREFIX}{PREFIX}/lib64"]
+        elif BUILD_AS_RUNTIME:
+            if os.path.isdir(f"{ROOTFS}/app") and not os.path.isdir(f"{ROOTFS}/usr"):
+                log("Moving files from /app to /usr for runtime build...")
+                privileged([["move", f"{ROOTFS}/app", f"{ROOTFS}/usr"]])
+            
+            if not os.path.isdir(f"{ROOTFS}/usr") or not os.listdir(f"{ROOTFS}/usr"):
+                error("Failed to create /usr structure for runtime")
+            log("Successfully created runtime /usr structure")
         
-        actual_bin_dir = None
-        for bin_dir in BIN_DIRS:
-            if os.path.isdir(bin_dir) and list(Path(bin_dir).glob("*")):
-                actual_bin_dir = bin_dir
-                break
+        else:
+            if not os.path.isdir(f"{ROOTFS}/app"):
+                if os.path.isdir(f"{ROOTFS}/usr"):
+                    log("Warning: Files installed to /usr instead of /app, moving to /app...")
+                    privileged([["move", f"{ROOTFS}/usr", f"{ROOTFS}/app"]])
+                else:
+                    error("No application files found in /app or /usr after build")
+            
+            if not os.path.isdir(f"{ROOTFS}/app") or not os.listdir(f"{ROOTFS}/app"):
+                error("Failed to create /app structure for application")
+            log("Successfully verified application /app structure")
         
-        if not actual_bin_dir:
-            actual_bin_dir = f"{ROOTFS}{EPREFIX}/bin"
-            os.makedirs(actual_bin_dir, exist_ok=True)
-            with open(f"{actual_bin_dir}/true", "w") as f:
-                f.write("#!/bin/sh\nexit 0\n")
-            os.chmod(f"{actual_bin_dir}/true", 0o755)
+        if not BUILD_AS_RUNTIME and not BUILD_AS_DATA:
+            BIN_DIRS = [f"{ROOTFS}{EPREFIX}/bin", f"{ROOTFS}{EPREFIX}{PREFIX}/bin"]
+            LIB_DIRS = [f"{ROOTFS}{EPREFIX}/lib64", f"{ROOTFS}{EPREFIX}{PREFIX}/lib64"]
             
-            for lib_dir in LIB_DIRS:
-                if os.path.isdir(lib_dir) and list(Path(lib_dir).glob("*.so*")):
-                    log("No executables found, but libraries detected. Setting dummy command for library package.")
-                    COMMAND = "true"
+            actual_bin_dir = None
+            for bin_dir in BIN_DIRS:
+                if os.path.isdir(bin_dir) and list(Path(bin_dir).glob("*")):
+                    actual_bin_dir = bin_dir
                     break
-    
-    if not BUILD_AS_RUNTIME and not BUILD_AS_DATA:
-        MAIN_BINARY = ""
-        BIN_DIRS = [f"{ROOTFS}{EPREFIX}/bin", f"{ROOTFS}{EPREFIX}{PREFIX}/bin"]
-        LIB_DIRS = [f"{ROOTFS}{EPREFIX}/lib64", f"{ROOTFS}{EPREFIX}{PREFIX}/lib64"]
-        
-        for BIN_DIR in BIN_DIRS:
-            if os.path.isfile(f"{BIN_DIR}/{COMMAND}"):
-                MAIN_BINARY = f"{BIN_DIR}/{COMMAND}"
-                break
-            elif os.path.isfile(f"{BIN_DIR}/{PACKAGE}"):
-                MAIN_BINARY = f"{BIN_DIR}/{PACKAGE}"
-                COMMAND = PACKAGE
-                break
+            
+            if not actual_bin_dir:
+                actual_bin_dir = f"{ROOTFS}{EPREFIX}/bin"
+                os.makedirs(actual_bin_dir, exist_ok=True)
+                with open(f"{actual_bin_dir}/true", "w") as f:
+                    f.write("#!/bin/sh\nexit 0\n")
+                os.chmod(f"{actual_bin_dir}/true", 0o755)
+                
+                for lib_dir in LIB_DIRS:
+                    if os.path.isdir(lib_dir) and list(Path(lib_dir).glob("*.so*")):
+                        log("No executables found, but libraries detected. Setting dummy command for library package.")
+                        COMMAND = "true"
+                        break
         
-        if not MAIN_BINARY:
+        if not BUILD_AS_RUNTIME and not BUILD_AS_DATA:
+            MAIN_BINARY = ""
+            BIN_DIRS = [f"{ROOTFS}{EPREFIX}/bin", f"{ROOTFS}{EPREFIX}{PREFIX}/bin"]
+            LIB_DIRS = [f"{ROOTFS}{EPREFIX}/lib64", f"{ROOTFS}{EPREFIX}{PREFIX}/lib64"]
+            
             for BIN_DIR in BIN_DIRS:
-                if os.path.isdir(BIN_DIR):
-                    try:
-                        binaries = list(Path(BIN_DIR).glob("*"))
-                        if binaries:
-                            MAIN_BINARY = str(binaries[0])
-                            COMMAND = binaries[0].name
-                            break
-                    except:
-                        pass
-        
-        if not MAIN_BINARY:
-            has_libraries = False
-            for LIB_DIR in LIB_DIRS:
-                if os.path.isdir(LIB_DIR) and list(Path(LIB_DIR).glob("*.so*")):
-                    has_libraries = True
+                if os.path.isfile(f"{BIN_DIR}/{COMMAND}"):
+                    MAIN_BINARY = f"{BIN_DIR}/{COMMAND}"
+                    break
+                elif os.path.isfile(f"{BIN_DIR}/{PACKAGE}"):
+                    MAIN_BINARY = f"{BIN_DIR}/{PACKAGE}"
+                    COMMAND = PACKAGE
                     break
-                    
-            if has_libraries:
-                log("No executable found, but libraries detected. Building as library package with dummy command.")
-                COMMAND = "true"
-                MAIN_BINARY = f"{EPREFIX}/bin/true"
-                log("Created dummy true binary for library package")
+            
+            if not MAIN_BINARY:
+                for BIN_DIR in BIN_DIRS:
+                    if os.path.isdir(BIN_DIR):
+                        try:
+                            binaries = list(Path(BIN_DIR).glob("*"))
+                            if binaries:
+                                MAIN_BINARY = str(binaries[0])
+                                COMMAND = binaries[0].name
+                                break
+                        except:
+                            pass
+            
+            if not MAIN_BINARY:
+                has_libraries = False
+                for LIB_DIR in LIB_DIRS:
+                    if os.path.isdir(LIB_DIR) and list(Path(LIB_DIR).glob("*.so*")):
+                        has_libraries = True
+                        break
+                        
+                if has_libraries:
+                    log("No executable found, but libraries detected. Building as library package with dummy command.")
+                    COMMAND = "true"
+                    MAIN_BINARY = f"{EPREFIX}/bin/true"
+                    log("Created dummy true binary for library package")
+                else:
+                    error(f"No executable found in any bin directory and no libraries detected")
+            
+            if COMMAND != "true":
+                log(f"Main binary: {COMMAND}")
             else:
-                error(f"No executable found in any bin directory and no libraries detected")
+                log(f"Library package using dummy command: {COMMAND}")
         
-        if COMMAND != "true":
-            log(f"Main binary: {COMMAND}")
-        else:
-            log(f"Library package using dummy command: {COMMAND}")
-    
-    if BUNDLE_LIBS and not BUILD_AS_RUNTIME and not BUILD_AS_DATA:
+        phase_end("cleanup", {"command": COMMAND})
+    else:
+        COMMAND = CLEANUP_OUTPUTS["command"]
+    
+    # Which sonames the runtime provides, and in which version, decides what is
+    # bundled, so a runtime update reruns the phase
+    runtime_files, runtime_commit = find_runtime(RUNTIME, FLATPAK_RUNTIME_VERSION)
+    if BUNDLE_LIBS and not BUILD_AS_RUNTIME and not BUILD_AS_DATA and \
+       phase_begin("libs", {"kde": USE_KDE_RUNTIME, "host": vardb_signature(vardb_index),
+                            "runtime": f"{RUNTIME}//{FLATPAK_RUNTIME_VERSION}", "runtime_commit": runtime_commit}) is None:
         log("Bundling libraries from host system...")
         
         BINARIES_TO_CHECK = []
-        for binary_path in Path(f"{ROOTFS}{EPREFIX}").rglob("*"):
-            if binary_path.is_file() and (os.access(str(binary_path), os.X_OK) or binary_path.suffix.startswith(".so")):
-                BINARIES_TO_CHECK.append(str(binary_path))
+        ROOTFS_USAGE = new_size_usage(ROOTFS, [EPREFIX + PREFIX, EPREFIX], rootfs_file_owners(ROOTFS_VARDB_DIRS))
+        for root, dirs, names in walk_rootfs(ROOTFS, ROOTFS_USAGE):
+            if not f"{root}/".startswith(f"{ROOTFS}{EPREFIX}/"):
+                continue
+            for name in names:
+                binary_path = os.path.join(root, name)
+                if os.path.isfile(binary_path) and (os.access(binary_path, os.X_OK) or os.path.splitext(name)[1].startswith(".so")):
+                    BINARIES_TO_CHECK.append(binary_path)
+        
+        # DT_NEEDED is read in-process and resolved against the rootfs, then the
+        # target runtime, then the host; only host hits are bundled
+        if not runtime_files:
+            log(f"Runtime {RUNTIME}//{FLATPAK_RUNTIME_VERSION} is not installed, resolving libraries against the host only")
+        layers = library_search_layers(ROOTFS, EPREFIX, runtime_files)
+        scan_start = time.monotonic()
+        elf_info, cache_hits = read_elf_batch(BINARIES_TO_CHECK)
+        host_libs, runtime_libs, outdated_libs, missing_libs = scan_library_dependencies(BINARIES_TO_CHECK, layers, elf_info)
+        log(f"  Scanned {len(BINARIES_TO_CHECK)} files ({cache_hits} cached) in {time.monotonic() - scan_start:.2f}s")
+        if runtime_libs:
+            log(f"  {len(runtime_libs)} libraries are provided by {RUNTIME}")
+        if outdated_libs:
+            log(f"  Too old in {RUNTIME}, bundling the host version: {' '.join(sorted(outdated_libs))}")
+        if missing_libs:
+            log(f"  Warning: could not resolve {' '.join(sorted(missing_libs))}")
         
         LIBS_TO_BUNDLE = []
-        for binary in BINARIES_TO_CHECK:
-            try:
-                result = subprocess.run(["ldd", binary], capture_output=True, text=True)
-                if result.returncode == 0:
-                    for line in result.stdout.splitlines():
-                        match = re.search(r'=>\s*(/[^\s]+)', line)
-                        if match:
-                            lib_path = match.group(1)
-                            lib_name = os.path.basename(lib_path)
-                            
-                            if not re.match(r'^/(lib|lib64|usr/lib|usr/lib64)/(ld-|libc\.|libm\.|libpthread\.|libdl\.|librt\.|libresolv\.|libnss_)', lib_path) and \
-                               not "/gcc/" in lib_path and \
-                               "linux-vdso" not in lib_path:
-                                if not USE_KDE_RUNTIME or lib_name.startswith(("libKF6", "libKF5")):
-                                    LIBS_TO_BUNDLE.append(lib_path)
-            except:
-                pass
+        for lib_path in host_libs:
+            lib_name = os.path.basename(lib_path)
+            if lib_name.startswith(GLIBC_SONAME_PREFIXES):
+                if lib_name in outdated_libs:
+                    log(f"  Warning: {RUNTIME} has an older {lib_name} than the host, the application may not start")
+                continue
+            if runtime_files:
+                # Everything the runtime does not provide in a compatible version
+                LIBS_TO_BUNDLE.append(lib_path)
+            elif not "/gcc/" in lib_path:
+                # Runtime not installed here: fall back to guessing what it ships
+                if not USE_KDE_RUNTIME or lib_name.startswith(("libKF6", "libKF5")):
+                    LIBS_TO_BUNDLE.append(lib_path)
         
         if LIBS_TO_BUNDLE:
             LIB_BUNDLE_DIR = f"{ROOTFS}{EPREFIX}{PREFIX}/lib64"
-            subprocess.run([SUDO_COMMAND, "mkdir", "-p", LIB_BUNDLE_DIR], check=True)
-            seen = set()
+            privileged([["mkdir", LIB_BUNDLE_DIR]])
+            bundled = {}
             for lib_path in LIBS_TO_BUNDLE:
-                if os.path.isfile(lib_path) and lib_path not in seen:
-                    seen.add(lib_path)
+                if os.path.isfile(lib_path) and os.path.basename(lib_path) not in bundled:
+                    bundled[os.path.basename(lib_path)] = lib_path
                     log(f"  Bundling: {os.path.basename(lib_path)}")
-                    
-                    target_path = f"{LIB_BUNDLE_DIR}/{os.path.basename(lib_path)}"
-                    if os.path.islink(target_path):
-                        subprocess.run([SUDO_COMMAND, "rm", target_path], check=False)
-                    
-                    subprocess.run([SUDO_COMMAND, "cp", "-L", lib_path, f"{LIB_BUNDLE_DIR}/"], check=True)
-                    
-                    lib_dir = os.path.dirname(lib_path)
-                    lib_base = os.path.basename(lib_path)
-                    
-                    for symlink in Path(lib_dir).iterdir():
-                        if symlink.is_symlink():
-                            link_target = os.readlink(str(symlink))
-                            symlink_name = symlink.name
-                            
-                            if lib_base in link_target or link_target in lib_base or os.path.basename(link_target) == lib_base:
-                                symlink_target_path = f"{LIB_BUNDLE_DIR}/{symlink_name}"
-                                if os.path.islink(symlink_target_path):
-                                    subprocess.run([SUDO_COMMAND, "rm", symlink_target_path], check=False)
-                                
-                                target_file = os.path.basename(lib_path)
-                                subprocess.run([SUDO_COMMAND, "ln", "-sf", target_file, f"{LIB_BUNDLE_DIR}/{symlink_name}"], check=True)
-                                log(f"    Creating symlink: {symlink_name} -> {target_file}")
+            
+            # Host symlinks that resolve to the same file as a bundled library
+            # are recreated next to it, e.g. libfoo.so -> libfoo.so.1
+            symlink_indexes = {}
+            symlinks = {}
+            for lib_base, lib_path in bundled.items():
+                index = host_symlink_index(os.path.dirname(lib_path), symlink_indexes)
+                for symlink_name in index.get(os.path.realpath(lib_path), []):
+                    if symlink_name not in bundled and symlink_name not in symlinks:
+                        symlinks[symlink_name] = lib_base
+                        log(f"    Creating symlink: {symlink_name} -> {lib_base}")
+            
+            # One privileged batch copies every library and creates its symlinks
+            privileged([["copy", lib_path, f"{LIB_BUNDLE_DIR}/{lib_base}", False, True] for lib_base, lib_path in bundled.items()] +
+                       [["link", target, f"{LIB_BUNDLE_DIR}/{name}"] for name, target in symlinks.items()])
+            for lib_base, lib_path in bundled.items():
+                account_file(ROOTFS_USAGE, f"{LIB_BUNDLE_DIR}/{lib_base}", os.path.getsize(lib_path), owner="(bundled from the host)")
         else:
             log("  No additional libraries needed")
-    
-    log("Creating archive from filtered ROOTFS...")
-    TARBALL = f"{STAGE_DIR}/{SAFE_PKG}-rootfs.tar.zst"
-    
-    if BUILD_AS_DATA:
-        log("Contents being archived for data package:")
-        subprocess.run(["ls", "-la", f"{ROOTFS}/"], check=False)
-    
-    os.chdir(ROOTFS)
-    subprocess.run([SUDO_COMMAND, "tar", "--no-same-owner", "--no-same-permissions", "-I", "zstd -19 -T0", "-cf", TARBALL, "."], check=True)
-    subprocess.run([SUDO_COMMAND, "chown", f"{os.getuid()}:{os.getgid()}", TARBALL], check=True)
-    os.chdir(WORK_DIR)
-    
-    try:
-        result = subprocess.run(["du", "-sh", TARBALL], capture_output=True, text=True)
-        size = result.stdout.split()[0] if result.returncode == 0 else "unknown"
-        log(f"Tarball created: {size} - {TARBALL}")
-    except:
-        log(f"Tarball created: {TARBALL}")
-    
-    log("Verifying tarball contains only ROOTFS content...")
-    subprocess.run(["tar", "-tf", TARBALL], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        
+        phase_end("libs")
+    
+    if PRUNE and not BUILD_AS_RUNTIME and not BUILD_AS_DATA and COMMAND != "true" and \
+       phase_begin("prune", {"mode": PRUNE, "entry_points": ENTRY_POINTS, "plugin_dirs": PLUGIN_DIRS}) is None:
+        log(f"Looking for files that nothing reaches from {COMMAND}...")
+        APP_ROOT = f"{ROOTFS}{EPREFIX}"
+        prune_roots = [f"{bin_dir}/{COMMAND}" for bin_dir in (f"{APP_ROOT}/bin", f"{APP_ROOT}{PREFIX}/bin")
+                       if os.path.isfile(f"{bin_dir}/{COMMAND}")][:1]
+        prune_roots += [sandbox_path(ROOTFS, EPREFIX, entry_point) for entry_point in ENTRY_POINTS]
+        for plugin_dir in PLUGIN_DIRS:
+            for root, dirs, names in os.walk(sandbox_path(ROOTFS, EPREFIX, plugin_dir)):
+                prune_roots.extend(os.path.join(root, name) for name in names)
+        
+        if not any(read_elf_dynamic(os.path.realpath(path)) for path in prune_roots if os.path.isfile(path)):
+            log(f"  Warning: {COMMAND} is not an ELF executable, nothing to start from; declare --entry-point to prune")
+        else:
+            unreachable, kept = find_unreachable_files(APP_ROOT, prune_roots, library_search_layers(ROOTFS, EPREFIX, runtime_files))
+            if kept:
+                log(f"  Keeping {len(kept)} shared object(s) that nothing links against, they may be loaded with dlopen()")
+                if VERBOSE:
+                    for path in kept:
+                        log(f"    {path[len(ROOTFS):]}")
+            owners = ROOTFS_USAGE["owners"] if ROOTFS_USAGE else rootfs_file_owners(ROOTFS_VARDB_DIRS)
+            per_package = {}
+            pruned_sizes = {}
+            for path in unreachable:
+                owner = owners.get(path[len(ROOTFS):], "(not owned by any package)")
+                files, size = per_package.get(owner, (0, 0))
+                pruned_sizes[path] = None if os.path.islink(path) else os.lstat(path).st_size
+                per_package[owner] = (files + 1, size + (pruned_sizes[path] or 0))
+                if VERBOSE:
+                    log(f"    {path[len(ROOTFS):]}")
+            for owner, (files, size) in sorted(per_package.items(), key=lambda item: -item[1][1]):
+                log(f"  {owner}: {files} file(s), {format_size(size)}")
+            
+            total = sum(size for _, size in per_package.values())
+            if not unreachable:
+                log("  Every executable and library is reachable")
+            elif PRUNE == "remove":
+                privileged([["remove", path] for path in unreachable])
+                if ROOTFS_USAGE:
+                    for path, size in pruned_sizes.items():
+                        if size is not None:
+                            account_file(ROOTFS_USAGE, path, size, -1)
+                log(f"Pruned {len(unreachable)} file(s), saved {format_size(total)}")
+            else:
+                log(f"Would prune {len(unreachable)} file(s), saving {format_size(total)}; use --prune remove to delete them")
+        
+        phase_end("prune")
+    
+    TARBALL = ""
+    COMPRESSOR = None
+    if EXPORT_TARBALL or STAGE_MODE == "tarball":
+        if ROOTFS_USAGE is None:
+            ROOTFS_USAGE = new_size_usage(ROOTFS, [EPREFIX + PREFIX, EPREFIX], rootfs_file_owners(ROOTFS_VARDB_DIRS))
+            for _ in walk_rootfs(ROOTFS, ROOTFS_USAGE):
+                pass
+        ROOTFS_BYTES, COMPRESSED_BYTES = ROOTFS_USAGE["total"], ROOTFS_USAGE["compressed"]
+        COMPRESSOR = compression_command(COMPRESSION, EXPORT_TARBALL, ROOTFS_BYTES, COMPRESSED_BYTES)
+        TARBALL = f"{WORK_DIR if EXPORT_TARBALL else STAGE_DIR}/{SAFE_PKG}-rootfs.tar{'.zst' if COMPRESSOR else ''}"
+    
+    if ROOTFS_USAGE is not None:
+        log_size_usage(ROOTFS_USAGE, "Rootfs contents")
+        BUILD_REPORT["sizes"] = size_usage_summary(ROOTFS_USAGE)
+    
+    if phase_begin("staging", {"stage_mode": STAGE_MODE, "tarball": TARBALL, "compressor": COMPRESSOR}) is None:
+        if BUILD_AS_DATA:
+            log("Contents being staged for data package:")
+            subprocess.run(["ls", "-la", f"{ROOTFS}/"], check=False)
+        
+        if TARBALL:
+            log(f"Creating archive from filtered ROOTFS ({COMPRESSOR or 'uncompressed'}, "
+                f"{format_size(COMPRESSED_BYTES)} of {format_size(ROOTFS_BYTES)} already compressed)...")
+            os.chdir(ROOTFS)
+            archive_start = time.monotonic()
+            subprocess.run([SUDO_COMMAND, "tar", "--no-same-owner", "--no-same-permissions"] +
+                           (["-I", COMPRESSOR] if COMPRESSOR else []) + ["-cf", TARBALL, "."], check=True)
+            archive_time = max(time.monotonic() - archive_start, 0.001)
+            privileged([["chown", TARBALL, os.getuid(), os.getgid(), False]])
+            os.chdir(WORK_DIR)
+            
+            tarball_size = os.path.getsize(TARBALL)
+            log(f"Tarball created: {format_size(tarball_size)} - {TARBALL}")
+            log(f"  ratio {ROOTFS_BYTES / max(tarball_size, 1):.2f}x, "
+                f"{ROOTFS_BYTES / archive_time / 1024 ** 2:.1f} MiB/s over {archive_time:.1f}s")
+        
+        if STAGE_MODE == "dir":
+            # flatpak-builder reads the rootfs as the build user, as a plain directory source
+            log("Staging filtered ROOTFS as a flatpak-builder directory source...")
+            privileged([["chown", ROOTFS, os.getuid(), os.getgid(), True]])
+        
+        phase_end("staging")
+    
+    if STAGE_MODE == "dir":
+        ROOTFS_SOURCE = os.path.relpath(ROOTFS, FLATPAK_DIR)
+        SOURCE_YML = f"""      - type: dir
+        path: {ROOTFS_SOURCE}"""
+        EXTRACT_CMD = ""
+        CLEANUP_CMD = ""
+    else:
+        SOURCE_YML = f"""      - type: file
+        path: {os.path.basename(TARBALL)}"""
+        EXTRACT_CMD = f"""
+      - tar --no-same-owner --no-same-permissions -xaf {os.path.basename(TARBALL)}"""
+        CLEANUP_CMD = f"""
+      - rm -f ${{FLATPAK_DEST}}/{os.path.basename(TARBALL)}"""
     
     FLATPAK_GUI = False
     DESKTOP_FILE = ""
@@ -1154,10 +2877,8 @@ modules:
   - name: {SAFE_PKG}
     buildsystem: simple
     sources:
-      - type: file
-        path: {os.path.basename(TARBALL)}
-    build-commands:
-      - tar --no-same-owner --no-same-permissions -xaf {os.path.basename(TARBALL)}
+{SOURCE_YML}
+    build-commands:{EXTRACT_CMD}
       - |
         if [ -d share ]; then
           echo "Installing data files from share directory..."
@@ -1165,8 +2886,7 @@ modules:
           cp -aT share ${{FLATPAK_DEST}}/share/
         else
           echo "Warning: No share directory found in data package"
-        fi
-      - rm -f ${{FLATPAK_DEST}}/{os.path.basename(TARBALL)}
+        fi{CLEANUP_CMD}
       - |
         cat > ${{FLATPAK_DEST}}/metadata << 'DATA_META'
         [Runtime]
@@ -1187,10 +2907,8 @@ modules:
   - name: {SAFE_PKG}
     buildsystem: simple
     sources:
-      - type: file
-        path: {os.path.basename(TARBALL)}
-    build-commands:
-      - tar --no-same-owner --no-same-permissions -xaf {os.path.basename(TARBALL)}
+{SOURCE_YML}
+    build-commands:{EXTRACT_CMD}
       - if [ -d usr ]; then cp -aT usr ${{FLATPAK_DEST}}/ || true; fi
       - find ${{FLATPAK_DEST}} -type f | head -10 || echo "Files copied to runtime"
       - |
@@ -1211,10 +2929,8 @@ modules:
   - name: {SAFE_PKG}
     buildsystem: simple
     sources:
-      - type: file
-        path: {os.path.basename(TARBALL)}
-    build-commands:
-      - tar --no-same-owner --no-same-permissions -xaf {os.path.basename(TARBALL)}"""
+{SOURCE_YML}
+    build-commands:{EXTRACT_CMD}"""
         
         manifest_part2 = """
       - |
@@ -1264,15 +2980,24 @@ modules:
         
         manifest_content = manifest_part1 + manifest_part2 + manifest_part3 + manifest_part4
         
-        if FLATPAK_GUI and DESKTOP_FILE:
+        if STAGE_MODE == "dir":
+            # Only the desktop files and icons, not a second copy of the whole rootfs
+            DESKTOP_SOURCE_YML = ""
+            for share_dir in ["app/share/applications", "usr/share/applications", "app/share/icons", "usr/share/icons"]:
+                if os.path.isdir(f"{ROOTFS}/{share_dir}"):
+                    DESKTOP_SOURCE_YML += f"""
+      - type: dir
+        path: {ROOTFS_SOURCE}/{share_dir}
+        dest: {share_dir}"""
+        else:
+            DESKTOP_SOURCE_YML = "\n" + SOURCE_YML
+        
+        if FLATPAK_GUI and DESKTOP_FILE and DESKTOP_SOURCE_YML:
             desktop_part1 = f"""
   - name: desktop-integration
     buildsystem: simple
-    sources:
-      - type: file
-        path: {os.path.basename(TARBALL)}
-    build-commands:
-      - tar --no-same-owner --no-same-permissions -xaf {os.path.basename(TARBALL)}"""
+    sources:{DESKTOP_SOURCE_YML}
+    build-commands:{EXTRACT_CMD}"""
             
             desktop_part2 = """
       - |
@@ -1299,15 +3024,29 @@ modules:
 """
             manifest_content += desktop_part1 + desktop_part2
     
-    with open(MANIFEST, "w") as f:
-        f.write(manifest_content)
-    
-    shutil.copy(TARBALL, f"{FLATPAK_DIR}/")
-    
-    log("Building Flatpak...")
-    result = subprocess.run(["flatpak-builder", "--force-clean", BUILD_DIR, MANIFEST])
-    if result.returncode != 0:
-        error("Flatpak build failed")
+    if phase_begin("manifest", {"manifest": manifest_content}) is None:
+        with open(MANIFEST, "w") as f:
+            f.write(manifest_content)
+        
+        if STAGE_MODE == "tarball":
+            shutil.copy(TARBALL, f"{FLATPAK_DIR}/")
+        
+        phase_end("manifest")
+    
+    # Build and export in one flatpak-builder run; bundling and installing
+    # both work from the exported repository instead of rebuilding.
+    # With --state-dir/--repo the module cache and the OSTree object store
+    # outlive the build, so unchanged files are committed only once.
+    if phase_begin("builder", {"state_dir": STATE_DIR, "repo": REPO_DIR}) is None:
+        log(f"Building Flatpak and exporting it to {REPO_DIR}...")
+        builder_cmd = ["flatpak-builder", f"--repo={REPO_DIR}", "--force-clean"]
+        if STATE_DIR:
+            builder_cmd.append(f"--state-dir={STATE_DIR}")
+        result = subprocess.run(builder_cmd + [BUILD_DIR, MANIFEST])
+        if result.returncode != 0:
+            error("Flatpak build failed")
+        
+        phase_end("builder")
     
     log("Debugging: Contents of ROOTFS before bundle creation:")
     print("=== ROOTFS directory listing ===")
@@ -1315,76 +3054,27 @@ modules:
     subprocess.run(["ls", "-la", STAGE_DIR], check=False)
     print("\n=== End ROOTFS debug ===")
     
-    log("Creating Flatpak bundle...")
-    subprocess.run(["flatpak-builder", f"--repo={REPO_DIR}", "--force-clean", BUILD_DIR, MANIFEST], check=True)
-    BUNDLE = f"{WORK_DIR}/{SAFE_PKG}.flatpak"
-    
-    if BUILD_AS_DATA or BUILD_AS_RUNTIME:
-        subprocess.run(["flatpak", "build-bundle", "--runtime", REPO_DIR, BUNDLE, APP_ID, FLATPAK_APP_VERSION], check=True)
-    else:
-        subprocess.run(["flatpak", "build-bundle", REPO_DIR, BUNDLE, APP_ID], check=True)
-    
-    if INSTALL:
-        log("Installing Flatpak...")
-        subprocess.run(["flatpak-builder", "--user", "--install", "--force-clean", BUILD_DIR, MANIFEST], check=True)
-    
-    if RUN_AFTER:
-        log("Running application...")
-        subprocess.run(["flatpak", "run", APP_ID])
-    
-    print(f"""
-========================================
-Build Complete!
-========================================
-
-Package(s):     {' '.join(PKGS)}
-App ID:         {APP_ID}
-Version:        {FLATPAK_APP_VERSION}
-Build Type:     {BUILD_TYPE}
-Bundle:         {BUNDLE}""")
+    if phase_begin("bundle", {"bundle": BUNDLE}, requires=[BUNDLE]) is None:
+        log("Creating Flatpak bundle...")
+        if not export_bundle(REPO_DIR, BUNDLE, APP_ID):
+            error("Failed to create Flatpak bundle")
+        save_build_result(BUILD_FINGERPRINT, BUNDLE, REPO_DIR, BUNDLE_REF)
+        
+        phase_end("bundle")
     
-    if BUILD_AS_DATA:
-        print(f"""
-To install extension manually:
-  flatpak install --user -y {BUNDLE}
-
-To use in applications:
-  Add to your application manifest as extension dependency
-
-To uninstall:
-  flatpak uninstall {APP_ID}""")
-    elif BUILD_AS_RUNTIME:
-        print(f"""
-To install runtime manually:
-  flatpak install --user -y {BUNDLE}
-
-To use as runtime dependency:
-  --runtime={APP_ID}
-
-To uninstall:
-  flatpak uninstall -y {APP_ID}""")
-    else:
-        print(f"""Command:        {COMMAND}
-
-To install manually:
-  flatpak install --user -y {BUNDLE}
-
-To run:
-  flatpak run {APP_ID}
-
-To debug:
-  flatpak run --command=sh --devel {APP_ID}
-
-To uninstall:
-  flatpak uninstall -y {APP_ID}""")
+    if INSTALL and phase_begin("install", {"bundle": BUNDLE}, requires=[BUNDLE]) is None:
+        install_bundle(BUNDLE)
+        phase_end("install")
     
-    print()
+    BUILD_REPORT["status"] = "ok"
+    finish_build(BUNDLE, BUILD_TYPE)
     
     if CLEAN_AFTER:
         log("Cleaning up build directories...")
+        privileged([["remove", PORTAGE_STATE_DIR]], check=False)
         shutil.rmtree(STAGE_DIR, ignore_errors=True)
         
-        if os.path.isdir(".flatpak-builder"):
+        if not STATE_DIR and os.path.isdir(".flatpak-builder"):
             log("Cleaning up flatpak-builder cache...")
             shutil.rmtree(".flatpak-builder", ignore_errors=True)
         